@@ -12,15 +12,34 @@ This module is used with ``twisted.application.service.ServiceMaker`` in
 expose this code via ``twist`` and ``twistd``.
 """
 
-from twisted.python.log import msg
+import sys
+import socket
+from os import environ
+from errno import ENOENT
+from json import dumps, loads
+from tempfile import mkdtemp
+from collections import OrderedDict
+
+import attr
+
+from zope.interface import implementer
+
 # Rename this so we can have a module attribute named Options.  Stick with the
 # attribute-import style (as opposed to just importing ``usage``) to get early
 # warning of mistakes.
-from twisted.python.usage import Options as _Options
-from twisted.internet.defer import Deferred
-from twisted.internet.protocol import Factory, Protocol
+from twisted.python.usage import Options as _Options, UsageError
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+from twisted.internet.interfaces import IPushProducer, IStreamServerEndpoint
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.defer import (
+    Deferred, DeferredList, execute, succeed,
+)
+from twisted.internet.protocol import Factory, Protocol, ProcessProtocol
+from twisted.internet.stdio import StandardIO
+from twisted.protocols.basic import NetstringReceiver
 from twisted.internet.endpoints import TCP4ClientEndpoint, serverFromString
-from twisted.application.service import MultiService
+from twisted.application.service import MultiService, Service
 from twisted.application.internet import StreamServerEndpointService, TimerService
 
 from foolscap.tokens import BananaError, NegotiationError
@@ -31,10 +50,12 @@ from pyrsistent import freeze, pmap, pset
 from eliot import (
     Message,
     start_action,
+    write_failure,
 )
 from eliot.twisted import DeferredContext
 
-from prometheus_client import Gauge
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.multiprocess import MultiProcessCollector, mark_process_dead
 
 from lae_util import prometheus_exporter
 from lae_util.service import AsynchronousService
@@ -43,10 +64,14 @@ from lae_util.fluentd_destination import (
     opt_eliot_destination,
 )
 from lae_automation.kubeclient import KubeClient
+from lae_automation.informer import Informer
+from lae_automation.containers import CUSTOMER_METADATA_LABELS
 from lae_automation.subscription_converger import (
     KubernetesClientOptionsMixin, get_customer_grid_pods, divert_errors_to_log,
 )
 
+from ._snapshot import Snapshot, encode_snapshot, decode_snapshot
+
 
 
 class Options(_Options, KubernetesClientOptionsMixin):
@@ -55,17 +80,70 @@ class Options(_Options, KubernetesClientOptionsMixin):
     """
     optParameters = [
         ("interval", None, 10.0,
-         "The interval (in seconds) at which to iterate on reconfiguration.", float,
+         "The interval (in seconds) at which to iterate on reconfiguration.  "
+         "With --watch, the delay before re-listing after a watch error.",
+         float,
         ),
         ("metrics-port", None, "tcp:9000",
          "A server endpoint description string on which to run a metrics-exposing server.",
         ),
+        ("workers", None, 1,
+         "The number of processes which accept and proxy connections.  With "
+         "more than one, each worker process listens on the same port and "
+         "this process only keeps the routes up to date.  Each worker "
+         "enforces an even share of every subscription's bandwidth and "
+         "connection limits.",
+         int,
+        ),
+        ("upstream-spares", None, 0,
+         "The number of idle connections to keep open to each recently used "
+         "Tahoe-LAFS node, ready for new proxied connections.",
+         int,
+        ),
+        ("tenant-metrics-limit", None, 20,
+         "The number of subscriptions, among those using the most bandwidth "
+         "or connections, which get their own per-subscription metrics.  The "
+         "rest are counted together.",
+         int,
+        ),
+        ("route-snapshot", None, None,
+         "The path of a file in which to periodically save the routes.  At "
+         "startup, routes are loaded from this file and used until they can "
+         "be loaded from Kubernetes.",
+         FilePath,
+        ),
+    ]
+
+    optFlags = [
+        ("watch", None,
+         "Watch Kubernetes for Pod changes and apply them as they happen "
+         "instead of listing all Pods every --interval seconds.",
+        ),
+        ("worker", None,
+         "For internal use: run as one of the processes started by --workers.",
+        ),
+        ("connect-early", None,
+         "Begin connecting to the Tahoe-LAFS node as soon as the requested "
+         "TubID has been received instead of after the complete Foolscap "
+         "negotiation header.",
+        ),
     ]
 
-    opt_eliot_destination = opt_eliot_destination
+    def opt_eliot_destination(self, description):
+        # Remember the original description so it can be passed on to worker
+        # processes.
+        self.setdefault("eliot-destinations", []).append(description)
+        opt_eliot_destination(self, description)
 
     def postOptions(self):
-        KubernetesClientOptionsMixin.postOptions(self)
+        if self["workers"] < 1:
+            raise UsageError("--workers must be at least 1")
+        if self["upstream-spares"] < 0:
+            raise UsageError("--upstream-spares must not be negative")
+        if self["tenant-metrics-limit"] < 0:
+            raise UsageError("--tenant-metrics-limit must not be negative")
+        if not self["worker"]:
+            KubernetesClientOptionsMixin.postOptions(self)
 
 
 
@@ -93,45 +171,154 @@ def makeService(options, reactor=None):
         options.get("destinations", []),
     ).setServiceParent(parent)
 
-    def make_service():
+    if options["worker"]:
+        grid_router_worker_service(
+            reactor,
+            options["connect-early"],
+            options["upstream-spares"],
+            options["tenant-metrics-limit"],
+        ).setServiceParent(parent)
+        return parent
+
+    spawn_workers = None
+    registry = REGISTRY
+    if options["workers"] > 1:
+        metrics_directory = mkdtemp(prefix="grid-router-metrics-")
+        registry = _WorkerMetrics(metrics_directory, _WORKER_METRICS)
+        worker_arguments = list(
+            "--eliot-destination={}".format(description)
+            for description in options.get("eliot-destinations", [])
+        ) + [
+            "--upstream-spares={}".format(options["upstream-spares"]),
+            "--tenant-metrics-limit={}".format(options["tenant-metrics-limit"]),
+        ]
+        if options["connect-early"]:
+            worker_arguments.append("--connect-early")
+        spawn_workers = lambda router: _WorkerPoolService(
+            reactor, router, options["workers"], worker_arguments, metrics_directory,
+        )
+
+    # Start accepting connections right away, using the routes from the
+    # snapshot (if there is one) until Kubernetes can be reached.
+    router = _GridRouterService(
+        reactor,
+        options["connect-early"],
+        options["upstream-spares"],
+        options["tenant-metrics-limit"],
+    )
+    service = _routing_service(
+        reactor, router, spawn_workers, options["route-snapshot"],
+    )
+    service.setServiceParent(parent)
+
+    def make_updater():
         kubernetes = options.get_kubernetes_service(reactor)
         d = kubernetes.versioned_client()
         d.addCallback(
-            lambda client: grid_router_service(
+            lambda client: _router_updater(
                 reactor,
                 client,
                 options["kubernetes-namespace"].decode("ascii"),
                 options["interval"],
+                options["watch"],
+                router,
             )
         )
         return d
 
-    service = AsynchronousService(make_service)
-    service.setServiceParent(parent)
+    AsynchronousService(make_updater).setServiceParent(service)
 
     prometheus_exporter(
-        reactor, options["metrics-port"]
+        reactor, options["metrics-port"], registry,
     ).setServiceParent(parent)
 
     return parent
 
 
 
-def grid_router_service(reactor, k8s, kubernetes_namespace, interval):
+def _routing_service(reactor, router, spawn_workers, snapshot_path=None):
+    """
+    Create an ``IService`` which accepts connections and routes them with
+    ``router`` but does not keep the routes up to date.
+
+    :param _GridRouterService router: The router to use.
+
+    :param spawn_workers: If not ``None``, a one-argument callable which is
+        called with ``router`` and returns an ``IService`` which runs worker
+        processes to accept connections.  In this case no connections are
+        accepted by this process.  Otherwise, connections are accepted on
+        port 10000 by this process.
+
+    :param FilePath snapshot_path: If not ``None``, the file in which to save
+        the routes and from which to load them before connections are
+        accepted.
+    """
+    service = _GridRouterParent()
+    service.setName(_GridRouterService.name)
+
+    router.setServiceParent(service)
+
+    if snapshot_path is not None:
+        _RouteSnapshotService(reactor, router, snapshot_path).setServiceParent(service)
+
+    if spawn_workers is None:
+        StreamServerEndpointService(
+            serverFromString(reactor, "tcp:{}".format(_PROXY_PORT)),
+            router.factory(),
+        ).setServiceParent(service)
+    else:
+        spawn_workers(router).setServiceParent(service)
+
+    return service
+
+
+
+def _router_updater(reactor, k8s, kubernetes_namespace, interval, watch, router):
+    """
+    Create an ``IService`` which keeps the routes of ``router`` up to date
+    with the Pods in Kubernetes.
+
+    :param bool watch: If ``True``, keep routes up to date using a Kubernetes
+        watch.  Otherwise, poll for all Pods every ``interval`` seconds.
+    """
+    if watch:
+        return _router_informer(
+            reactor, interval, KubeClient(k8s=k8s), kubernetes_namespace, router,
+        )
+    return _RouterUpdateService(reactor, interval, k8s, kubernetes_namespace, router)
+
+
+
+def grid_router_worker_service(
+        reactor, connect_early=False, upstream_spares=0, tenant_metrics_limit=20,
+):
     """
-    Create an ``IService`` which can route connections to the correct grid.
+    Create an ``IService`` which accepts connections on port 10000 in one of
+    several worker processes and routes them using routes read from stdin.
+
+    The listening socket is bound with ``SO_REUSEPORT`` so the kernel spreads
+    incoming connections across all of the workers.  The process which
+    started the worker writes the routes using ``_RouteWriter``.  If stdin
+    is closed, that process is gone and the worker stops the reactor.
+
+    :param bool connect_early: See ``_GridRouterService``.
+
+    :param int upstream_spares: See ``_GridRouterService``.
+
+    :param int tenant_metrics_limit: See ``_GridRouterService``.
     """
     service = _GridRouterParent()
     service.setName(_GridRouterService.name)
 
-    router = _GridRouterService(reactor)
+    router = _GridRouterService(
+        reactor, connect_early, upstream_spares, tenant_metrics_limit,
+    )
     router.setServiceParent(service)
 
-    updater = _RouterUpdateService(reactor, interval, k8s, kubernetes_namespace, router)
-    updater.setServiceParent(service)
+    _RouteReaderService(reactor, router._route_index).setServiceParent(service)
 
     StreamServerEndpointService(
-        serverFromString(reactor, "tcp:10000"),
+        _ReusePortEndpoint(reactor, _PROXY_PORT),
         router.factory(),
     ).setServiceParent(service)
 
@@ -163,22 +350,144 @@ class _FoolscapProxy(Protocol):
     conversation to extract the TubID so that a proxy target can be selected
     based on that value.
 
-    :ivar bytes buffered: Data which has been received and buffered but not
+    The negotiation header is only scanned once: each received chunk is
+    searched for the end of the header along with the few bytes before it
+    which might begin the terminator.  Connections which send too much
+    without completing the header or which take too long to complete it are
+    dropped.
+
+    If the factory's ``connect_early`` is true, the connection to the
+    destination is begun as soon as the first line of the header (which
+    holds the TubID) has been received.
+
+    If the destination's subscription has a connection limit and that many
+    of its connections are already being proxied (or connected), the
+    connection is dropped.
+
+    :ivar int maximum_header_size: The most bytes which will be buffered
+        while waiting for the end of the negotiation header.
+
+    :ivar float handshake_timeout: The number of seconds a connection is
+        given to send a complete negotiation header.
+
+    :ivar float slow_handshake: The number of seconds after which a completed
+        handshake is counted as slow.
+
+    :ivar list _chunks: Data which has been received and buffered but not
         yet interpreted or passed on.
+
+    :ivar int _buffered: The total length of ``_chunks``.
+
+    :ivar bytes _tail: The last few bytes received, which might be the start
+        of the header terminator.
+
+    :ivar bytes _early_tub: The TubID for which a connection was begun early
+        or ``None`` if none was.
+
+    :ivar _early: The ``Deferred`` for the connection begun early or the
+        ``NegotiationError`` explaining why none could be.
+
+    :ivar _TenantStats _stats: The usage of the destination's subscription,
+        once a connection to the destination has been begun.  That
+        connection is counted in its ``connecting`` until it is handed to
+        ``proxy``.
     """
-    buffered = b""
+    maximum_header_size = 16 * 1024
+    handshake_timeout = 30.0
+    slow_handshake = 1.0
+
+    _rejected_handshakes = Counter(
+        u"grid_router_rejected_handshakes_total",
+        u"Connections grid-router dropped before proxying them.",
+        [u"reason"],
+    )
+
+    _slow_handshakes = Counter(
+        u"grid_router_slow_handshakes_total",
+        u"Connections which took more than one second to send a complete "
+        u"Foolscap negotiation header.",
+    )
+
+    _timeout = None
+    _early_tub = None
+    _early = None
+    _stats = None
+
+    def connectionMade(self):
+        self._chunks = []
+        self._buffered = 0
+        self._tail = b""
+        self._started = self.factory.reactor.seconds()
+        self._timeout = self.factory.reactor.callLater(
+            self.handshake_timeout, self._reject, u"timeout",
+        )
+
+
+    def connectionLost(self, reason):
+        self._cancel_timeout()
+        self._discard_early()
+
+
+    def _cancel_timeout(self):
+        if self._timeout is not None and self._timeout.active():
+            self._timeout.cancel()
+        self._timeout = None
+
+
+    def _reject(self, reason):
+        """
+        Drop this connection without proxying it.
+
+        :param unicode reason: A short description of what was wrong with the
+            connection.
+        """
+        self._cancel_timeout()
+        self._discard_early()
+        self._chunks = None
+        self._rejected_handshakes.labels(reason).inc()
+        Message.log(event_type=u"grid-router:rejected", reason=reason)
+        self.transport.abortConnection()
+
 
     def dataReceived(self, data):
         """
         Buffer the received data until enough is received that we can determine a
         proxy destination.
         """
-        msg("_FoolscapProxy.dataReceived {!r}".format(data))
-        self.buffered += data
-        if b"\r\n\r\n" in self.buffered:
-            header = self.buffered
-            self.buffered = b""
+        if self._chunks is None:
+            # Already rejected.
+            return
+
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered > self.maximum_header_size:
+            self._reject(u"too-large")
+            return
+
+        # Only look at the new bytes and the few before them which might be
+        # the start of the terminator.
+        scan = self._tail + data
+        if self.factory.connect_early and self._early_tub is None and b"\r\n" in scan:
+            self._connect_early()
+
+        if b"\r\n\r\n" not in scan:
+            self._tail = scan[-3:]
+            return
+
+        self._cancel_timeout()
+        if self.factory.reactor.seconds() - self._started > self.slow_handshake:
+            self._slow_handshakes.inc()
+
+        header = b"".join(self._chunks)
+        self._chunks = None
+        try:
             self.handlePLAINTEXTServer(header)
+        except (BananaError, ValueError):
+            self._reject(u"malformed")
+        except _ConnectionLimitExceeded:
+            self._reject(u"connection-limit")
+        except NegotiationError:
+            self._reject(u"refused")
 
     # Basically just copied from foolscap/negotiate.py so we get the tub id
     # extraction logic but we can then do something different with it.
@@ -221,36 +530,135 @@ class _FoolscapProxy(Protocol):
 
         :param bytes targetTubID: The TubID which was requested.
         """
-        try:
-            _, (ip, port_number) = self.factory.route_mapping()[targetTubID]
-        except KeyError:
-            raise NegotiationError("unknown TubID %s" % (targetTubID,))
+        if targetTubID == self._early_tub:
+            connecting = self._take_early()
+        else:
+            self._discard_early()
+            connecting = self._connect(targetTubID)
+
+        proxy(self, connecting, header, self.factory.reactor, self._stats)
+
+
+    def _connect(self, tub_id):
+        """
+        Begin connecting to the destination which is responsible for a TubID.
+
+        :param bytes tub_id: The TubID.
+
+        :raise NegotiationError: If there is no destination for the TubID.
 
+        :raise _ConnectionLimitExceeded: If the destination's subscription
+            already has as many connections as it is allowed.
+
+        :return Deferred: A ``Deferred`` that fires with a connected
+            ``_Proxy``.
+        """
+        route = self.factory.route_lookup(tub_id)
+        if route is None:
+            raise NegotiationError("unknown TubID %s" % (tub_id,))
+
+        address, tenant, bandwidth_limit, connection_limit = route
+        ip, port_number = address
         if not ip:
-            raise NegotiationError("TubID not yet available %s" % (targetTubID,))
+            raise NegotiationError("TubID not yet available %s" % (tub_id,))
+
+        stats = self.factory.tenants.stats(tenant, bandwidth_limit)
+        if connection_limit is not None and stats.connections + stats.connecting >= connection_limit:
+            raise _ConnectionLimitExceeded(
+                "connection limit %d reached for TubID %s" % (connection_limit, tub_id),
+            )
+        stats.connecting += 1
+        self._stats = stats
+        return self.factory.upstreams.connect(address)
+
+
+    def _connect_early(self):
+        """
+        Begin connecting to the destination for the TubID in the first line
+        of the negotiation header, if there is one.  Any problem with the
+        header is left to be discovered once the rest of it is received.
+        """
+        request_line = b"".join(self._chunks).split(b"\r\n", 1)[0]
+        parts = request_line.split()
+        if len(parts) != 3 or parts[0] != b"GET" or not parts[1].startswith(b"/id/"):
+            self._early_tub = b""
+            return
+
+        self._early_tub = parts[1][len(b"/id/"):]
+        try:
+            self._early = self._connect(self._early_tub)
+        except NegotiationError as e:
+            self._early = e
+
+
+    def _take_early(self):
+        early = self._early
+        self._early = None
+        if isinstance(early, NegotiationError):
+            raise early
+        return early
+
+
+    def _discard_early(self):
+        early = self._early
+        self._early = None
+        if isinstance(early, Deferred):
+            self._stats.connecting -= 1
+            early.cancel()
+            early.addCallbacks(
+                lambda downstream: downstream.transport.abortConnection(),
+                lambda reason: None,
+            )
 
-        # Now proxy to ip:port_number
-        proxy(self, TCP4ClientEndpoint(self.factory.reactor, ip, port_number), header)
+
+
+class _ConnectionLimitExceeded(NegotiationError):
+    """
+    A connection was refused because its destination's subscription already
+    has as many connections as it is allowed.
+    """
 
 
 
-def proxy(upstream, endpoint, header):
+def proxy(upstream, connecting, header, clock, tenant=None):
     """
-    Establish a new connection to ``endpoint`` and begin proxying between that
-    connection and ``upstream``.
+    Wait for a downstream connection to be established and begin proxying
+    between that connection and ``upstream``.
 
     :param IProtocol upstream: A connected protocol.  All data received by
         this protocol from this point on will be sent along to another newly
         established connection.
 
-    :param IStreamClientEndpoint endpoint: An endpoint to use to establish a
-        new connection.  All data received over this connection will be sent
-        along to the upstream connection.
+    :param Deferred connecting: A ``Deferred`` that fires with a connected
+        ``_Proxy``.  All data received over its connection will be sent along
+        to the upstream connection.
 
     :param bytes header: Some extra data to write to the new downstream
         connection before proxying begins.
+
+    :param IReactorTime clock: The clock with which to measure how long it
+        takes the downstream connection to be ready and to respond.
+
+    :param _TenantStats tenant: If not ``None``, the usage with which to
+        account for the connection.  The connection is counted in its
+        ``connecting`` until it is established or fails.
     """
+    started = clock.seconds()
+
+    def connected(downstream):
+        _Proxy._connect_latency.observe(clock.seconds() - started)
+        if tenant is not None:
+            tenant.connecting -= 1
+        return DeferredContext(downstream.take_over(
+            upstream,
+            header,
+            lambda: _Proxy._first_byte_latency.observe(clock.seconds() - started),
+            tenant,
+        ))
+
     def failed(reason):
+        if tenant is not None:
+            tenant.connecting -= 1
         upstream.transport.resumeProducing()
         upstream.transport.abortConnection()
         return reason
@@ -263,25 +671,204 @@ def proxy(upstream, endpoint, header):
         **{u"from": (peer.host, peer.port)}
     )
     with action.context():
-        d = DeferredContext(endpoint.connect(Factory.forProtocol(_Proxy)))
-        d.addCallbacks(
-            lambda downstream: DeferredContext(downstream.take_over(upstream, header)),
-            failed,
-        )
+        d = DeferredContext(connecting)
+        d.addCallbacks(connected, failed)
         return d.addActionFinish()
 
 
 
+@implementer(IPushProducer)
+class _ThrottledProducer(object):
+    """
+    An ``IPushProducer`` for one side of a proxied connection which can be
+    paused both by the consumer it is registered with and, for a while, to
+    keep within a bandwidth limit.  The transport only reads while neither
+    wants it paused.
+
+    :ivar _transport: The transport to pause and resume.
+
+    :ivar bool _paused: Whether the consumer has paused this producer.
+
+    :ivar _throttled: ``None`` or an ``IDelayedCall`` which will end the
+        current throttling.
+    """
+    def __init__(self, transport):
+        self._transport = transport
+        self._paused = False
+        self._throttled = None
+
+
+    def _reading(self):
+        return not self._paused and self._throttled is None
+
+
+    def pauseProducing(self):
+        if self._reading():
+            self._transport.pauseProducing()
+        self._paused = True
+
+
+    def resumeProducing(self):
+        self._paused = False
+        if self._reading():
+            self._transport.resumeProducing()
+
+
+    def stopProducing(self):
+        self.unthrottle()
+        self._transport.stopProducing()
+
+
+    def throttle(self, clock, delay):
+        """
+        Stop reading for a while, unless already doing so because of an
+        earlier call.
+
+        :param IReactorTime clock: The clock with which to schedule reading
+            again.
+
+        :param float delay: The number of seconds to stop reading for.
+
+        :return bool: ``True`` if this began a period of throttling,
+            ``False`` if one was already in progress.
+        """
+        if self._throttled is not None:
+            return False
+        if self._reading():
+            self._transport.pauseProducing()
+        self._throttled = clock.callLater(delay, self._unthrottled)
+        return True
+
+
+    def unthrottle(self):
+        """
+        End any current throttling without resuming reading.
+        """
+        if self._throttled is not None:
+            self._throttled.cancel()
+            self._throttled = None
+
+
+    def _unthrottled(self):
+        self._throttled = None
+        if self._reading():
+            self._transport.resumeProducing()
+
+
+
+@implementer(IPushProducer)
+@attr.s
+class _StallCountingProducer(object):
+    """
+    An ``IPushProducer`` which passes calls through to another producer and
+    counts how many times it is paused.
+
+    :ivar _producer: The wrapped producer.
+
+    :ivar _stalls: A Prometheus counter to increment each time the producer
+        is paused.
+    """
+    _producer = attr.ib()
+    _stalls = attr.ib()
+
+    def pauseProducing(self):
+        self._stalls.inc()
+        self._producer.pauseProducing()
+
+    def resumeProducing(self):
+        self._producer.resumeProducing()
+
+    def stopProducing(self):
+        self._producer.stopProducing()
+
+
+
+# Latency buckets for connections between the grid router and Tahoe-LAFS
+# nodes, which are on the same cluster network.
+_LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, float(u"inf"),
+)
+
+
+
 class _Proxy(Protocol):
     """
     Handle the downstream connection for a proxy between two connections.
+
+    Each connection's transport is registered as the streaming producer for
+    the other connection's transport.  When one side is slow to accept data
+    and its write buffer fills up, the other side stops reading until the
+    buffer drains.  This bounds the memory used for each proxied connection.
+
+    If the subscription has a bandwidth limit, data is passed along as it
+    arrives but the side it arrived from stops reading for as long as the
+    subscription's token bucket is in debt.  No data is dropped.
+
+    :ivar int _bytes_downstream: The number of bytes received from the
+        upstream connection and passed on to the downstream connection.
+
+    :ivar int _bytes_upstream: The number of bytes received from the
+        downstream connection and passed on to the upstream connection.
+
+    :ivar idle_lost: ``None`` or a one-argument callable to call with this
+        protocol if its connection is lost before it is used for proxying.
     """
     _proxied_connections = Gauge(
         u"grid_router_connections",
         u"Current count of connections proxied by grid-router to Tahoe-LAFS.",
+        # Summed across the live worker processes, with --workers.
+        multiprocess_mode=u"livesum",
+    )
+
+    _connect_latency = Histogram(
+        u"grid_router_upstream_connect_seconds",
+        u"Time from receiving a complete Foolscap negotiation header to "
+        u"having a connection to the Tahoe-LAFS node to proxy it to.",
+        buckets=_LATENCY_BUCKETS,
+    )
+
+    _first_byte_latency = Histogram(
+        u"grid_router_first_byte_seconds",
+        u"Time from receiving a complete Foolscap negotiation header to "
+        u"receiving the first byte of the Tahoe-LAFS node's response.",
+        buckets=_LATENCY_BUCKETS,
     )
 
-    def take_over(self, upstream, header):
+    _proxied_bytes = Counter(
+        u"grid_router_proxied_bytes_total",
+        u"Bytes proxied by grid-router, counted when each connection closes.",
+        [u"direction"],
+    )
+
+    _connection_bytes = Histogram(
+        u"grid_router_connection_bytes",
+        u"Bytes proxied by grid-router over the lifetime of one connection.",
+        [u"direction"],
+        buckets=(2 ** 10, 2 ** 14, 2 ** 17, 2 ** 20, 2 ** 23, 2 ** 27, 2 ** 30, float(u"inf")),
+    )
+
+    _backpressure_stalls = Counter(
+        u"grid_router_backpressure_stalls_total",
+        u"Times grid-router stopped reading from one side of a proxied "
+        u"connection because the other side was not keeping up.",
+        [u"direction"],
+    )
+
+    _throttles = Counter(
+        u"grid_router_throttled_total",
+        u"Times grid-router stopped reading from one side of a proxied "
+        u"connection to keep within its subscription's bandwidth limit.",
+        [u"direction"],
+    )
+
+    _bytes_downstream = 0
+    _bytes_upstream = 0
+    _first_byte = None
+    upstream = None
+    idle_lost = None
+
+    def take_over(self, upstream, header, first_byte=None, tenant=None):
         """
         Begin actively proxying between this protocol and ``upstream``.
 
@@ -291,11 +878,24 @@ class _Proxy(Protocol):
         :param bytes header: Any data that should be sent downstream before
             engaging the proxy.
 
+        :param first_byte: ``None`` or a no-argument callable to call when
+            the first data is received from the downstream connection.
+
+        :param _TenantStats tenant: If not ``None``, where to account for
+            this connection and the data proxied over it.
+
         :return Deferred: A ``Deferred`` that fires when this protocol's
             connection is lost.  This should be tightly coupled to loss of the
             upstream protocol's connection.
         """
         self.done = Deferred()
+        self.idle_lost = None
+        self._first_byte = first_byte
+        if tenant is None:
+            tenant = _TenantStats()
+        self._tenant = tenant
+        tenant.connects += 1
+        tenant.connections += 1
 
         self._proxied_connections.inc()
 
@@ -307,15 +907,71 @@ class _Proxy(Protocol):
         with a:
             self.transport.write(header)
 
-            upstream.dataReceived = self.transport.write
+            upstream.dataReceived = self._upstream_data_received
             upstream.connectionLost = self._upstream_connection_lost
 
-            self.dataReceived = upstream.transport.write
             self.upstream = upstream
+
+            # Stop reading from either side while the other side has more
+            # data buffered for writing than it can handle.
+            self._upstream_reader = _ThrottledProducer(upstream.transport)
+            self._downstream_reader = _ThrottledProducer(self.transport)
+            self.transport.registerProducer(
+                _StallCountingProducer(
+                    self._upstream_reader,
+                    self._backpressure_stalls.labels(u"downstream"),
+                ),
+                True,
+            )
+            upstream.transport.registerProducer(
+                _StallCountingProducer(
+                    self._downstream_reader,
+                    self._backpressure_stalls.labels(u"upstream"),
+                ),
+                True,
+            )
+
             self.upstream.transport.resumeProducing()
             return self.done
 
 
+    def _upstream_data_received(self, data):
+        """
+        Data was received from the upstream connection.  Send it downstream.
+        """
+        self._bytes_downstream += len(data)
+        self._tenant.bytes_downstream += len(data)
+        self.transport.write(data)
+        if self._tenant.bandwidth is not None:
+            self._throttle(self._upstream_reader, len(data), u"downstream")
+
+
+    def dataReceived(self, data):
+        """
+        Data was received from the downstream connection.  Send it upstream.
+        """
+        if self._first_byte is not None:
+            first_byte = self._first_byte
+            self._first_byte = None
+            first_byte()
+        self._bytes_upstream += len(data)
+        self._tenant.bytes_upstream += len(data)
+        self.upstream.transport.write(data)
+        if self._tenant.bandwidth is not None:
+            self._throttle(self._downstream_reader, len(data), u"upstream")
+
+
+    def _throttle(self, reader, amount, direction):
+        """
+        Account for data proxied under the subscription's bandwidth limit and
+        stop reading from the side it came from if the limit is exceeded.
+        """
+        bandwidth = self._tenant.bandwidth
+        delay = bandwidth.consume(amount)
+        if delay and reader.throttle(bandwidth.clock, delay):
+            self._throttles.labels(direction).inc()
+
+
     def _upstream_connection_lost(self, reason):
         """
         The upstream connection was lost.  Close this connection as well.
@@ -328,113 +984,872 @@ class _Proxy(Protocol):
         This protocol's connection was lost.  Close the upstream connection as
         well.
         """
+        if self.upstream is None:
+            # It was never used for proxying.
+            if self.idle_lost is not None:
+                self.idle_lost(self)
+            return
+
         self._proxied_connections.dec()
+        self._tenant.connections -= 1
+        self._upstream_reader.unthrottle()
+        self._downstream_reader.unthrottle()
+        for direction, count in [
+                (u"downstream", self._bytes_downstream),
+                (u"upstream", self._bytes_upstream),
+        ]:
+            self._proxied_bytes.labels(direction).inc(count)
+            self._connection_bytes.labels(direction).observe(count)
 
         self.upstream.transport.abortConnection()
         del self.upstream.dataReceived
         del self.upstream.connectionLost
 
-        del self.dataReceived
         self.upstream = None
         self.done.callback(None)
 
 
 
-class _GridRouterService(MultiService):
-    """
-    ``_GridRouterService`` accepts connections on many ports and proxies them
-    to the pod responsible for them.  Responsibility is determined by the
-    local port number.
+# When the route mapping last agreed with Kubernetes.  The staleness of the
+# routes is the difference between the current time and this value.
+_route_sync_time = Gauge(
+    u"grid_router_routes_last_sync_timestamp_seconds",
+    u"The time at which grid-router's routes were last known to agree with Kubernetes.",
+)
 
-    :ivar _reactor: A Twisted reactor which can be used to establish
-        connections for the proxy.
 
-    :ivar _route_mapping: A mapping from tub identifiers to destination
-        information.  The destination information is a two-tuple of an IP
-        address and a port number.  It gives an address where a Foolscap node
-        capable of servicing the tub identifier can be reached.
-    """
-    name = u"grid-router"
 
-    def __init__(self, reactor):
-        MultiService.__init__(self)
-        self._reactor = reactor
-        self._route_mapping = freeze({})
+def _introducer_tub(pod):
+    return pod.metadata.annotations[u"leastauthority.com/introducer-tub-id"]
+def _storage_tub(pod):
+    return pod.metadata.annotations[u"leastauthority.com/storage-tub-id"]
 
+def _introducer_port_number(pod):
+    return int(pod.metadata.annotations[u"leastauthority.com/introducer-port-number"])
+def _storage_port_number(pod):
+    return int(pod.metadata.annotations[u"leastauthority.com/storage-port-number"])
 
-    def factory(self):
-        """
-        :return: A protocol factory for a Foolscap proxy server.
-        """
-        f = Factory.forProtocol(_FoolscapProxy)
-        f.reactor = self._reactor
-        f.route_mapping = self.route_mapping
-        return f
+def _introducer_address(pod):
+    return (pod.status.podIP, _introducer_port_number(pod))
+def _storage_address(pod):
+    return (pod.status.podIP, _storage_port_number(pod))
 
 
-    def route_mapping(self):
-        """
-        Retrieve the mapping describing how to route connections to pods.
 
-        :return PMap: A mapping from a tub identifier to a (host, port) pair.
-        """
-        return self._route_mapping
+def _pod_name(pod):
+    """
+    :return: The name of ``pod`` or ``None`` if ``pod`` is ``None`` (as it
+        is for routes loaded from a snapshot).
+    """
+    if pod is None:
+        return None
+    return pod.metadata.name
 
 
-    def set_pods(self, pods):
-        """
-        Update grid routing rules based on new information about what pods exist.
 
-        :param list[v1.Pod] pods: The pods which were observed to exist very
-            recently.
-        """
-        self.set_route_mapping(self._pods_to_routes(self._route_mapping, pods))
+def _pod_tenant(pod):
+    """
+    :return: The subscription identifier of ``pod`` or ``None`` if it is not
+        known.
+    """
+    if pod is None:
+        return None
+    return pod.metadata.annotations.get(u"subscription")
 
 
-    def set_route_mapping(self, route_mapping):
-        """
-        Record a new route mapping.
 
-        :param route_mapping: A new value for the private ``_route_mapping``
-            attribute.
-        """
-        self._route_mapping = freeze(route_mapping)
+def _pod_limit(pod, name):
+    """
+    :return: The positive integer value of the grid router limit annotation
+        ``name`` on ``pod`` or ``None`` if there is no such limit.
+    """
+    if pod is None:
+        return None
+    value = pod.metadata.annotations.get(name)
+    if value is None:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+    if limit <= 0:
+        Message.log(
+            event_type=u"router:invalid-limit",
+            pod=pod.metadata.name,
+            name=name,
+            value=value,
+        )
+        return None
+    return limit
 
 
-    def _pods_to_routes(self, old, pods):
-        """
-        Extract the addressing information from some pods.
 
-        :param old: The old routing information.  Used to log route changes.
+def _index_route(pod, address):
+    """
+    :return: The ``_RouteIndex`` route to ``address`` which is served by
+        ``pod``.
+    """
+    return (
+        address,
+        _pod_tenant(pod),
+        _pod_limit(pod, u"leastauthority.com/router-bandwidth-limit"),
+        _pod_limit(pod, u"leastauthority.com/router-connection-limit"),
+    )
 
-        :param list[v1.Pod] pods: Some pods from which routing information can
-            be extracted.
 
-        :return: A mapping of the new routing information deriving solely from
-            ``pods``.
-        """
-        def _introducer_tub(pod):
-            return pod.metadata.annotations[u"leastauthority.com/introducer-tub-id"]
-        def _storage_tub(pod):
-            return pod.metadata.annotations[u"leastauthority.com/storage-tub-id"]
 
-        def _introducer_port_number(pod):
-            return int(pod.metadata.annotations[u"leastauthority.com/introducer-port-number"])
-        def _storage_port_number(pod):
-            return int(pod.metadata.annotations[u"leastauthority.com/storage-port-number"])
+def _pod_routes(pod):
+    """
+    Extract the addressing information from one pod.
 
-        def _introducer_address(pod):
-            return (pod.status.podIP, _introducer_port_number(pod))
-        def _storage_address(pod):
-            return (pod.status.podIP, _storage_port_number(pod))
+    :param v1.Pod pod: A customer grid pod.
 
-        with start_action(action_type=u"router-update:set-pods", count=len(pods)):
-            new = pmap([
-                (_introducer_tub(pod), (pod, _introducer_address(pod)))
-                for pod in pods
-            ] + [
-                (_storage_tub(pod), (pod, _storage_address(pod)))
-                for pod in pods
+    :return: A list of two-tuples of a tub identifier and a two-tuple of
+        ``pod`` and the (host, port) address of that tub.
+    """
+    return [
+        (_introducer_tub(pod), (pod, _introducer_address(pod))),
+        (_storage_tub(pod), (pod, _storage_address(pod))),
+    ]
+
+
+
+class _RouteIndex(object):
+    """
+    A compact index from tub identifier to route, used to route each
+    accepted connection.  A route is a four-tuple of the ``(host, port)``
+    address which serves the tub, the subscription identifier it belongs to,
+    and that subscription's bandwidth limit (bytes per second) and
+    connection limit.  Any but the address may be ``None`` if it is not
+    known or there is no limit.
+
+    The index is a plain ``dict`` keyed on interned ``bytes`` tub identifiers
+    (the type they are parsed from the Foolscap negotiation as).  It is
+    replaced wholesale when a complete set of routes is known and adjusted
+    in place for single changes.  Either way, a lookup never sees a partial
+    update because the reactor is single-threaded.
+
+    Recently requested tub identifiers which had no route are remembered in
+    a bounded, least-recently-used set.  It only limits logging: a repeated
+    request from a scanner or misconfigured client is counted but not logged
+    again.  It does not make lookups cheaper, since a miss in ``_routes`` is
+    already a single ``dict`` lookup, and every lookup still consults
+    ``_routes`` first so a tub identifier which gains a route is found at
+    once.
+
+    :ivar dict _routes: The index.
+
+    :ivar OrderedDict _unknown: The tub identifiers which were requested
+        recently but had no route and have already been logged.
+
+    :ivar int _unknown_limit: The maximum size of ``_unknown``.
+    """
+    _unknown_requests = Counter(
+        u"grid_router_unknown_tub_requests_total",
+        u"Connections grid-router refused because they asked for an unknown TubID.",
+    )
+
+    def __init__(self, unknown_limit=1024):
+        self._routes = {}
+        self._unknown = OrderedDict()
+        self._unknown_limit = unknown_limit
+
+
+    def _key(self, tub_id):
+        return intern(tub_id.encode("ascii"))
+
+
+    def lookup(self, tub_id):
+        """
+        :param bytes tub_id: A tub identifier.
+
+        :return: The route for ``tub_id`` or ``None`` if there is none.
+        """
+        try:
+            return self._routes[tub_id]
+        except KeyError:
+            pass
+
+        self._unknown_requests.inc()
+        try:
+            # Refresh its position in the LRU ordering.
+            self._unknown[tub_id] = self._unknown.pop(tub_id)
+        except KeyError:
+            Message.log(event_type=u"router:unknown-tub", tub_id=tub_id)
+            self._unknown[tub_id] = None
+            if len(self._unknown) > self._unknown_limit:
+                self._unknown.popitem(last=False)
+        return None
+
+
+    def replace(self, routes):
+        """
+        Replace the entire contents of the index.
+
+        :param routes: An iterable of two-tuples of tub identifier and
+            route.
+        """
+        self._routes = {
+            self._key(tub_id): route
+            for (tub_id, route)
+            in routes
+        }
+        self._unknown.clear()
+
+
+    def add(self, tub_id, route):
+        """
+        Add or change the route for one tub identifier.
+        """
+        key = self._key(tub_id)
+        self._routes[key] = route
+        self._unknown.pop(key, None)
+
+
+    def discard(self, tub_id):
+        """
+        Remove the route for one tub identifier, if there is one.
+        """
+        self._routes.pop(self._key(tub_id), None)
+
+
+
+class _TenantStats(object):
+    """
+    Usage of the grid router by one subscription.
+
+    The proxy updates these plain attributes directly as it works.
+    ``_TenantAccounting.flush`` periodically moves them into Prometheus
+    metrics.
+
+    :ivar int connections: The number of connections currently being proxied.
+
+    :ivar int connects: The number of connections proxied since the last
+        flush.
+
+    :ivar int bytes_downstream: The number of bytes proxied to Tahoe-LAFS
+        since the last flush.
+
+    :ivar int bytes_upstream: The number of bytes proxied from Tahoe-LAFS
+        since the last flush.
+
+    :ivar int connecting: The number of connections to Tahoe-LAFS being
+        established which will be proxied once they are.
+
+    :ivar _TokenBucket bandwidth: ``None`` or the bucket from which to take
+        a token for each byte proxied in either direction.
+    """
+    __slots__ = (
+        "connections", "connects", "bytes_downstream", "bytes_upstream",
+        "connecting", "bandwidth",
+    )
+
+    def __init__(self):
+        self.connections = 0
+        self.connects = 0
+        self.bytes_downstream = 0
+        self.bytes_upstream = 0
+        self.connecting = 0
+        self.bandwidth = None
+
+
+
+class _TokenBucket(object):
+    """
+    A token bucket which allows an average of ``rate`` tokens per second
+    with bursts of up to one second's worth (or ``minimum_burst``, if that
+    is more).
+
+    Tokens may be taken even when there are not enough.  The bucket goes
+    into debt and the caller is told how long to wait for it to be paid off.
+
+    :ivar clock: The ``IReactorTime`` provider used to refill the bucket.
+
+    :ivar int rate: The number of tokens added each second.
+    """
+    __slots__ = ("clock", "rate", "_burst", "_tokens", "_updated")
+
+    minimum_burst = 64 * 1024
+
+    def __init__(self, clock, rate):
+        self.clock = clock
+        self.rate = rate
+        self._burst = max(rate, self.minimum_burst)
+        self._tokens = self._burst
+        self._updated = clock.seconds()
+
+
+    def consume(self, amount):
+        """
+        Take tokens from the bucket.
+
+        :param int amount: The number of tokens to take.
+
+        :return float: The number of seconds until the bucket is out of debt
+            or ``0`` if it is not in debt.
+        """
+        now = self.clock.seconds()
+        tokens = min(
+            self._burst, self._tokens + (now - self._updated) * self.rate,
+        ) - amount
+        self._tokens = tokens
+        self._updated = now
+        if tokens >= 0:
+            return 0
+        return -tokens / float(self.rate)
+
+
+
+class _TenantAccounting(object):
+    """
+    ``_TenantAccounting`` tracks how much each subscription uses the grid
+    router and exposes the heaviest users as labelled Prometheus metrics.
+
+    To keep the number of time series bounded, only the ``limit``
+    subscriptions with the most traffic (or, for the connection gauge, the
+    most connections) since the last flush get their own label value.  The
+    rest are counted under ``u"other"``.  Connections whose subscription is
+    not known are counted under ``u"unknown"``.
+
+    Bandwidth and connection limits are enforced only on the connections
+    this process proxies.  With ``--workers``, each worker process has its
+    own ``_TenantAccounting`` and is given a share of each limit (see
+    ``_RouteWriter``).  A subscription whose connections are unevenly spread
+    between the workers may therefore be limited somewhat before it reaches
+    its whole limit.
+
+    :ivar dict _stats: A mapping from subscription identifier to
+        ``_TenantStats``.
+
+    :ivar set _counted: The subscriptions with their own values for the
+        traffic counters as of the last flush.
+
+    :ivar set _labelled: The subscriptions with their own value for the
+        connection gauge as of the last flush.
+
+    :ivar _clock: The ``IReactorTime`` provider for bandwidth limiting.
+    """
+    _bytes = Counter(
+        u"grid_router_tenant_bytes_total",
+        u"Bytes grid-router proxied for a subscription.",
+        [u"subscription", u"direction"],
+    )
+
+    _connects = Counter(
+        u"grid_router_tenant_connections_total",
+        u"Connections grid-router proxied for a subscription.",
+        [u"subscription"],
+    )
+
+    _connections = Gauge(
+        u"grid_router_tenant_connections",
+        u"Connections grid-router is currently proxying for a subscription.",
+        [u"subscription"],
+        multiprocess_mode=u"livesum",
+    )
+
+    def __init__(self, limit, clock):
+        self._limit = limit
+        self._clock = clock
+        self._stats = {}
+        self._counted = set()
+        self._labelled = set()
+
+
+    def stats(self, tenant, bandwidth_limit=None):
+        """
+        :param tenant: A subscription identifier or ``None``.
+
+        :param int bandwidth_limit: ``None`` or the number of bytes per second
+            to which the subscription is currently limited.
+
+        :return _TenantStats: The usage of that subscription.
+        """
+        if tenant is None:
+            tenant = u"unknown"
+        try:
+            stats = self._stats[tenant]
+        except KeyError:
+            stats = self._stats[tenant] = _TenantStats()
+
+        bandwidth = stats.bandwidth
+        if bandwidth_limit is None:
+            stats.bandwidth = None
+        elif bandwidth is None or bandwidth.rate != bandwidth_limit:
+            stats.bandwidth = _TokenBucket(self._clock, bandwidth_limit)
+        return stats
+
+
+    def _top(self, key):
+        ranked = sorted(self._stats, key=lambda tenant: key(self._stats[tenant]), reverse=True)
+        return set(
+            tenant
+            for tenant in ranked[:self._limit]
+            if key(self._stats[tenant])
+        )
+
+
+    def flush(self):
+        """
+        Move the usage recorded since the last flush into the Prometheus
+        metrics.
+        """
+        traffic = self._top(lambda stats: stats.bytes_downstream + stats.bytes_upstream + stats.connects)
+        connected = self._top(lambda stats: stats.connections)
+
+        other_connections = 0
+        for tenant, stats in self._stats.items():
+            label = tenant if tenant in traffic else u"other"
+            if stats.connects:
+                self._connects.labels(label).inc(stats.connects)
+            if stats.bytes_downstream:
+                self._bytes.labels(label, u"downstream").inc(stats.bytes_downstream)
+            if stats.bytes_upstream:
+                self._bytes.labels(label, u"upstream").inc(stats.bytes_upstream)
+            stats.connects = stats.bytes_downstream = stats.bytes_upstream = 0
+
+            if tenant in connected:
+                self._connections.labels(tenant).set(stats.connections)
+            else:
+                other_connections += stats.connections
+                if not stats.connections and not stats.connecting:
+                    # Nothing in progress and nothing to report.
+                    del self._stats[tenant]
+
+        self._connections.labels(u"other").set(other_connections)
+
+        # Drop the series of subscriptions which are no longer among the
+        # heaviest so that the number of series stays bounded as the
+        # heaviest subscriptions change.
+        for tenant in self._counted - traffic:
+            _remove_series(self._connects, tenant)
+            _remove_series(self._bytes, tenant, u"downstream")
+            _remove_series(self._bytes, tenant, u"upstream")
+        self._counted = traffic
+        for tenant in self._labelled - connected:
+            # Zero the value first in case it is shared with other processes
+            # (see ``prometheus_client.multiprocess``).
+            self._connections.labels(tenant).set(0)
+            _remove_series(self._connections, tenant)
+        self._labelled = connected
+
+
+
+def _remove_series(metric, *labels):
+    """
+    Remove the series of a labelled metric, if it has one.
+
+    :param metric: The labelled Prometheus metric.
+    :param labels: The label values of the series to remove.
+    """
+    try:
+        metric.remove(*labels)
+    except KeyError:
+        pass
+
+
+
+class _UpstreamPool(object):
+    """
+    ``_UpstreamPool`` makes the connections from the grid router to the
+    Tahoe-LAFS nodes it proxies to.
+
+    Optionally, it keeps some idle connections open to each address which
+    was connected to recently.  A new proxied connection to one of those
+    addresses takes one of them instead of waiting for a TCP handshake.  This
+    helps most when many clients reconnect at once.  Idle connections are
+    closed before the Foolscap server gives up waiting for them to begin
+    negotiating.
+
+    :ivar float spare_lifetime: The number of seconds an idle connection is
+        kept open.
+
+    :ivar float hot_lifetime: The number of seconds after a connection to an
+        address during which idle connections to it are kept open.
+
+    :ivar int _spares_per_address: The number of idle connections to keep
+        open to each recently used address.
+
+    :ivar dict _spares: A mapping from addresses to lists of connected, idle
+        ``_Proxy`` instances.
+
+    :ivar dict _connecting: A mapping from addresses to the number of idle
+        connections being established to them.
+
+    :ivar dict _last_used: A mapping from addresses to the time of the most
+        recent connection to them.
+    """
+    spare_lifetime = 60.0
+    hot_lifetime = 60.0
+
+    _connections = Counter(
+        u"grid_router_upstream_connections_total",
+        u"Connections grid-router used to proxy to Tahoe-LAFS, by whether "
+        u"an idle connection was available or a new one was made.",
+        [u"source"],
+    )
+
+    def __init__(self, reactor, spares):
+        self._reactor = reactor
+        self._spares_per_address = spares
+        self._spares = {}
+        self._connecting = {}
+        self._last_used = {}
+
+
+    def connect(self, address):
+        """
+        Get a connection to an address.
+
+        :param address: A two-tuple of an IP address and a port number.
+
+        :return Deferred: A ``Deferred`` that fires with a connected
+            ``_Proxy``.
+        """
+        spares = self._spares.get(address)
+        if spares:
+            protocol, expiry = spares.pop()
+            expiry.cancel()
+            protocol.idle_lost = None
+            self._connections.labels(u"spare").inc()
+            d = succeed(protocol)
+        else:
+            self._connections.labels(u"new").inc()
+            d = self._connect(address)
+
+        if self._spares_per_address:
+            self._last_used[address] = self._reactor.seconds()
+            self._replenish(address)
+        return d
+
+
+    def _connect(self, address):
+        ip, port_number = address
+        return TCP4ClientEndpoint(self._reactor, ip, port_number).connect(
+            Factory.forProtocol(_Proxy),
+        )
+
+
+    def _hot(self, address):
+        last_used = self._last_used.get(address)
+        return (
+            last_used is not None and
+            self._reactor.seconds() - last_used < self.hot_lifetime
+        )
+
+
+    def _replenish(self, address):
+        """
+        Begin establishing enough idle connections to ``address`` to bring
+        the total up to the configured number.
+        """
+        spares = self._spares.setdefault(address, [])
+        connecting = self._connecting.get(address, 0)
+        missing = self._spares_per_address - len(spares) - connecting
+        if missing <= 0:
+            return
+        self._connecting[address] = connecting + missing
+        for i in range(missing):
+            d = self._connect(address)
+            d.addBoth(self._connected, address)
+            d.addErrback(write_failure)
+
+
+    def _connected(self, result, address):
+        self._connecting[address] -= 1
+        if not self._connecting[address]:
+            del self._connecting[address]
+        if isinstance(result, Failure):
+            # Don't try again until the address is used again.
+            Message.log(
+                event_type=u"grid-router:spare-failed",
+                address=address,
+                reason=result.getErrorMessage(),
+            )
+            self._forget(address)
+            return None
+        protocol = result
+        protocol.idle_lost = lambda protocol: self._lost(address, protocol)
+        expiry = self._reactor.callLater(
+            self.spare_lifetime, self._expire, address, protocol,
+        )
+        self._spares.setdefault(address, []).append((protocol, expiry))
+        return None
+
+
+    def _remove(self, address, protocol):
+        spares = self._spares.get(address, [])
+        for i, (spare, expiry) in enumerate(spares):
+            if spare is protocol:
+                del spares[i]
+                return expiry
+        return None
+
+
+    def _lost(self, address, protocol):
+        """
+        An idle connection was closed by the other side.
+        """
+        expiry = self._remove(address, protocol)
+        if expiry is not None:
+            expiry.cancel()
+        self._forget(address)
+
+
+    def _expire(self, address, protocol):
+        """
+        An idle connection has been open for as long as it may be.  Close it
+        and replace it if the address is still in use.
+        """
+        self._remove(address, protocol)
+        protocol.idle_lost = None
+        protocol.transport.loseConnection()
+        if self._hot(address):
+            self._replenish(address)
+        else:
+            self._forget(address)
+
+
+    def _forget(self, address):
+        """
+        Discard the bookkeeping for an address with no idle connections.
+        """
+        if not self._spares.get(address) and address not in self._connecting:
+            self._spares.pop(address, None)
+            if not self._hot(address):
+                self._last_used.pop(address, None)
+
+
+
+class _GridRouterService(MultiService):
+    """
+    ``_GridRouterService`` accepts connections on many ports and proxies them
+    to the pod responsible for them.  Responsibility is determined by the
+    local port number.
+
+    :ivar _reactor: A Twisted reactor which can be used to establish
+        connections for the proxy.
+
+    :ivar _route_mapping: A mapping from tub identifiers to destination
+        information.  The destination information is a two-tuple of an IP
+        address and a port number.  It gives an address where a Foolscap node
+        capable of servicing the tub identifier can be reached.
+
+    :ivar bool _connect_early: Whether to begin connecting to the destination
+        as soon as the TubID is known.
+
+    :ivar _UpstreamPool _upstreams: The source of connections to
+        destinations.
+
+    :ivar int _generation: A number which increases each time the routes
+        change.  It is carried over from a loaded snapshot.
+
+    :ivar _TenantAccounting _tenants: Usage of the router by each
+        subscription.
+
+    :ivar float tenant_flush_interval: The number of seconds between updates
+        of the per-subscription metrics.
+    """
+    name = u"grid-router"
+
+    _stale_routes = Gauge(
+        u"grid_router_stale_routes",
+        u"Routes loaded from a snapshot which grid-router is still using "
+        u"because it has not yet loaded routes from Kubernetes.",
+    )
+
+    tenant_flush_interval = 10.0
+
+    def __init__(self, reactor, connect_early=False, upstream_spares=0, tenant_metrics_limit=20):
+        MultiService.__init__(self)
+        self._reactor = reactor
+        self._connect_early = connect_early
+        self._upstreams = _UpstreamPool(reactor, upstream_spares)
+        self._route_mapping = freeze({})
+        self._route_index = _RouteIndex()
+        self._route_observers = [self._route_index]
+        self._generation = 0
+        self._tenants = _TenantAccounting(tenant_metrics_limit, reactor)
+
+        flush = TimerService(self.tenant_flush_interval, self._tenants.flush)
+        flush.clock = reactor
+        flush.setServiceParent(self)
+
+
+    def factory(self):
+        """
+        :return: A protocol factory for a Foolscap proxy server.
+        """
+        f = Factory.forProtocol(_FoolscapProxy)
+        f.reactor = self._reactor
+        f.route_mapping = self.route_mapping
+        f.route_lookup = self._route_index.lookup
+        f.connect_early = self._connect_early
+        f.upstreams = self._upstreams
+        f.tenants = self._tenants
+        return f
+
+
+    def route_mapping(self):
+        """
+        Retrieve the mapping describing how to route connections to pods.
+
+        :return PMap: A mapping from a tub identifier to a (host, port) pair.
+        """
+        return self._route_mapping
+
+
+    def watch_routes(self, observer):
+        """
+        Start keeping ``observer`` up to date with the routes.
+
+        :param observer: An object with ``replace``, ``add``, and ``discard``
+            methods like those of ``_RouteIndex``.  Its ``replace`` method is
+            called with the current routes right away.
+        """
+        observer.replace(self._index_routes())
+        self._route_observers.append(observer)
+
+
+    def unwatch_routes(self, observer):
+        """
+        Stop keeping ``observer`` up to date with the routes.
+        """
+        self._route_observers.remove(observer)
+
+
+    def snapshot(self):
+        """
+        :return Snapshot: The current routes.
+        """
+        return Snapshot(
+            generation=self._generation,
+            written=self._reactor.seconds(),
+            routes=self._addresses(),
+        )
+
+
+    def load_snapshot(self, snapshot):
+        """
+        Use the routes from a snapshot until a complete set of routes is
+        loaded with ``set_pods``.  The pods in the route mapping for these
+        routes are ``None``.
+
+        :param Snapshot snapshot: The routes to use.
+        """
+        Message.log(
+            event_type=u"router-update:load-snapshot",
+            generation=snapshot.generation,
+            age=self._reactor.seconds() - snapshot.written,
+            count=len(snapshot.routes),
+        )
+        self.set_route_mapping({
+            tub_id: (None, address)
+            for (tub_id, address)
+            in snapshot.routes
+        })
+        self._generation = snapshot.generation
+        self._stale_routes.set(len(self._route_mapping))
+
+
+    def _addresses(self):
+        return list(
+            (tub_id, address)
+            for (tub_id, (_, address))
+            in self._route_mapping.iteritems()
+        )
+
+
+    def _index_routes(self):
+        return list(
+            (tub_id, _index_route(pod, address))
+            for (tub_id, (pod, address))
+            in self._route_mapping.iteritems()
+        )
+
+
+    def set_pods(self, pods):
+        """
+        Update grid routing rules based on new information about what pods exist.
+
+        :param list[v1.Pod] pods: The pods which were observed to exist very
+            recently.
+        """
+        self.set_route_mapping(self._pods_to_routes(self._route_mapping, pods))
+
+
+    def apply_pod_event(self, event_type, pod):
+        """
+        Update grid routing rules based on a change to a single pod.
+
+        :param unicode event_type: ``u"ADDED"``, ``u"MODIFIED"``, or
+            ``u"DELETED"``.
+
+        :param v1.Pod pod: The pod which changed.
+        """
+        with start_action(
+            action_type=u"router-update:pod-event",
+            event_type=event_type,
+            pod=pod.metadata.name,
+        ):
+            routes = self._route_mapping
+            # Whatever the change was, routes for tubs this pod used to serve
+            # are no longer necessarily right.  The tub identifiers a pod
+            # serves never change but check by pod name anyway so a
+            # misbehaving pod can't take over another pod's routes.
+            for tub_id, _ in _pod_routes(pod):
+                existing = routes.get(tub_id)
+                if existing is not None and _pod_name(existing[0]) in (None, pod.metadata.name):
+                    routes = routes.discard(tub_id)
+                    for observer in self._route_observers:
+                        observer.discard(tub_id)
+                    if event_type == u"DELETED":
+                        Message.log(event_type=u"router-update:remove", pod=pod.metadata.name)
+
+            if event_type != u"DELETED":
+                for tub_id, route in _pod_routes(pod):
+                    if tub_id not in self._route_mapping:
+                        Message.log(event_type=u"router-update:add", pod=pod.metadata.name)
+                    routes = routes.set(tub_id, route)
+                    for observer in self._route_observers:
+                        observer.add(tub_id, _index_route(pod, route[1]))
+
+            self._route_mapping = routes
+            self._generation += 1
+
+
+    def set_route_mapping(self, route_mapping):
+        """
+        Record a new route mapping.
+
+        :param route_mapping: A new value for the private ``_route_mapping``
+            attribute.
+        """
+        self._route_mapping = freeze(route_mapping)
+        self._generation += 1
+        self._stale_routes.set(0)
+        routes = self._index_routes()
+        for observer in self._route_observers:
+            observer.replace(routes)
+
+
+    def _pods_to_routes(self, old, pods):
+        """
+        Extract the addressing information from some pods.
+
+        :param old: The old routing information.  Used to log route changes.
+
+        :param list[v1.Pod] pods: Some pods from which routing information can
+            be extracted.
+
+        :return: A mapping of the new routing information deriving solely from
+            ``pods``.
+        """
+        with start_action(action_type=u"router-update:set-pods", count=len(pods)):
+            new = pmap([
+                route
+                for pod in pods
+                for route in _pod_routes(pod)
             ])
 
             adding = pset(new.keys()) - pset(old.keys())
@@ -443,12 +1858,79 @@ class _GridRouterService(MultiService):
             for tub_id in adding:
                 Message.log(event_type=u"router-update:add", pod=new[tub_id][0].metadata.name)
             for tub_id in removing:
-                Message.log(event_type=u"router-update:remove", pod=old[tub_id][0].metadata.name)
+                Message.log(event_type=u"router-update:remove", pod=_pod_name(old[tub_id][0]))
 
             return new
 
 
 
+class _RouteSnapshotService(TimerService):
+    """
+    ``_RouteSnapshotService`` loads the routes of a ``_GridRouterService``
+    from a snapshot file when it starts.  It saves them back to that file
+    every ``interval`` seconds if they have changed, and again when it
+    stops.
+
+    :ivar float maximum_age: The age in seconds beyond which a snapshot is
+        considered too out of date to use.
+
+    :ivar _saved_generation: The generation of the routes most recently
+        loaded or saved, or ``None``.
+    """
+    maximum_age = 24 * 60 * 60.0
+
+    def __init__(self, reactor, router, path, interval=30.0):
+        TimerService.__init__(
+            self,
+            interval,
+            divert_errors_to_log(self._save, u"router-snapshot"),
+        )
+        # This attribute controls the the reactor used by TimerService to set
+        # up the LoopingCall.
+        self.clock = reactor
+        self._router = router
+        self._path = path
+        self._saved_generation = None
+
+
+    def startService(self):
+        divert_errors_to_log(self._load, u"router-snapshot")()
+        TimerService.startService(self)
+
+
+    def stopService(self):
+        d = TimerService.stopService(self)
+        divert_errors_to_log(self._save, u"router-snapshot")()
+        return d
+
+
+    def _load(self):
+        try:
+            data = self._path.getContent()
+        except IOError as e:
+            if e.errno != ENOENT:
+                raise
+            return
+        snapshot = decode_snapshot(data)
+        if self.clock.seconds() - snapshot.written > self.maximum_age:
+            Message.log(
+                event_type=u"router-snapshot:too-old",
+                written=snapshot.written,
+            )
+            return
+        self._router.load_snapshot(snapshot)
+        self._saved_generation = snapshot.generation
+
+
+    def _save(self):
+        snapshot = self._router.snapshot()
+        if snapshot.generation == self._saved_generation:
+            return
+        self._path.setContent(encode_snapshot(snapshot))
+        self._saved_generation = snapshot.generation
+
+
+
 class _RouterUpdateService(TimerService):
     """
     ``_RouterUpdateService`` reports valid Pods to a ``_GridRouterService``.
@@ -477,4 +1959,345 @@ class _RouterUpdateService(TimerService):
                 get_customer_grid_pods(KubeClient(k8s=k8s), namespace)
             )
             d.addCallback(self._router.set_pods)
+            d.addCallback(lambda ignored: _route_sync_time.set(self.clock.seconds()))
             return d.addActionFinish()
+
+
+
+def _router_informer(reactor, interval, kube, namespace, router):
+    """
+    Create an ``Informer`` which keeps a ``_GridRouterService`` up to date by
+    listing Pods once and then applying changes reported by a Kubernetes
+    watch.
+    """
+    def synced():
+        _route_sync_time.set(reactor.seconds())
+    return Informer(
+        reactor, interval, kube, kube.k8s.model.v1.Pod,
+        namespace, CUSTOMER_METADATA_LABELS,
+        router.apply_pod_event,
+        replaced=router.set_pods,
+        current=synced,
+    )
+
+
+
+# The port on which customer Foolscap connections are accepted.
+_PROXY_PORT = 10000
+
+# Python 2 doesn't expose this constant.  This is its value on Linux, which is
+# the only platform the grid router is deployed on.
+_SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+
+
+@implementer(IStreamServerEndpoint)
+@attr.s(frozen=True)
+class _ReusePortEndpoint(object):
+    """
+    A TCP server endpoint which sets ``SO_REUSEPORT`` on its listening socket
+    so that several processes can listen on the same port at once.  The
+    kernel distributes new connections between them.
+    """
+    reactor = attr.ib()
+    port = attr.ib()
+    interface = attr.ib(default="")
+    backlog = attr.ib(default=50)
+
+    def listen(self, factory):
+        return execute(self._listen, factory)
+
+
+    def _listen(self, factory):
+        skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            skt.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+            skt.bind((self.interface, self.port))
+            skt.listen(self.backlog)
+            skt.setblocking(False)
+            # The reactor duplicates the descriptor so this socket object can
+            # be closed either way.
+            return self.reactor.adoptStreamPort(skt.fileno(), socket.AF_INET, factory)
+        finally:
+            skt.close()
+
+
+
+@attr.s
+class _RouteWriter(object):
+    """
+    ``_RouteWriter`` serializes route changes to a transport so they can be
+    applied to a ``_RouteIndex`` in another process by ``_RouteReader``.
+
+    Each change is one JSON-encoded netstring.  It has the same interface as
+    ``_RouteIndex`` so it can be given to
+    ``_GridRouterService.watch_routes``.
+
+    :ivar int shares: The number of worker processes between which each
+        subscription's limits are divided.  Each worker enforces the limits
+        it is given on its own connections so, with the limits divided, a
+        subscription gets roughly its whole limit across all of them.
+    """
+    transport = attr.ib()
+    shares = attr.ib(default=1)
+
+    def _send(self, change):
+        data = dumps(change)
+        self.transport.write(b"%d:%s," % (len(data), data))
+
+
+    def _share(self, limit):
+        if limit is None:
+            return None
+        # Round up so no worker is left with a limit of zero.
+        return -(-limit // self.shares)
+
+
+    def _encode(self, tub_id, route):
+        (host, port), tenant, bandwidth, connections = route
+        return (
+            tub_id, host, port, tenant,
+            self._share(bandwidth), self._share(connections),
+        )
+
+
+    def replace(self, routes):
+        self._send({
+            u"replace": list(
+                self._encode(tub_id, route)
+                for (tub_id, route)
+                in routes
+            ),
+        })
+
+
+    def add(self, tub_id, route):
+        self._send({u"add": self._encode(tub_id, route)})
+
+
+    def discard(self, tub_id):
+        self._send({u"discard": tub_id})
+
+
+
+class _RouteReader(NetstringReceiver):
+    """
+    ``_RouteReader`` applies the route changes written by ``_RouteWriter`` to
+    a ``_RouteIndex``.
+
+    :ivar index: The ``_RouteIndex`` to update.
+
+    :ivar lost: A no-argument callable to call when the connection is lost.
+    """
+    # A complete route table is sent as one string.
+    MAX_LENGTH = 2 ** 30
+
+    def __init__(self, index, lost):
+        self.index = index
+        self.lost = lost
+
+
+    def stringReceived(self, string):
+        change = loads(string)
+        if u"replace" in change:
+            self.index.replace(
+                (tub_id, ((host, port), tenant, bandwidth, connections))
+                for (tub_id, host, port, tenant, bandwidth, connections)
+                in change[u"replace"]
+            )
+        elif u"add" in change:
+            tub_id, host, port, tenant, bandwidth, connections = change[u"add"]
+            self.index.add(tub_id, ((host, port), tenant, bandwidth, connections))
+        elif u"discard" in change:
+            self.index.discard(change[u"discard"])
+
+
+    def connectionLost(self, reason):
+        self.lost()
+
+
+
+class _RouteReaderService(Service):
+    """
+    ``_RouteReaderService`` reads route changes from stdin into a
+    ``_RouteIndex`` and stops the reactor if stdin is closed.
+    """
+    def __init__(self, reactor, index):
+        self._reactor = reactor
+        self._index = index
+
+
+    def startService(self):
+        Service.startService(self)
+        self._stdio = StandardIO(
+            _RouteReader(self._index, self._lost),
+            reactor=self._reactor,
+        )
+
+
+    def _lost(self):
+        if self.running:
+            Message.log(event_type=u"router-worker:supervisor-lost")
+            self._reactor.stop()
+
+
+
+class _WorkerProcess(ProcessProtocol):
+    """
+    ``_WorkerProcess`` feeds routes to one grid router worker process.
+
+    :ivar Deferred ended: Fires when the process has exited.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+        self.ended = Deferred()
+
+
+    def connectionMade(self):
+        self.pid = self.transport.pid
+        self.routes = _RouteWriter(self.transport, self._pool.count)
+        self._pool.worker_started(self)
+
+
+    def processEnded(self, reason):
+        self._pool.worker_ended(self, reason)
+        self.ended.callback(None)
+
+
+
+class _WorkerPoolService(Service):
+    """
+    ``_WorkerPoolService`` runs a fixed number of grid router worker processes
+    and keeps each of them up to date with the routes of a
+    ``_GridRouterService``.  Workers which exit are replaced.
+
+    Workers record their metrics beneath a directory shared by all of them
+    so that ``_WorkerMetrics`` can aggregate them.  The directory is removed
+    once the service has stopped and all of the workers have exited.
+
+    :ivar int count: The number of worker processes.  Each subscription's
+        limits are divided evenly between them.
+
+    :ivar float respawn_delay: The number of seconds to wait before replacing
+        a worker which exited.
+    """
+    respawn_delay = 1.0
+
+    def __init__(self, reactor, router, count, arguments, metrics_directory):
+        self._reactor = reactor
+        self._router = router
+        self.count = count
+        self._arguments = arguments
+        self._metrics_directory = metrics_directory
+        self._workers = set()
+        self._respawns = set()
+
+
+    def startService(self):
+        Service.startService(self)
+        for i in range(self.count):
+            self._spawn()
+
+
+    def stopService(self):
+        Service.stopService(self)
+        for delayed in self._respawns:
+            delayed.cancel()
+        self._respawns.clear()
+        workers = list(self._workers)
+        for worker in workers:
+            try:
+                worker.transport.signalProcess("TERM")
+            except ProcessExitedAlready:
+                pass
+        d = DeferredList(list(worker.ended for worker in workers))
+        d.addCallback(lambda ignored: FilePath(self._metrics_directory).remove())
+        return d
+
+
+    def _spawn(self):
+        argv = [
+            sys.executable, b"-m", b"twisted",
+            b"s4-grid-router", b"--worker",
+        ] + self._arguments
+        env = dict(environ, prometheus_multiproc_dir=self._metrics_directory)
+        self._reactor.spawnProcess(
+            _WorkerProcess(self), sys.executable, argv, env,
+            childFDs={0: "w", 1: 1, 2: 2},
+        )
+
+
+    def _respawn(self, delayed):
+        self._respawns.discard(delayed)
+        self._spawn()
+
+
+    def worker_started(self, worker):
+        Message.log(event_type=u"router-worker:started", pid=worker.pid)
+        self._workers.add(worker)
+        self._router.watch_routes(worker.routes)
+
+
+    def worker_ended(self, worker, reason):
+        Message.log(
+            event_type=u"router-worker:ended",
+            pid=worker.pid,
+            reason=reason.getErrorMessage(),
+        )
+        self._workers.discard(worker)
+        self._router.unwatch_routes(worker.routes)
+        mark_process_dead(worker.pid, self._metrics_directory)
+        if self.running:
+            delayed = self._reactor.callLater(self.respawn_delay, lambda: self._respawn(delayed))
+            self._respawns.add(delayed)
+
+
+
+@attr.s(frozen=True)
+class _WorkerMetrics(object):
+    """
+    ``_WorkerMetrics`` is a Prometheus registry which combines the metrics of
+    this process with those recorded by grid router worker processes.
+
+    :ivar metrics_directory: The directory beneath which worker processes
+        record their metrics.
+
+    :ivar worker_metrics: The names of the metrics to take from the worker
+        processes.  All other metrics are taken from this process.
+    """
+    metrics_directory = attr.ib()
+    worker_metrics = attr.ib()
+
+    def collect(self):
+        for metric in REGISTRY.collect():
+            if metric.name not in self.worker_metrics:
+                yield metric
+        for metric in MultiProcessCollector(None, self.metrics_directory).collect():
+            if metric.name in self.worker_metrics:
+                yield metric
+
+
+
+# The metrics which only grid router worker processes (those which accept
+# connections) record values for.
+_WORKER_METRICS = frozenset(
+    metric.name
+    for collector in [
+        _FoolscapProxy._rejected_handshakes,
+        _FoolscapProxy._slow_handshakes,
+        _Proxy._proxied_connections,
+        _Proxy._proxied_bytes,
+        _Proxy._connection_bytes,
+        _Proxy._backpressure_stalls,
+        _Proxy._throttles,
+        _Proxy._connect_latency,
+        _Proxy._first_byte_latency,
+        _UpstreamPool._connections,
+        _TenantAccounting._bytes,
+        _TenantAccounting._connects,
+        _TenantAccounting._connections,
+        _RouteIndex._unknown_requests,
+    ]
+    for metric in collector.collect()
+)
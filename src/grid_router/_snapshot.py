@@ -0,0 +1,118 @@
+# Copyright Least Authority Enterprises.
+# See LICENSE for details.
+
+"""
+A compact binary serialization of the grid router's route table.
+
+The grid router saves its routes in this format so that after a restart it
+can begin routing connections right away, before it has heard from
+Kubernetes.
+
+A snapshot is a fixed-size header followed by one record per route::
+
+    header: magic (8 bytes), generation (uint64), written (double),
+            route count (uint32)
+    record: tub id length (uint8), tub id (ascii), IPv4 address (4 bytes),
+            port number (uint16)
+
+All integers are in network byte order.
+"""
+
+from socket import inet_aton, inet_ntoa, error as socket_error
+from struct import Struct, error as struct_error
+
+import attr
+
+_MAGIC = b"s4route1"
+_HEADER = Struct("!8sQdI")
+_TUB_LENGTH = Struct("!B")
+_ADDRESS = Struct("!4sH")
+
+
+
+class SnapshotError(ValueError):
+    """
+    A snapshot could not be decoded.
+    """
+
+
+
+@attr.s(frozen=True)
+class Snapshot(object):
+    """
+    :ivar int generation: The generation of the route table when it was
+        saved.  This increases with every change to the route table.
+
+    :ivar float written: The POSIX timestamp at which the snapshot was taken.
+
+    :ivar list routes: Two-tuples of a tub identifier and a ``(host, port)``
+        address.
+    """
+    generation = attr.ib()
+    written = attr.ib()
+    routes = attr.ib()
+
+
+
+def encode_snapshot(snapshot):
+    """
+    Serialize a snapshot.
+
+    Routes without an IPv4 address (for example, those for pods which have
+    not been assigned an address yet) are left out.
+
+    :param Snapshot snapshot: The snapshot to serialize.
+
+    :return bytes: The serialized snapshot.
+    """
+    records = []
+    for tub_id, (host, port) in snapshot.routes:
+        if not host:
+            continue
+        try:
+            packed_host = inet_aton(host)
+        except socket_error:
+            continue
+        tub_id = tub_id.encode("ascii")
+        records.append(_TUB_LENGTH.pack(len(tub_id)))
+        records.append(tub_id)
+        records.append(_ADDRESS.pack(packed_host, port))
+    header = _HEADER.pack(
+        _MAGIC, snapshot.generation, snapshot.written, len(records) // 3,
+    )
+    return header + b"".join(records)
+
+
+
+def decode_snapshot(data):
+    """
+    Deserialize a snapshot.
+
+    :param bytes data: A serialized snapshot as returned by
+        ``encode_snapshot``.
+
+    :raise SnapshotError: If ``data`` is not a complete snapshot.
+
+    :return Snapshot: The deserialized snapshot.
+    """
+    try:
+        magic, generation, written, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise SnapshotError("Unrecognized snapshot format {!r}".format(magic))
+
+        routes = []
+        offset = _HEADER.size
+        for i in range(count):
+            (tub_length,) = _TUB_LENGTH.unpack_from(data, offset)
+            offset += _TUB_LENGTH.size
+            tub_id = data[offset:offset + tub_length].decode("ascii")
+            offset += tub_length
+            packed_host, port = _ADDRESS.unpack_from(data, offset)
+            offset += _ADDRESS.size
+            routes.append((tub_id, (inet_ntoa(packed_host).decode("ascii"), port)))
+    except (struct_error, UnicodeDecodeError) as e:
+        raise SnapshotError("Malformed snapshot: {}".format(e))
+
+    if offset != len(data):
+        raise SnapshotError("{} bytes of trailing garbage".format(len(data) - offset))
+    return Snapshot(generation=generation, written=written, routes=routes)
@@ -5,11 +5,17 @@
 Tests for ``grid_router``.
 """
 
-from socket import AF_INET, socket
+from socket import AF_INET, SOL_SOCKET, socket
+
+import attr
 
 from testtools.matchers import (
     AfterPreprocessing,
     Equals,
+    HasLength,
+    IsInstance,
+    Is,
+    Contains,
 )
 
 from hypothesis import given, assume
@@ -17,10 +23,14 @@ from hypothesis.strategies import choices
 from hypothesis.stateful import RuleBasedStateMachine, rule, run_state_machine_as_test
 
 from twisted.python.log import msg
+from twisted.python.filepath import FilePath
 from twisted.trial.unittest import TestCase as AsyncTestCase
 from twisted.internet.address import IPv4Address
 from twisted.internet.interfaces import IReactorTCP, IReactorTime
-from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone, ProcessTerminated
+from twisted.internet.protocol import Protocol
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet.endpoints import AdoptedStreamServerEndpoint, TCP4ServerEndpoint
 from twisted.test.proto_helpers import StringTransport, MemoryReactor
 from twisted.python.components import proxyForInterface
@@ -28,21 +38,35 @@ from twisted.internet.task import Clock, deferLater
 
 from pyrsistent import freeze
 
+from prometheus_client import REGISTRY
+
 from foolscap.pb import Tub
 from foolscap.referenceable import Referenceable
 
-from lae_util.testtools import TestCase
+from eliot.testing import capture_logging
+
+from lae_util.testtools import TestCase, CustomException
 from lae_automation.test.strategies import (
     ipv4_addresses, port_numbers, node_pems,
     deployment_configuration, subscription_details,
 )
 from lae_automation.containers import create_deployment
-from lae_automation.model import NullDeploymentConfiguration, SubscriptionDetails
+from lae_automation.model import (
+    NullDeploymentConfiguration, SubscriptionDetails, RouterLimits,
+)
 
 from lae_util.k8s import derive_pod
 
+from lae_automation.kubeclient import WatchEvent, WatchExpired, select
+
 from .. import Options, makeService
-from .._router import _GridRouterService
+from .._router import (
+    _GridRouterService, _router_informer, _Proxy, _RouteIndex,
+    _RouteWriter, _RouteReader, _ReusePortEndpoint, _SO_REUSEPORT,
+    _UpstreamPool, _RouteSnapshotService, _TenantStats, _TenantAccounting,
+    _TokenBucket, _FoolscapProxy, _WorkerPoolService, _WORKER_METRICS,
+)
+from .._snapshot import Snapshot, encode_snapshot, decode_snapshot
 
 from txkube import memory_kubernetes, v1_5_model as model
 
@@ -233,6 +257,10 @@ class GridRouterTests(TestCase):
         deployment = create_deployment(deploy_config, details, model)
         pod = derive_pod(model, deployment, ip)
         service.set_pods([pod])
+        self.expectThat(
+            service._route_index.lookup(details.storage_tub_id.encode("ascii")),
+            Equals(((ip, details.storage_port_number), details.subscription_id, None, None)),
+        )
         mapping = service.route_mapping()
         self.assertThat(
             mapping,
@@ -249,6 +277,40 @@ class GridRouterTests(TestCase):
             ),
         )
 
+    @given(
+        ip=ipv4_addresses(),
+        deploy_config=deployment_configuration(),
+        details=subscription_details()
+    )
+    def test_apply_pod_event(self, ip, deploy_config, details):
+        """
+        ``_GridRouterService.apply_pod_event`` adds routes for pods which are
+        added and removes routes for pods which are deleted.
+        """
+        service = _GridRouterService(object())
+        deployment = create_deployment(deploy_config, details, model)
+        pod = derive_pod(model, deployment, ip)
+
+        service.apply_pod_event(u"ADDED", pod)
+        self.expectThat(
+            service.route_mapping(),
+            AfterPreprocessing(
+                lambda m: {
+                    tub_id: address
+                    for (tub_id, (pod, address))
+                    in m.iteritems()
+                },
+                Equals({
+                    details.introducer_tub_id: (ip, details.introducer_port_number),
+                    details.storage_tub_id: (ip, details.storage_port_number),
+                }),
+            ),
+        )
+
+        service.apply_pod_event(u"DELETED", pod)
+        self.expectThat(service.route_mapping(), Equals({}))
+
+
     @given(
         ip=ipv4_addresses(),
         deploy_config=deployment_configuration(),
@@ -280,6 +342,949 @@ class GridRouterTests(TestCase):
 
 
 
+class FoolscapNegotiationTests(TestCase):
+    """
+    Tests for the negotiation header handling of ``_FoolscapProxy``.
+    """
+    def setUp(self):
+        super(FoolscapNegotiationTests, self).setUp()
+        self.network = MemoryReactor()
+        self.clock = Clock()
+        self.router = _GridRouterService(FakeReactor(self.network, self.clock))
+        self.router.set_route_mapping({
+            u"abc": (None, (u"10.0.0.1", 10000)),
+        })
+        self.protocol = self.router.factory().buildProtocol(None)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+
+    def test_fragmented(self):
+        """
+        A negotiation header which arrives one byte at a time is proxied once
+        it is complete.
+        """
+        header = (
+            b"GET /id/abc HTTP/1.1\r\n"
+            b"Host: example.invalid\r\n"
+            b"\r\n"
+        )
+        for i in range(len(header)):
+            self.expectThat(self.network.connectors, HasLength(0))
+            self.protocol.dataReceived(header[i:i + 1])
+        [connector] = self.network.connectors
+        self.expectThat(
+            connector.getDestination(),
+            Equals(IPv4Address("TCP", u"10.0.0.1", 10000)),
+        )
+        # The handshake timeout no longer applies.
+        self.expectThat(self.clock.getDelayedCalls(), HasLength(0))
+
+
+    def test_too_large(self):
+        """
+        A connection which sends more than ``maximum_header_size`` bytes
+        without completing the negotiation header is dropped.
+        """
+        self.protocol.dataReceived(b"GET /id/abc HTTP/1.1\r\n")
+        self.protocol.dataReceived(b"x" * self.protocol.maximum_header_size)
+        self.expectThat(self.transport.disconnecting, Equals(True))
+        self.expectThat(self.clock.getDelayedCalls(), HasLength(0))
+
+
+    def test_timeout(self):
+        """
+        A connection which does not complete the negotiation header within
+        ``handshake_timeout`` seconds is dropped.
+        """
+        self.protocol.dataReceived(b"GET /id/abc HTTP/1.1\r\n")
+        self.clock.advance(self.protocol.handshake_timeout)
+        self.expectThat(self.transport.disconnecting, Equals(True))
+
+
+    def test_unknown_tub(self):
+        """
+        A connection which asks for an unknown TubID is dropped.
+        """
+        self.protocol.dataReceived(b"GET /id/def HTTP/1.1\r\n\r\n")
+        self.expectThat(self.transport.disconnecting, Equals(True))
+        self.expectThat(self.network.connectors, HasLength(0))
+
+
+    def test_malformed(self):
+        """
+        A connection which sends something other than a Foolscap negotiation
+        header is dropped.
+        """
+        self.protocol.dataReceived(b"POST /something HTTP/1.1\r\n\r\n")
+        self.expectThat(self.transport.disconnecting, Equals(True))
+
+
+    def connect_early(self):
+        self.router._connect_early = True
+        self.protocol = self.router.factory().buildProtocol(None)
+        self.protocol.makeConnection(self.transport)
+
+
+    def test_connect_early(self):
+        """
+        With ``connect_early``, the connection to the destination is begun as
+        soon as the line holding the TubID is received and is used once the
+        rest of the negotiation header is received.
+        """
+        self.connect_early()
+        self.protocol.dataReceived(b"GET /id/abc HTTP/1.1\r\n")
+        self.expectThat(self.network.connectors, HasLength(1))
+        self.protocol.dataReceived(b"Host: example.invalid\r\n\r\n")
+        self.expectThat(self.network.connectors, HasLength(1))
+        self.expectThat(self.network.connectors[0].stoppedConnecting, Equals(False))
+        self.expectThat(self.transport.disconnecting, Equals(False))
+
+
+    def test_connect_early_lost(self):
+        """
+        With ``connect_early``, a connection begun early is abandoned if the
+        client goes away before sending the rest of the negotiation header.
+        """
+        self.connect_early()
+        self.protocol.dataReceived(b"GET /id/abc HTTP/1.1\r\n")
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        [connector] = self.network.connectors
+        self.expectThat(connector.stoppedConnecting, Equals(True))
+
+
+    def test_connection_limit(self):
+        """
+        A connection is dropped if the destination's subscription already has
+        as many connections being proxied or established as the
+        ``leastauthority.com/router-connection-limit`` annotation on its pod
+        allows.
+        """
+        pod = model.v1.Pod(metadata=dict(
+            name=u"limited",
+            annotations={
+                u"subscription": u"sub",
+                u"leastauthority.com/router-connection-limit": u"1",
+            },
+        ))
+        self.router.set_route_mapping({
+            u"abc": (pod, (u"10.0.0.1", 10000)),
+        })
+        header = b"GET /id/abc HTTP/1.1\r\n\r\n"
+        factory = self.router.factory()
+
+        def connect():
+            protocol = factory.buildProtocol(None)
+            protocol.makeConnection(StringTransport())
+            protocol.dataReceived(header)
+            return protocol
+
+        connect()
+        self.expectThat(self.network.connectors, HasLength(1))
+        self.expectThat(connect().transport.disconnecting, Equals(True))
+        self.expectThat(self.network.connectors, HasLength(1))
+
+        # The connection still counts once it is established.
+        upstream = self.network.tcpClients[0][2].buildProtocol(None)
+        upstream.makeConnection(StringTransport())
+        self.expectThat(connect().transport.disconnecting, Equals(True))
+
+        # Once it is closed, another is allowed.
+        upstream.connectionLost(Failure(ConnectionDone()))
+        self.expectThat(connect().transport.disconnecting, Equals(False))
+        self.expectThat(self.network.connectors, HasLength(2))
+
+
+    def test_connect_early_unknown_tub(self):
+        """
+        With ``connect_early``, a connection which asks for an unknown TubID
+        is dropped once the negotiation header is complete.
+        """
+        self.connect_early()
+        self.protocol.dataReceived(b"GET /id/def HTTP/1.1\r\n")
+        self.expectThat(self.transport.disconnecting, Equals(False))
+        self.protocol.dataReceived(b"\r\n")
+        self.expectThat(self.transport.disconnecting, Equals(True))
+        self.expectThat(self.network.connectors, HasLength(0))
+
+
+
+class RouteIndexTests(TestCase):
+    """
+    Tests for ``_RouteIndex``.
+    """
+    def test_lookup(self):
+        """
+        ``_RouteIndex.lookup`` returns the address for a known tub identifier
+        and ``None`` for an unknown one.
+        """
+        index = _RouteIndex()
+        index.replace([(u"abc", ((u"10.0.0.1", 10000), u"sub", None, None))])
+        self.expectThat(index.lookup(b"abc"), Equals(((u"10.0.0.1", 10000), u"sub", None, None)))
+        self.expectThat(index.lookup(b"def"), Equals(None))
+
+
+    @capture_logging(None)
+    def test_unknown_logged_once(self, logger):
+        """
+        A tub identifier with no route is logged the first time it is
+        requested.  Later requests for it are counted but not logged.
+        """
+        def requests():
+            return REGISTRY.get_sample_value(
+                u"grid_router_unknown_tub_requests_total",
+            )
+        before = requests()
+        index = _RouteIndex()
+        for tub_id in [b"a", b"a", b"b", b"a"]:
+            self.expectThat(index.lookup(tub_id), Equals(None))
+        self.expectThat(
+            list(
+                message[u"tub_id"]
+                for message
+                in logger.messages
+                if message.get(u"event_type") == u"router:unknown-tub"
+            ),
+            Equals([b"a", b"b"]),
+        )
+        self.expectThat(requests() - before, Equals(4))
+
+
+    def test_negative_cache_bounded(self):
+        """
+        The set of logged unknown tub identifiers holds at most the
+        configured number of the most recently requested ones.
+        """
+        index = _RouteIndex(unknown_limit=2)
+        for tub_id in [b"a", b"b", b"a", b"c"]:
+            index.lookup(tub_id)
+        self.expectThat(list(index._unknown), Equals([b"a", b"c"]))
+
+
+    def test_add_after_unknown(self):
+        """
+        A tub identifier which was previously unknown can be found after a
+        route for it is added.
+        """
+        index = _RouteIndex()
+        self.expectThat(index.lookup(b"abc"), Equals(None))
+        index.add(u"abc", ((u"10.0.0.1", 10000), u"sub", None, None))
+        self.expectThat(index.lookup(b"abc"), Equals(((u"10.0.0.1", 10000), u"sub", None, None)))
+        index.discard(u"abc")
+        self.expectThat(index.lookup(b"abc"), Equals(None))
+
+
+
+class ProxyTests(TestCase):
+    """
+    Tests for ``_Proxy``.
+    """
+    def setUp(self):
+        super(ProxyTests, self).setUp()
+        self.upstream = Protocol()
+        self.upstream.makeConnection(StringTransport())
+        self.downstream = _Proxy()
+        self.downstream.makeConnection(StringTransport())
+        self.done = self.downstream.take_over(self.upstream, b"header")
+
+
+    def test_proxies(self):
+        """
+        After the header, data received on either connection is written to the
+        other.
+        """
+        self.upstream.dataReceived(b"hello")
+        self.downstream.dataReceived(b"goodbye")
+        self.expectThat(self.downstream.transport.value(), Equals(b"headerhello"))
+        self.expectThat(self.upstream.transport.value(), Equals(b"goodbye"))
+
+
+    def test_backpressure(self):
+        """
+        Each transport is registered as the streaming producer of the other so
+        a full write buffer on one side pauses reading on the other side.
+        """
+        for consumer, producer in [
+                (self.downstream.transport, self.upstream.transport),
+                (self.upstream.transport, self.downstream.transport),
+        ]:
+            self.expectThat(consumer.streaming, Equals(True))
+            consumer.producer.pauseProducing()
+            self.expectThat(producer.producerState, Equals(u"paused"))
+            consumer.producer.resumeProducing()
+            self.expectThat(producer.producerState, Equals(u"producing"))
+
+
+    def test_first_byte(self):
+        """
+        The callable given to ``take_over`` is called when the first data is
+        received from the downstream connection, and only then.
+        """
+        upstream = Protocol()
+        upstream.makeConnection(StringTransport())
+        downstream = _Proxy()
+        downstream.makeConnection(StringTransport())
+        calls = []
+        downstream.take_over(upstream, b"header", lambda: calls.append(None))
+        upstream.dataReceived(b"hello")
+        self.expectThat(calls, HasLength(0))
+        downstream.dataReceived(b"good")
+        downstream.dataReceived(b"bye")
+        self.expectThat(calls, HasLength(1))
+
+
+    def test_tenant(self):
+        """
+        The connection and the data proxied over it are accounted for in the
+        ``_TenantStats`` given to ``take_over``.
+        """
+        upstream = Protocol()
+        upstream.makeConnection(StringTransport())
+        downstream = _Proxy()
+        downstream.makeConnection(StringTransport())
+        tenant = _TenantStats()
+        downstream.take_over(upstream, b"header", tenant=tenant)
+        upstream.dataReceived(b"hello")
+        downstream.dataReceived(b"goodbye")
+        self.expectThat(
+            (tenant.connects, tenant.connections, tenant.bytes_downstream, tenant.bytes_upstream),
+            Equals((1, 1, 5, 7)),
+        )
+        downstream.connectionLost(Failure(ConnectionDone()))
+        self.expectThat(tenant.connections, Equals(0))
+
+
+    def test_bandwidth_limit(self):
+        """
+        If the ``_TenantStats`` has a bandwidth limit, data is proxied as it
+        arrives but the side it came from stops reading until the limit
+        allows more.  Relieving backpressure during that time does not resume
+        reading.
+        """
+        clock = Clock()
+        upstream = Protocol()
+        upstream.makeConnection(StringTransport())
+        downstream = _Proxy()
+        downstream.makeConnection(StringTransport())
+        tenant = _TenantStats()
+        tenant.bandwidth = _TokenBucket(clock, _TokenBucket.minimum_burst)
+        downstream.take_over(upstream, b"", tenant=tenant)
+
+        data = b"x" * (_TokenBucket.minimum_burst * 2)
+        upstream.dataReceived(data)
+        self.expectThat(downstream.transport.value(), Equals(data))
+        self.expectThat(upstream.transport.producerState, Equals(u"paused"))
+
+        downstream.transport.producer.pauseProducing()
+        downstream.transport.producer.resumeProducing()
+        self.expectThat(upstream.transport.producerState, Equals(u"paused"))
+
+        clock.advance(1)
+        self.expectThat(upstream.transport.producerState, Equals(u"producing"))
+
+        # Backpressure which arrives during throttling is still respected
+        # after it ends.
+        downstream.dataReceived(data)
+        upstream.transport.producer.pauseProducing()
+        clock.advance(2)
+        self.expectThat(downstream.transport.producerState, Equals(u"paused"))
+        upstream.transport.producer.resumeProducing()
+        self.expectThat(downstream.transport.producerState, Equals(u"producing"))
+
+
+    def test_connection_lost(self):
+        """
+        When the downstream connection is lost, the upstream connection is
+        closed and the ``Deferred`` returned by ``take_over`` fires.
+        """
+        self.downstream.connectionLost(Failure(ConnectionDone()))
+        self.expectThat(self.upstream.transport.disconnecting, Equals(True))
+        self.expectThat(self.successResultOf(self.done), Equals(None))
+
+
+
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+
+class TokenBucketTests(TestCase):
+    """
+    Tests for ``_TokenBucket``.
+    """
+    def test_debt(self):
+        """
+        ``_TokenBucket.consume`` returns the number of seconds until the bucket
+        will have been refilled enough to cover what was taken beyond its
+        contents.
+        """
+        clock = Clock()
+        bucket = _TokenBucket(clock, 1024 * 1024)
+        self.expectThat(bucket.consume(1024 * 1024), Equals(0))
+        self.expectThat(bucket.consume(512 * 1024), Equals(0.5))
+        clock.advance(0.25)
+        self.expectThat(bucket.consume(0), Equals(0.25))
+        clock.advance(10)
+        # The bucket holds no more than one second's worth.
+        self.expectThat(bucket.consume(1024 * 1024 + 1024), Equals(1 / 1024.0))
+
+
+
+class TenantAccountingTests(TestCase):
+    """
+    Tests for ``_TenantAccounting``.
+    """
+    def test_top_tenants(self):
+        """
+        ``_TenantAccounting.flush`` gives the subscriptions with the most
+        traffic their own label values and counts the rest as ``other``.
+        """
+        accounting = _TenantAccounting(1, Clock())
+        heavy = accounting.stats(u"heavy-tenant")
+        light = accounting.stats(u"light-tenant")
+        heavy.connects, heavy.bytes_downstream = 1, 1000
+        light.connects, light.bytes_downstream, light.connections = 1, 10, 2
+
+        before = {
+            label: _sample(
+                u"grid_router_tenant_bytes_total",
+                subscription=label, direction=u"downstream",
+            )
+            for label in [u"heavy-tenant", u"light-tenant", u"other"]
+        }
+        accounting.flush()
+        self.expectThat(
+            {
+                label: _sample(
+                    u"grid_router_tenant_bytes_total",
+                    subscription=label, direction=u"downstream",
+                ) - before[label]
+                for label in before
+            },
+            Equals({u"heavy-tenant": 1000, u"light-tenant": 0, u"other": 10}),
+        )
+        # The tenant with the most connections gets its own gauge.
+        self.expectThat(
+            _sample(u"grid_router_tenant_connections", subscription=u"light-tenant"),
+            Equals(2),
+        )
+        # Stats for tenants with nothing in progress are discarded.
+        self.expectThat(accounting._stats.keys(), Equals([u"light-tenant"]))
+        self.expectThat(heavy.bytes_downstream, Equals(0))
+
+
+    def test_rotation(self):
+        """
+        As the heaviest subscriptions change, ``_TenantAccounting.flush``
+        removes the series of those which drop out so only ``limit``
+        subscriptions have their own series.
+        """
+        limit = 2
+        accounting = _TenantAccounting(limit, Clock())
+        tenants = list(u"rotating-tenant-{}".format(n) for n in range(limit * 3))
+        for start in range(len(tenants) - limit + 1):
+            heaviest = tenants[start:start + limit]
+            for tenant in heaviest:
+                stats = accounting.stats(tenant)
+                stats.connects, stats.bytes_upstream, stats.bytes_downstream = 1, 1, 1
+                stats.connections = 1
+            accounting.flush()
+            for tenant in heaviest:
+                accounting.stats(tenant).connections = 0
+
+        def series(name):
+            return set(
+                sample_labels[u"subscription"]
+                for metric in REGISTRY.collect()
+                for (sample_name, sample_labels, value) in metric.samples
+                if sample_name == name
+                and sample_labels[u"subscription"] in tenants
+            )
+        for name in [
+            u"grid_router_tenant_bytes_total",
+            u"grid_router_tenant_connections_total",
+            u"grid_router_tenant_connections",
+        ]:
+            self.expectThat(series(name), Equals(set(heaviest)), name)
+
+
+    def test_unknown(self):
+        """
+        Connections for which the subscription is not known are accounted
+        together.
+        """
+        accounting = _TenantAccounting(1, Clock())
+        self.expectThat(accounting.stats(None), Is(accounting.stats(u"unknown")))
+
+
+    def test_bandwidth_limit(self):
+        """
+        ``_TenantAccounting.stats`` keeps the subscription's token bucket while
+        its bandwidth limit stays the same and replaces or removes it when
+        the limit changes.
+        """
+        accounting = _TenantAccounting(1, Clock())
+        bucket = accounting.stats(u"tenant", 1024).bandwidth
+        self.expectThat(bucket.rate, Equals(1024))
+        self.expectThat(accounting.stats(u"tenant", 1024).bandwidth, Is(bucket))
+        self.expectThat(accounting.stats(u"tenant", 2048).bandwidth.rate, Equals(2048))
+        self.expectThat(accounting.stats(u"tenant").bandwidth, Is(None))
+
+
+
+class UpstreamPoolTests(TestCase):
+    """
+    Tests for ``_UpstreamPool``.
+    """
+    address = (u"10.0.0.1", 10000)
+
+    def setUp(self):
+        super(UpstreamPoolTests, self).setUp()
+        self.network = MemoryReactor()
+        self.clock = Clock()
+        self.pool = _UpstreamPool(FakeReactor(self.network, self.clock), 1)
+
+
+    def complete(self, index):
+        """
+        Finish establishing one of the connections the pool started.
+        """
+        factory = self.network.tcpClients[index][2]
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        return protocol
+
+
+    def test_spare_used(self):
+        """
+        After a connection to an address, another is made and kept idle to be
+        used for the next connection to that address.
+        """
+        first = self.pool.connect(self.address)
+        self.expectThat(self.network.tcpClients, HasLength(2))
+        self.complete(0)
+        self.successResultOf(first)
+        self.complete(1)
+
+        second = self.pool.connect(self.address)
+        self.expectThat(self.successResultOf(second), IsInstance(_Proxy))
+        # A replacement spare is begun.
+        self.expectThat(self.network.tcpClients, HasLength(3))
+
+
+    def test_spare_expires(self):
+        """
+        An idle connection is closed after ``spare_lifetime`` seconds and is
+        not replaced if the address has not been used for ``hot_lifetime``
+        seconds.
+        """
+        self.pool.connect(self.address)
+        self.complete(0)
+        spare = self.complete(1)
+        self.clock.advance(self.pool.spare_lifetime)
+        self.expectThat(spare.transport.disconnecting, Equals(True))
+        self.expectThat(self.network.tcpClients, HasLength(2))
+        self.expectThat(self.pool._spares, Equals({}))
+        self.expectThat(self.pool._last_used, Equals({}))
+
+
+    def test_spare_lost(self):
+        """
+        An idle connection which is closed by the other side is not used.
+        """
+        self.pool.connect(self.address)
+        self.complete(0)
+        spare = self.complete(1)
+        spare.connectionLost(Failure(ConnectionDone()))
+        self.expectThat(self.clock.getDelayedCalls(), HasLength(0))
+        self.pool.connect(self.address)
+        self.expectThat(self.network.tcpClients, HasLength(4))
+
+
+
+class _WatchingKube(object):
+    """
+    Just enough of a ``KubeClient`` for ``_router_informer``.  Lists and
+    watches are resolved by the test.
+
+    :ivar list watches: The ``Deferred``, event handler, resource version,
+        and establishment callback of each watch started.
+    """
+    def __init__(self, client, pods):
+        self.k8s = client
+        self._pods = pods
+        self.lists = 0
+        self.watches = []
+
+    def list(self, kind, selector):
+        self.lists += 1
+        return succeed(self.k8s.model.v1.PodList(
+            metadata=dict(resourceVersion=u"1"),
+            items=select(self.k8s.model.v1.PodList(items=self._pods), selector),
+        ))
+
+    def watch(
+            self, kind, namespace, labels, resource_version, handle_event,
+            established=lambda: None,
+    ):
+        d = Deferred()
+        self.watches.append((d, handle_event, resource_version, established))
+        return d
+
+
+
+class RouteSnapshotServiceTests(TestCase):
+    """
+    Tests for ``_RouteSnapshotService``.
+    """
+    def setUp(self):
+        super(RouteSnapshotServiceTests, self).setUp()
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.router = _GridRouterService(self.clock)
+        self.path = self.make_temporary_path()
+        self.service = _RouteSnapshotService(self.clock, self.router, self.path)
+
+
+    def write_snapshot(self, written):
+        self.path.setContent(encode_snapshot(Snapshot(
+            generation=7,
+            written=written,
+            routes=[(u"abc", (u"10.0.0.1", 10000))],
+        )))
+
+
+    def test_load(self):
+        """
+        When the service starts, the routes in the snapshot are used until
+        routes are loaded from Kubernetes.
+        """
+        self.write_snapshot(self.clock.seconds() - 60)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+        self.expectThat(
+            self.router.route_mapping(),
+            Equals({u"abc": (None, (u"10.0.0.1", 10000))}),
+        )
+        self.expectThat(
+            self.router._route_index.lookup(b"abc"),
+            Equals(((u"10.0.0.1", 10000), None, None, None)),
+        )
+        self.expectThat(self.router.snapshot().generation, Equals(7))
+
+        self.router.set_pods([])
+        self.expectThat(self.router.route_mapping(), Equals({}))
+        self.expectThat(self.router.snapshot().generation, Equals(8))
+
+
+    def test_too_old(self):
+        """
+        A snapshot older than ``maximum_age`` seconds is not used.
+        """
+        self.write_snapshot(self.clock.seconds() - self.service.maximum_age - 1)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+        self.expectThat(self.router.route_mapping(), Equals({}))
+
+
+    def test_save(self):
+        """
+        Changed routes are saved every ``interval`` seconds and when the
+        service stops.
+        """
+        self.service.startService()
+        self.router.set_route_mapping({u"abc": (None, (u"10.0.0.1", 10000))})
+        self.clock.advance(self.service.step)
+        self.expectThat(
+            decode_snapshot(self.path.getContent()),
+            Equals(Snapshot(
+                generation=1,
+                written=self.clock.seconds(),
+                routes=[(u"abc", (u"10.0.0.1", 10000))],
+            )),
+        )
+
+        self.router.set_route_mapping({})
+        self.service.stopService()
+        self.expectThat(decode_snapshot(self.path.getContent()).routes, Equals([]))
+
+
+
+class RouterInformerTests(TestCase):
+    """
+    Tests for ``_router_informer``.
+    """
+    def setUp(self):
+        super(RouterInformerTests, self).setUp()
+        self.clock = Clock()
+        self.router = _GridRouterService(self.clock)
+        self.client = memory_kubernetes().client()
+        deploy_config = deployment_configuration().example()
+        self.pods = list(
+            derive_pod(
+                model,
+                create_deployment(deploy_config, subscription_details().example(), model),
+                ip,
+            )
+            for ip in [u"10.0.0.1", u"10.0.0.2"]
+        )
+        self.kube = _WatchingKube(self.client, self.pods[:1])
+        self.service = _router_informer(
+            self.clock, 1.0, self.kube, deploy_config.kubernetes_namespace, self.router,
+        )
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+
+
+    def tub_ids(self):
+        return set(self.router.route_mapping().keys())
+
+
+    def test_list_then_watch(self):
+        """
+        The service lists pods once and then watches from the resource version
+        of the list, applying events to the route mapping.
+        """
+        first, second = self.pods
+        self.expectThat(self.kube.lists, Equals(1))
+        self.expectThat(self.tub_ids(), Equals({
+            first.metadata.annotations[u"leastauthority.com/introducer-tub-id"],
+            first.metadata.annotations[u"leastauthority.com/storage-tub-id"],
+        }))
+        [(d, handle_event, resource_version, _)] = self.kube.watches
+        self.expectThat(resource_version, Equals(u"1"))
+
+        handle_event(WatchEvent(type=u"ADDED", object=second))
+        handle_event(WatchEvent(type=u"DELETED", object=first))
+        self.expectThat(self.tub_ids(), Equals({
+            second.metadata.annotations[u"leastauthority.com/introducer-tub-id"],
+            second.metadata.annotations[u"leastauthority.com/storage-tub-id"],
+        }))
+
+        # When the server ends the watch, it is resumed without a list.
+        d.callback(None)
+        self.expectThat(self.kube.lists, Equals(1))
+        self.expectThat(self.kube.watches, HasLength(2))
+
+
+    def test_sync_time(self):
+        """
+        The time at which the routes were last known to be up to date is
+        recorded whenever the watch reports a change or the server accepts a
+        resumed watch.
+        """
+        def sync_time():
+            return REGISTRY.get_sample_value(
+                u"grid_router_routes_last_sync_timestamp_seconds",
+            )
+        [(d, handle_event, _, _)] = self.kube.watches
+        self.clock.advance(10)
+        handle_event(WatchEvent(type=u"ADDED", object=self.pods[1]))
+        self.expectThat(sync_time(), Equals(10))
+        self.clock.advance(10)
+        d.callback(None)
+        self.expectThat(sync_time(), Equals(10))
+        [_, (_, _, _, established)] = self.kube.watches
+        established()
+        self.expectThat(sync_time(), Equals(20))
+
+
+    @capture_logging(None)
+    def test_tasks(self, logger):
+        """
+        Each list and watch is logged as a task of its own rather than beneath
+        the one before it.
+        """
+        [(d, _, _, _)] = self.kube.watches
+        d.callback(None)
+        [(d, _, _, _)] = self.kube.watches[1:]
+        d.errback(WatchExpired())
+        started = list(
+            (message[u"action_type"], message[u"task_level"])
+            for message in logger.messages
+            if message.get(u"action_status") == u"started"
+            and message[u"action_type"].startswith(u"informer:")
+        )
+        self.expectThat(started, Equals([
+            (u"informer:watch", [1]),
+            (u"informer:relist", [1]),
+            (u"informer:watch", [1]),
+        ]))
+
+
+    def test_relist_on_expired(self):
+        """
+        If the watch expires, the service lists pods again.
+        """
+        [(d, _, _, _)] = self.kube.watches
+        d.errback(WatchExpired())
+        self.expectThat(self.kube.lists, Equals(2))
+        self.expectThat(self.kube.watches, HasLength(2))
+
+
+    @capture_logging(None)
+    def test_relist_after_error(self, logger):
+        """
+        If the watch fails unexpectedly, the failure is logged and the service
+        lists pods again after the configured interval.
+        """
+        [(d, _, _, _)] = self.kube.watches
+        d.errback(CustomException())
+        self.expectThat(logger.flush_tracebacks(CustomException), HasLength(1))
+        self.expectThat(self.kube.lists, Equals(1))
+        self.clock.advance(1.0)
+        self.expectThat(self.kube.lists, Equals(2))
+
+
+
+class WorkerTests(TestCase):
+    """
+    Tests for the pieces which let several worker processes accept
+    connections using one route table.
+    """
+    @given(
+        ip=ipv4_addresses(),
+        deploy_config=deployment_configuration(),
+        details=subscription_details()
+    )
+    def test_route_broadcast(self, ip, deploy_config, details):
+        """
+        Route changes written by a ``_RouteWriter`` which is watching a
+        ``_GridRouterService`` are applied to a ``_RouteIndex`` by
+        ``_RouteReader`` so that it agrees with the index of the service.
+        """
+        service = _GridRouterService(object())
+        service.set_route_mapping({
+            u"old": (None, (u"10.0.0.1", 10000)),
+        })
+        transport = StringTransport()
+        service.watch_routes(_RouteWriter(transport))
+
+        deploy_config = attr.evolve(deploy_config, router_limits={
+            details.product_id: RouterLimits(bandwidth=1024, connections=10),
+        })
+        deployment = create_deployment(deploy_config, details, model)
+        pod = derive_pod(model, deployment, ip)
+        service.apply_pod_event(u"ADDED", pod)
+
+        index = _RouteIndex()
+        reader = _RouteReader(index, lambda: None)
+        reader.makeConnection(StringTransport())
+        reader.dataReceived(transport.value())
+        self.expectThat(index._routes, Equals(service._route_index._routes))
+        self.expectThat(
+            index.lookup(details.storage_tub_id.encode("ascii")),
+            Equals(((ip, details.storage_port_number), details.subscription_id, 1024, 10)),
+        )
+
+        transport.clear()
+        service.apply_pod_event(u"DELETED", pod)
+        reader.dataReceived(transport.value())
+        self.expectThat(index._routes, Equals({b"old": ((u"10.0.0.1", 10000), None, None, None)}))
+
+
+    def test_route_shares(self):
+        """
+        A ``_RouteWriter`` writing routes for one of several workers divides
+        each limit between them, rounding up.
+        """
+        transport = StringTransport()
+        writer = _RouteWriter(transport, 3)
+        writer.replace([
+            (b"limited", ((u"10.0.0.1", 10000), u"a", 1000, 10)),
+            (b"unlimited", ((u"10.0.0.2", 10000), u"b", None, None)),
+        ])
+        writer.add(b"small", ((u"10.0.0.3", 10000), u"c", 1, 1))
+
+        index = _RouteIndex()
+        reader = _RouteReader(index, lambda: None)
+        reader.makeConnection(StringTransport())
+        reader.dataReceived(transport.value())
+        self.expectThat(index._routes, Equals({
+            b"limited": ((u"10.0.0.1", 10000), u"a", 334, 4),
+            b"unlimited": ((u"10.0.0.2", 10000), u"b", None, None),
+            b"small": ((u"10.0.0.3", 10000), u"c", 1, 1),
+        }))
+
+
+    def test_worker_metrics(self):
+        """
+        Every metric recorded by the classes which proxy connections is
+        collected from the worker processes.
+        """
+        names = set(
+            metric.name
+            for cls in [_FoolscapProxy, _Proxy, _UpstreamPool, _TenantAccounting]
+            for value in vars(cls).values()
+            if hasattr(value, "collect")
+            for metric in value.collect()
+        )
+        self.expectThat(names - _WORKER_METRICS, Equals(set()))
+        self.expectThat(
+            _WORKER_METRICS,
+            Contains(u"grid_router_throttled_total"),
+        )
+
+
+    def test_metrics_directory_removed(self):
+        """
+        ``_WorkerPoolService`` removes the metrics directory once it has been
+        stopped and its workers have exited.
+        """
+        spawned = []
+        class ProcessReactor(Clock):
+            def spawnProcess(self, protocol, *args, **kwargs):
+                spawned.append(protocol)
+
+        metrics_directory = self.mktemp()
+        FilePath(metrics_directory).makedirs()
+        pool = _WorkerPoolService(
+            ProcessReactor(), _GridRouterService(object()), 1, [],
+            metrics_directory,
+        )
+        pool.startService()
+        [worker] = spawned
+        transport = StringTransport()
+        transport.pid = 12345
+        transport.signalProcess = lambda signal: None
+        worker.makeConnection(transport)
+
+        d = pool.stopService()
+        self.expectThat(FilePath(metrics_directory).exists(), Equals(True))
+        worker.processEnded(Failure(ProcessTerminated(signal=15)))
+        self.successResultOf(d)
+        self.expectThat(FilePath(metrics_directory).exists(), Equals(False))
+
+
+    def test_reuse_port(self):
+        """
+        ``_ReusePortEndpoint`` can listen on a port which another socket with
+        ``SO_REUSEPORT`` set is already listening on.
+        """
+        other = socket()
+        self.addCleanup(other.close)
+        other.setsockopt(SOL_SOCKET, _SO_REUSEPORT, 1)
+        other.bind(("127.0.0.1", 0))
+        other.listen(1)
+
+        reactor = MemoryReactor()
+        endpoint = _ReusePortEndpoint(
+            reactor, other.getsockname()[1], interface="127.0.0.1",
+        )
+        self.successResultOf(endpoint.listen(object()))
+        self.expectThat(reactor.adoptedPorts, HasLength(1))
+
+
+    def test_worker_options(self):
+        """
+        Worker processes don't need to be told how to talk to Kubernetes.
+        """
+        options = Options()
+        options.parseOptions([b"--worker"])
+        self.expectThat(options["worker"], Equals(True))
+
+
+
 # XXX Doesn't seem to be easily reversible.
 from foolscap.logging.log import bridgeLogsToTwisted
 bridgeLogsToTwisted(lambda event: True)
@@ -0,0 +1,86 @@
+# Copyright Least Authority Enterprises.
+# See LICENSE for details.
+
+"""
+Tests for ``grid_router._snapshot``.
+"""
+
+import attr
+
+from testtools.matchers import Equals
+
+from hypothesis import given
+from hypothesis.strategies import (
+    dictionaries, text, tuples, integers, floats,
+)
+
+from lae_util.testtools import TestCase
+from lae_automation.test.strategies import ipv4_addresses, port_numbers
+
+from .._snapshot import (
+    Snapshot, SnapshotError, encode_snapshot, decode_snapshot,
+)
+
+
+def tub_ids():
+    return text(alphabet=u"abcdefghijklmnopqrstuvwxyz234567", min_size=1, max_size=32)
+
+
+def snapshots():
+    return tuples(
+        integers(min_value=0, max_value=2 ** 64 - 1),
+        floats(min_value=0, max_value=2 ** 32),
+        dictionaries(tub_ids(), tuples(ipv4_addresses(), port_numbers())),
+    ).map(
+        lambda values: Snapshot(
+            generation=values[0],
+            written=values[1],
+            routes=sorted(values[2].items()),
+        ),
+    )
+
+
+
+class SnapshotTests(TestCase):
+    """
+    Tests for ``encode_snapshot`` and ``decode_snapshot``.
+    """
+    @given(snapshots())
+    def test_roundtrip(self, snapshot):
+        """
+        A snapshot is decoded to the same snapshot it was encoded from.
+        """
+        decoded = decode_snapshot(encode_snapshot(snapshot))
+        self.assertThat(
+            attr.evolve(decoded, routes=sorted(decoded.routes)),
+            Equals(snapshot),
+        )
+
+
+    def test_unavailable_address(self):
+        """
+        Routes without an IPv4 address are not included.
+        """
+        snapshot = Snapshot(
+            generation=1,
+            written=2.0,
+            routes=[(u"abc", (None, 1)), (u"def", (u"10.0.0.1", 2))],
+        )
+        self.assertThat(
+            decode_snapshot(encode_snapshot(snapshot)).routes,
+            Equals([(u"def", (u"10.0.0.1", 2))]),
+        )
+
+
+    def test_malformed(self):
+        """
+        ``decode_snapshot`` raises ``SnapshotError`` if given something other
+        than a complete snapshot.
+        """
+        data = encode_snapshot(Snapshot(
+            generation=1,
+            written=2.0,
+            routes=[(u"abc", (u"10.0.0.1", 2))],
+        ))
+        for malformed in [b"", b"x" * len(data), data[:-1], data + b"x"]:
+            self.assertRaises(SnapshotError, decode_snapshot, malformed)
@@ -4,6 +4,9 @@
 from base64 import b32encode, b32decode
 from json import dumps
 from hashlib import sha256
+from functools import wraps
+
+import attr
 
 from eliot import Message
 
@@ -29,6 +32,177 @@ CUSTOMER_METADATA_LABELS = {
 
 
 
+def _content_hash(obj):
+    """
+    :return bytes: A digest of all of the fields of an ``attrs``-based
+        object.
+    """
+    return sha256(
+        dumps(attr.asdict(obj), sort_keys=True, default=repr),
+    ).digest()
+
+
+
+@attr.s
+class _RenderEntry(object):
+    """
+    The objects rendered for one subscription.
+
+    :ivar deploy_config: The deployment configuration most recently looked
+        up for the subscription.
+
+    :ivar details: The subscription details most recently looked up.
+
+    :ivar tuple digests: The content hashes of the details and the
+        configuration the objects were rendered from.
+
+    :ivar dict values: A mapping from the function and extra arguments which
+        rendered each object to the object.
+    """
+    deploy_config = attr.ib()
+    details = attr.ib()
+    digests = attr.ib()
+    values = attr.ib(default=attr.Factory(dict))
+
+
+
+class _RenderCache(object):
+    """
+    A cache of the objects rendered for subscriptions.
+
+    Only the objects rendered from a subscription's latest details and
+    deployment configuration are kept, so each subscription has at most one
+    entry and every subscription's objects stay cached from one pass of
+    convergence to the next however many subscriptions there are.  Entries
+    for subscriptions which have gone away are discarded by ``retain``.
+
+    The cached objects are all immutable so they can be handed out any
+    number of times.
+
+    Content hashes are only computed for configuration and details which
+    were not the very objects looked up last time.  The configuration is
+    shared by every subscription in a pass of convergence and each
+    subscription's details by every object rendered for it so each is
+    hashed only once per pass.
+
+    :ivar dict _entries: A mapping from subscription identifier to
+        ``_RenderEntry``.
+
+    :ivar tuple _config: The deployment configuration most recently hashed
+        and its content hash.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._config = (None, None)
+
+
+    def _config_digest(self, deploy_config):
+        config, digest = self._config
+        if config is not deploy_config:
+            digest = _content_hash(deploy_config)
+            self._config = (deploy_config, digest)
+        return digest
+
+
+    def get(self, deploy_config, details, key, render):
+        """
+        :param deploy_config: The ``DeploymentConfiguration`` the object is
+            rendered from.
+
+        :param details: The ``SubscriptionDetails`` the object is rendered
+            from.
+
+        :param key: Something hashable identifying everything else the
+            rendered object depends on.
+
+        :param render: A no-argument callable to render the object if it is
+            not cached.
+
+        :return: The cached or newly rendered object.
+        """
+        sid = details.subscription_id
+        entry = self._entries.get(sid)
+        if (
+            entry is None or
+            entry.details is not details or
+            entry.deploy_config is not deploy_config
+        ):
+            if entry is not None and entry.details is details:
+                details_digest = entry.digests[0]
+            else:
+                details_digest = _content_hash(details)
+            digests = (details_digest, self._config_digest(deploy_config))
+            if entry is None or entry.digests != digests:
+                entry = self._entries[sid] = _RenderEntry(
+                    deploy_config, details, digests,
+                )
+            else:
+                entry.deploy_config = deploy_config
+                entry.details = details
+        try:
+            return entry.values[key]
+        except KeyError:
+            value = entry.values[key] = render()
+            return value
+
+
+    def retain(self, subscription_ids):
+        """
+        Discard the objects rendered for every subscription except some.
+
+        :param subscription_ids: The identifiers of the subscriptions whose
+            objects to keep.
+        """
+        for sid in set(self._entries) - set(subscription_ids):
+            del self._entries[sid]
+
+
+    def clear(self):
+        self._entries.clear()
+        self._config = (None, None)
+
+
+
+_render_cache = _RenderCache()
+
+
+
+def retain_rendered(subscription_ids):
+    """
+    Discard the cached objects rendered for subscriptions which are no longer
+    being converged.  Without this, the objects (which include the
+    subscriptions' secrets) of every subscription ever seen would be kept.
+
+    :param subscription_ids: The identifiers of the subscriptions still
+        being converged.
+    """
+    _render_cache.retain(subscription_ids)
+
+
+
+def _memoized(f):
+    """
+    Decorate a function of a deployment configuration and subscription
+    details (and perhaps some hashable arguments after those) so its results
+    are kept in ``_render_cache``.
+
+    The results are kept for the content of the configuration and details,
+    not their identity, so a subscription loaded again by a later pass of
+    convergence finds the objects rendered for it before.
+    """
+    @wraps(f)
+    def memoized(deploy_config, details, *args):
+        if not attr.has(type(deploy_config)):
+            # Eg NullDeploymentConfiguration.
+            return f(deploy_config, details, *args)
+        return _render_cache.get(
+            deploy_config, details, (f.__name__,) + args,
+            lambda: f(deploy_config, details, *args),
+        )
+    return memoized
+
+
+
 def _s4_customer_metadata(model):
     return model.v1.ObjectMeta(labels=CUSTOMER_METADATA_LABELS)
 
@@ -61,6 +235,48 @@ def subscription_metadata(details):
 
 
 
+# The annotations on a customer grid pod giving the limits the grid router
+# enforces on connections to it.
+ROUTER_BANDWIDTH_LIMIT_ANNOTATION = u"leastauthority.com/router-bandwidth-limit"
+ROUTER_CONNECTION_LIMIT_ANNOTATION = u"leastauthority.com/router-connection-limit"
+ROUTER_LIMIT_ANNOTATIONS = (
+    ROUTER_BANDWIDTH_LIMIT_ANNOTATION,
+    ROUTER_CONNECTION_LIMIT_ANNOTATION,
+)
+
+
+
+def router_limit_annotations(deploy_config, details):
+    """
+    :return dict: The grid router limit annotations a subscription's pods
+        should have, according to its plan.  Limits the plan does not have
+        are left out.
+    """
+    limits = deploy_config.router_limits.get(details.product_id)
+    if limits is None:
+        return {}
+    annotations = {}
+    if limits.bandwidth is not None:
+        annotations[ROUTER_BANDWIDTH_LIMIT_ANNOTATION] = u"{}".format(limits.bandwidth)
+    if limits.connections is not None:
+        annotations[ROUTER_CONNECTION_LIMIT_ANNOTATION] = u"{}".format(limits.connections)
+    return annotations
+
+
+
+def router_limit_metadata(deploy_config, details):
+    """
+    :return: A pyrsistent transformation which annotates a pod template with
+        the limits the grid router should enforce on connections to that
+        pod, according to the subscription's plan.
+    """
+    transformation = []
+    for (name, value) in sorted(router_limit_annotations(deploy_config, details).items()):
+        transformation.extend([[u"metadata", u"annotations", name], value])
+    return transformation
+
+
+
 def configmap_name(subscription_id):
     return u"customer-config-" + _sanitize(subscription_id)
 
@@ -74,26 +290,26 @@ def configmap_public_host(subscription_id, domain):
 
 
 
-def create_configuration(deploy_config, details, model):
-    """
-    Create the Kubernetes configuration resource necessary to provide
-    service to the given subscription.
+# The annotation on a configmap (and, placed there by the subscription
+# converger, on the pod template of the deployment which uses it) giving a
+# digest of the Tahoe-LAFS configuration in the configmap.  Changes to the
+# configuration are found by comparing it to the digest of the configuration
+# which should be there instead of comparing the configuration itself.  A
+# change to the digest on the pod template makes Kubernetes replace the pods
+# so they load the new configuration.
+CONFIGURATION_HASH_ANNOTATION = u"leastauthority.com/configuration-hash"
+
+
+
+def _configuration_data(deploy_config, details):
     """
-    configmap_template = model.v1.ConfigMap(
-        metadata=_s4_customer_metadata(model),
-    )
+    Compute the contents of the configmap for a subscription.
 
-    name = configmap_name(details.subscription_id)
-    metadata = subscription_metadata(details)
+    :return dict: The configmap data.
+    """
     public_host = configmap_public_host(details.subscription_id, deploy_config.domain)
     private_host = deploy_config.private_host
 
-    Message.log(
-        event=u"convergence-service:key-notification",
-        key_id=deploy_config.s3_access_key_id,
-        secret_key_hash=sha256(deploy_config.s3_secret_key).hexdigest().decode("ascii"),
-    )
-
     configuration = marshal_tahoe_configuration(
         introducer_pem=details.introducer_node_pem,
         storage_pem=details.server_node_pem,
@@ -114,6 +330,53 @@ def create_configuration(deploy_config, details, model):
         log_gatherer_furl=deploy_config.log_gatherer_furl,
         stats_gatherer_furl=deploy_config.stats_gatherer_furl,
     )
+    return {
+        u"introducer.json": dumps({"introducer": configuration["introducer"]}).decode("ascii"),
+        u"storage.json": dumps({"storage": configuration["storage"]}).decode("ascii"),
+    }
+
+
+
+def _data_hash(data):
+    return sha256(
+        dumps(data, sort_keys=True).encode("utf-8"),
+    ).hexdigest().decode("ascii")
+
+
+
+@_memoized
+def configuration_hash(deploy_config, details):
+    """
+    :return unicode: The digest of the Tahoe-LAFS configuration for the given
+        subscription, as found in ``CONFIGURATION_HASH_ANNOTATION``.
+    """
+    return _data_hash(_configuration_data(deploy_config, details))
+
+
+
+@_memoized
+def create_configuration(deploy_config, details, model):
+    """
+    Create the Kubernetes configuration resource necessary to provide
+    service to the given subscription.
+
+    The configmap is rendered (and the key notification logged) only the
+    first time it is needed for a particular configuration and subscription.
+    """
+    configmap_template = model.v1.ConfigMap(
+        metadata=_s4_customer_metadata(model),
+    )
+
+    name = configmap_name(details.subscription_id)
+    metadata = subscription_metadata(details)
+
+    Message.log(
+        event=u"convergence-service:key-notification",
+        key_id=deploy_config.s3_access_key_id,
+        secret_key_hash=sha256(deploy_config.s3_secret_key).hexdigest().decode("ascii"),
+    )
+
+    data = _configuration_data(deploy_config, details)
 
     return configmap_template.transform(
         [u"metadata", u"namespace"], deploy_config.kubernetes_namespace,
@@ -122,16 +385,29 @@ def create_configuration(deploy_config, details, model):
         # Some other metadata to make inspecting this stuff a little easier.
         *metadata
     ).transform(
+        [u"metadata", u"annotations", CONFIGURATION_HASH_ANNOTATION],
+        _data_hash(data),
         # Dump the actual Tahoe-LAFS configuration into it.
-        [u"data", u"introducer.json"],
-        dumps({"introducer": configuration["introducer"]}).decode("ascii"),
-
-        [u"data", u"storage.json"],
-        dumps({"storage": configuration["storage"]}).decode("ascii"),
+        [u"data", u"introducer.json"], data[u"introducer.json"],
+        [u"data", u"storage.json"], data[u"storage.json"],
     )
 
 
+_deployment_templates = {}
+
 def _deployment_template(model):
+    """
+    :return: The parts of a customer grid deployment which are the same for
+        every subscription, built only once for each model.
+    """
+    try:
+        return _deployment_templates[model]
+    except KeyError:
+        template = _deployment_templates[model] = _build_deployment_template(model)
+        return template
+
+
+def _build_deployment_template(model):
     return model.v1beta1.Deployment(
         metadata=_s4_customer_metadata(model),
         status=None,
@@ -246,18 +522,28 @@ def _sanitize(subscription_id):
 
 
 
+def subscription_label(subscription_id):
+    """
+    :return unicode: The value of the ``subscription`` label on a
+        subscription's deployment and the replicasets and pods it creates.
+    """
+    return _sanitize(subscription_id)
+
+
+
 def deployment_name(subscription_id):
     return u"customer-deployment-" + _sanitize(subscription_id)
 
 
 
+@_memoized
 def create_deployment(deploy_config, details, model):
     name = deployment_name(details.subscription_id)
     configmap = configmap_name(details.subscription_id)
 
     # We need to make this Deployment distinct from the similar
     # deployments that exist for all other subscriptions.
-    subscription_label = b32encode(details.subscription_id).lower().strip(u"=")
+    label = subscription_label(details.subscription_id)
 
     # The names don't really matter.  They need to be unique within the scope
     # of the Deployment, I think.  Hey look they are.
@@ -272,12 +558,12 @@ def create_deployment(deploy_config, details, model):
         [u"metadata", u"name"], name,
 
         # Also make it easy to find by subscription.
-        [u"metadata", u"labels", u"subscription"], subscription_label,
+        [u"metadata", u"labels", u"subscription"], label,
 
         # Make the pod for this subscription's deployment distinct from the
         # pods for all the other subscriptions' deployments.
         [u"spec", u"template", u"metadata", u"labels", u"subscription"],
-        subscription_label,
+        label,
 
         # Point both configuration volumes at this subscription's configmap.
         ["spec", "template", "spec", "volumes", ny, "configMap", "name"], configmap,
@@ -308,8 +594,12 @@ def create_deployment(deploy_config, details, model):
         [u"spec", u"template"],
         lambda template: template.transform(*subscription_metadata(details)),
 
+        # The grid router finds these on the pods it routes to.
+        [u"spec", u"template"],
+        lambda template: template.transform(*router_limit_metadata(deploy_config, details)),
+
         # ... and then to the deployment spec.
-        *subscription_metadata(details)
+        *subscription_metadata(details) + router_limit_metadata(deploy_config, details)
     )
     deployment = deployment.transform(
         # Be explicit about how we select replicasets and pods belonging to
@@ -363,7 +653,7 @@ def new_service(namespace, model):
 
 
 def autopad_b32decode(s):
-    padding = 8 - (len(s) % 8)
+    padding = -len(s) % 8
     s += u"=" * padding
     v = b32decode(s.upper())
     return v
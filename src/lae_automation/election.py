@@ -0,0 +1,172 @@
+# Copyright Least Authority Enterprises.
+# See LICENSE for details.
+
+"""
+Choose one of several replicas of a service to do its work while the others
+stand by.
+
+The replica doing the work holds a lease recorded in a ConfigMap.  It renews
+the lease several times per lease period.  Once the lease has expired
+without being renewed, any of the other replicas may take it.
+"""
+
+from eliot import Message, start_action, write_failure
+from eliot.twisted import DeferredContext
+
+from twisted.internet.task import LoopingCall
+from twisted.application.service import Service
+from twisted.web.http import NOT_FOUND
+
+from txkube import KubernetesError
+
+
+
+class LeaderElection(Service):
+    """
+    ``LeaderElection`` takes and renews a lease on behalf of one replica.
+
+    The lease is the ``holder`` and ``expires`` (in seconds since the epoch)
+    entries of a ConfigMap.  Every update replaces the ConfigMap at the
+    version which was read so that two replicas cannot both take an expired
+    lease.  Expiry times are compared with this replica's clock so the
+    clocks of the replicas should roughly agree.
+
+    :ivar elected: A no-argument callable to call whenever this replica
+        takes the lease.
+
+    :ivar _expires: The time at which this replica's lease, if it holds it,
+        runs out unless renewed or ``None`` if it does not.
+    """
+    def __init__(self, clock, kube, namespace, name, identity, duration):
+        self._clock = clock
+        self._kube = kube
+        self._namespace = namespace
+        self._name = name
+        self._identity = identity
+        self._duration = duration
+        self.elected = lambda: None
+        self._expires = None
+        self._loop = None
+
+
+    @property
+    def leader(self):
+        """
+        Whether this replica holds the lease.
+        """
+        return self._expires is not None and self._clock.seconds() < self._expires
+
+
+    def startService(self):
+        Service.startService(self)
+        self._loop = LoopingCall(self.renew)
+        self._loop.clock = self._clock
+        self._loop.start(self._duration / 3.0, now=True)
+
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        if self.leader:
+            # Let a standby take over without waiting for the lease to run
+            # out.
+            d = self._read()
+            d.addCallback(self._write, 0)
+            d.addErrback(write_failure)
+            return d
+        self._expires = None
+        return None
+
+
+    def renew(self):
+        """
+        Renew the lease if this replica holds it or take it if it has
+        expired.
+
+        :return Deferred: Fires with ``None`` when done.  Failures are
+            logged.
+        """
+        a = start_action(
+            action_type=u"leader-election:renew",
+            name=self._name,
+            identity=self._identity,
+        )
+        with a.context():
+            d = DeferredContext(self._read())
+            d.addCallback(self._got_lease)
+            d.addErrback(write_failure)
+            return d.addActionFinish()
+
+
+    def _read(self):
+        model = self._kube.k8s.model
+        d = self._kube.get(model.v1.ConfigMap(
+            metadata=dict(namespace=self._namespace, name=self._name),
+        ))
+        def missing(reason):
+            reason.trap(KubernetesError)
+            if reason.value.code != NOT_FOUND:
+                return reason
+            return None
+        d.addErrback(missing)
+        return d
+
+
+    def _got_lease(self, configmap):
+        now = self._clock.seconds()
+        if configmap is not None:
+            data = configmap.data or {}
+            holder = data.get(u"holder")
+            try:
+                expires = float(data.get(u"expires", u"0"))
+            except ValueError:
+                expires = 0
+            if holder != self._identity and expires > now:
+                self._lost(holder)
+                return None
+        return self._write(configmap, now + self._duration)
+
+
+    def _write(self, configmap, expires):
+        """
+        Record this replica as holding the lease until ``expires``.
+        """
+        data = {
+            u"holder": self._identity,
+            u"expires": u"{:.3f}".format(expires),
+        }
+        if configmap is None:
+            model = self._kube.k8s.model
+            d = self._kube.create(model.v1.ConfigMap(
+                metadata=dict(namespace=self._namespace, name=self._name),
+                data=data,
+            ))
+        else:
+            d = self._kube.replace(configmap.set(data=data))
+        d.addCallback(lambda ignored: self._won(expires))
+        return d
+
+
+    def _won(self, expires):
+        was_leader = self.leader
+        self._expires = expires
+        if self.leader and not was_leader:
+            Message.log(
+                event_type=u"leader-election:elected",
+                name=self._name,
+                identity=self._identity,
+            )
+            self.elected()
+
+
+    def _lost(self, holder):
+        if self._expires is not None:
+            Message.log(
+                event_type=u"leader-election:deposed",
+                name=self._name,
+                identity=self._identity,
+                holder=holder,
+            )
+        self._expires = None
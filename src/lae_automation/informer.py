@@ -0,0 +1,181 @@
+# Copyright Least Authority Enterprises.
+# See LICENSE for details.
+
+"""
+An in-memory cache of Kubernetes objects which is kept up to date using a
+watch.
+"""
+
+from eliot import Message, start_task, write_failure
+from eliot.twisted import DeferredContext
+
+from twisted.internet.defer import CancelledError
+from twisted.application.service import Service
+
+from .kubeclient import And, LabelSelector, NamespaceSelector, WatchExpired
+
+
+
+class Informer(Service):
+    """
+    ``Informer`` keeps a copy of the objects of one kind with certain labels
+    in one namespace by listing them once and then applying the changes
+    reported by a Kubernetes watch.
+
+    The watch is resumed from the last observed resource version whenever the
+    server ends it.  If the server reports that version is too old (or the
+    watch fails some other way), the objects are listed again.
+
+    :ivar bool synced: Whether the objects have been listed yet.
+
+    :ivar dict _objects: A mapping from object name to the latest observed
+        state of that object.
+
+    :ivar _changed: A two-argument callable to call with the type of each
+        change (``u"ADDED"``, ``u"MODIFIED"``, or ``u"DELETED"``) and the
+        object which changed.
+
+    :ivar _replaced: ``None`` or a one-argument callable to call with a
+        ``list`` of all of the objects each time they are listed.  If it is
+        given, ``_changed`` is only called for changes reported by the
+        watch, not for the differences found by listing.
+
+    :ivar _current: A no-argument callable to call whenever the copy is
+        known to be up to date: after the objects are listed, when the server
+        accepts a watch, and after each change the watch reports.
+
+    :ivar _resource_version: The resource version of the most recently
+        observed collection state or ``None`` if there has not been one yet.
+    """
+    synced = False
+
+    def __init__(
+            self, reactor, interval, kube, kind, namespace, labels, changed,
+            replaced=None, current=lambda: None,
+    ):
+        self._reactor = reactor
+        self._interval = interval
+        self._kube = kube
+        self._kind = kind
+        self._namespace = namespace
+        self._labels = labels
+        self._selector = And([LabelSelector(labels), NamespaceSelector(namespace)])
+        self._changed = changed
+        self._replaced = replaced
+        self._current = current
+        self._objects = {}
+        self._resource_version = None
+        self._running = None
+        self._delayed = None
+
+
+    def items(self):
+        """
+        :return: A ``list`` of the objects as of the most recent change.
+        """
+        return self._objects.values()
+
+
+    def startService(self):
+        Service.startService(self)
+        self._relist()
+
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+        self._delayed = None
+        if self._running is not None:
+            self._running.cancel()
+
+
+    def _relist(self):
+        self._delayed = None
+        # Each list and watch is a task of its own.  They are started from
+        # the callbacks of the previous one and would otherwise nest without
+        # bound.
+        a = start_task(action_type=u"informer:relist", kind=self._kind.kind)
+        with a.context():
+            d = DeferredContext(self._kube.list(self._kind, self._selector))
+            self._running = d.result
+            d.addCallback(self._listed)
+            d.addErrback(self._failed)
+            d.addActionFinish()
+
+
+    def _listed(self, collection):
+        objects = {
+            obj.metadata.name: obj
+            for obj
+            in collection.items
+        }
+        old, self._objects = self._objects, objects
+        if self._replaced is not None:
+            self._replaced(list(collection.items))
+        else:
+            for name, obj in objects.items():
+                previous = old.pop(name, None)
+                if previous is None:
+                    self._changed(u"ADDED", obj)
+                elif previous != obj:
+                    self._changed(u"MODIFIED", obj)
+            for obj in old.values():
+                self._changed(u"DELETED", obj)
+
+        self.synced = True
+        self._current()
+        metadata = collection.metadata
+        self._resource_version = None if metadata is None else metadata.resourceVersion
+        self._watch()
+
+
+    def _watch(self):
+        a = start_task(
+            action_type=u"informer:watch",
+            kind=self._kind.kind,
+            resource_version=self._resource_version,
+        )
+        with a.context():
+            d = DeferredContext(self._kube.watch(
+                self._kind,
+                self._namespace,
+                self._labels,
+                self._resource_version,
+                self._event,
+                self._current,
+            ))
+            self._running = d.result
+            d.addCallbacks(
+                lambda ignored: self._watch(),
+                self._watch_failed,
+            )
+            d.addActionFinish()
+
+
+    def _event(self, event):
+        obj = event.object
+        if self._selector.match(obj):
+            if event.type == u"DELETED":
+                self._objects.pop(obj.metadata.name, None)
+            else:
+                self._objects[obj.metadata.name] = obj
+            self._changed(event.type, obj)
+        self._resource_version = obj.metadata.resourceVersion
+        self._current()
+
+
+    def _watch_failed(self, reason):
+        if reason.check(WatchExpired):
+            Message.log(event_type=u"informer:watch-expired", kind=self._kind.kind)
+            self._relist()
+            return None
+        return self._failed(reason)
+
+
+    def _failed(self, reason):
+        if reason.check(CancelledError) or not self.running:
+            return None
+        write_failure(reason)
+        self._delayed = self._reactor.callLater(self._interval, self._relist)
+        return None
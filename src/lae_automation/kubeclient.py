@@ -1,26 +1,95 @@
 # Copyright Least Authority Enterprises.
 # See LICENSE for details.
 
+from json import loads
+
 from twisted.python.url import URL
+from twisted.python.failure import Failure
+from twisted.internet.defer import Deferred, gatherResults, maybeDeferred
+from twisted.internet.protocol import Protocol
+from twisted.web.client import ResponseDone, readBody
+from twisted.web.http import OK, NOT_ALLOWED, GONE
 
 import attr
 import attr.validators
 
+from eliot import start_action
+from eliot.twisted import DeferredContext
+
 from txkube import (
     IKubernetesClient,
     network_kubernetes, authenticate_with_serviceaccount,
 )
+# Private txkube 0.2.0 APIs.  Only ``_TxKubeNetwork`` may use them.
+from txkube._network import check_status, collection_location
+
+@attr.s(frozen=True)
+class _ListQuery(object):
+    """
+    The restrictions of a selector which the Kubernetes API server can apply
+    when listing a collection.
+
+    :ivar unicode namespace: The namespace to list or ``None`` to list all
+        namespaces.
+
+    :ivar dict labels: The labels the listed objects must have.
+
+    :ivar dict label_sets: The labels the listed objects must have with a
+        value from the corresponding ``frozenset``.
+    """
+    namespace = attr.ib(default=None)
+    labels = attr.ib(default=attr.Factory(dict))
+    label_sets = attr.ib(default=attr.Factory(dict))
+
+
 
 @attr.s(frozen=True)
 class LabelSelector(object):
     labels = attr.ib()
 
     def match(self, obj):
+        labels = obj.metadata.labels
+        if labels is None:
+            return not self.labels
         missing = object()
-        return {
-            key: obj.metadata.labels.get(key, missing)
-            for key in self.labels
-        } == self.labels
+        return all(
+            labels.get(key, missing) == value
+            for (key, value)
+            in self.labels.items()
+        )
+
+    def narrow(self, query):
+        for key, value in self.labels.items():
+            if query.labels.get(key, value) != value:
+                return None
+        labels = query.labels.copy()
+        labels.update(self.labels)
+        return attr.assoc(query, labels=labels)
+
+
+
+@attr.s(frozen=True)
+class LabelInSelector(object):
+    """
+    Select objects with a label whose value is one of several.
+    """
+    key = attr.ib()
+    values = attr.ib(convert=frozenset)
+
+    def match(self, obj):
+        labels = obj.metadata.labels
+        if labels is None:
+            return False
+        return labels.get(self.key) in self.values
+
+    def narrow(self, query):
+        values = query.label_sets.get(self.key, self.values) & self.values
+        if not values:
+            # There is no way to ask for nothing.
+            return None
+        label_sets = query.label_sets.copy()
+        label_sets[self.key] = values
+        return attr.assoc(query, label_sets=label_sets)
 
 
 
@@ -28,6 +97,9 @@ class NullSelector(object):
     def match(self, obj):
         return True
 
+    def narrow(self, query):
+        return query
+
 
 
 @attr.s(frozen=True)
@@ -37,6 +109,13 @@ class And(object):
     def match(self, obj):
         return all(s.match(obj) for s in self.selectors)
 
+    def narrow(self, query):
+        for s in self.selectors:
+            if query is None:
+                break
+            query = s.narrow(query)
+        return query
+
 
 
 @attr.s(frozen=True)
@@ -46,6 +125,11 @@ class NamespaceSelector(object):
     def match(self, obj):
         return self.namespace == obj.metadata.namespace
 
+    def narrow(self, query):
+        if query.namespace not in (None, self.namespace):
+            return None
+        return attr.assoc(query, namespace=self.namespace)
+
 
 
 def select(collection, selector):
@@ -53,6 +137,170 @@ def select(collection, selector):
 
 
 
+class WatchExpired(Exception):
+    """
+    The resource version a watch was started from is no longer available
+    (*410 Gone*).  The collection must be listed again to find a new starting
+    point.
+    """
+
+
+
+@attr.s
+class UnexpectedWatchResponse(Exception):
+    """
+    The Kubernetes API server responded to a watch request with something
+    other than a stream of events.
+    """
+    code = attr.ib()
+    body = attr.ib()
+
+
+
+@attr.s(frozen=True)
+class WatchEvent(object):
+    """
+    One change to an object in a watched collection.
+
+    :ivar unicode type: One of ``u"ADDED"``, ``u"MODIFIED"``, or
+        ``u"DELETED"``.
+
+    :ivar IObject object: The state of the object after the change (or, for
+        ``u"DELETED"``, the last state it had).
+    """
+    type = attr.ib()
+    object = attr.ib()
+
+
+
+class _WatchEventsProtocol(Protocol):
+    """
+    Parse the newline-delimited JSON events of a Kubernetes watch response
+    body.
+
+    :ivar _model: The txkube model to use to load objects from events.
+
+    :ivar _handle_event: A one-argument callable to call with each
+        ``WatchEvent`` as it is received.
+
+    :ivar Deferred done: Fires when the response body is complete or fails
+        if the connection is lost or the server reports the watch has
+        expired.
+    """
+    def __init__(self, model, handle_event):
+        self._model = model
+        self._handle_event = handle_event
+        self._buffer = b""
+        self._failure = None
+        self.done = Deferred()
+
+
+    def dataReceived(self, data):
+        lines = (self._buffer + data).split(b"\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            if line.strip():
+                self._line_received(line)
+
+
+    def _line_received(self, line):
+        event = loads(line)
+        if event[u"type"] == u"ERROR":
+            # The object is a v1.Status.  410 Gone means the resourceVersion
+            # we asked for is too old.  Anything else is unexpected.
+            status = event[u"object"]
+            if status.get(u"code") == 410:
+                self._failure = WatchExpired(status.get(u"message"))
+            else:
+                self._failure = UnexpectedWatchResponse(status.get(u"code"), line)
+            self.transport.stopProducing()
+            return
+        self._handle_event(WatchEvent(
+            type=event[u"type"],
+            object=self._model.iobject_from_raw(event[u"object"]),
+        ))
+
+
+    def connectionLost(self, reason):
+        if self._failure is not None:
+            self.done.errback(self._failure)
+        elif reason.check(ResponseDone):
+            self.done.callback(None)
+        else:
+            self.done.errback(reason)
+
+
+
+def _label_selector_query(labels, label_sets={}):
+    return u",".join(list(
+        u"{}={}".format(key, value)
+        for (key, value)
+        in sorted(labels.items())
+    ) + list(
+        u"{} in ({})".format(key, u",".join(sorted(values)))
+        for (key, values)
+        in sorted(label_sets.items())
+    ))
+
+
+
+@attr.s(frozen=True)
+class _TxKubeNetwork(object):
+    """
+    ``_TxKubeNetwork`` issues the requests for which ``IKubernetesClient``
+    has no operation (such as watches and namespaced or paged lists) using
+    the HTTP agent of a txkube client.
+
+    This depends on these private APIs of txkube 0.2.0, which must be checked
+    whenever txkube is upgraded:
+
+      * the ``agent`` and ``kubernetes.base_url`` attributes of the client
+        returned by ``network_kubernetes(...).client()`` (and
+        ``memory_kubernetes().client()``);
+      * ``txkube._network.check_status``;
+      * ``txkube._network.collection_location``.
+
+    :ivar client: The txkube ``IKubernetesClient`` provider.
+    """
+    client = attr.ib()
+
+    @classmethod
+    def of(cls, client):
+        """
+        :return: A ``_TxKubeNetwork`` for ``client`` or ``None`` if ``client``
+            has no HTTP agent.
+        """
+        if getattr(client, "agent", None) is None:
+            return None
+        return cls(client)
+
+    def collection_url(self, kind, namespace=None):
+        """
+        :return URL: The location of the collection of objects of the given
+            kind, either cluster-wide or in one namespace.
+        """
+        segments = collection_location(kind)
+        if namespace is not None:
+            segments = segments[:-1] + (u"namespaces", namespace, segments[-1])
+        return self.client.kubernetes.base_url.child(*segments)
+
+    def request(self, method, url):
+        """
+        :return Deferred: Fires with the ``IResponse`` to the request.
+        """
+        return self.client.agent.request(
+            method, url.asURI().asText().encode("ascii"),
+        )
+
+    def check_status(self, response, expected=(OK,)):
+        """
+        :return Deferred: Fires with ``response`` if it has one of the
+            ``expected`` codes and fails with ``KubernetesError`` otherwise.
+        """
+        return maybeDeferred(check_status, response, expected, self.client.model)
+
+
+
 @attr.s(frozen=True)
 class KubeClient(object):
     k8s = attr.ib(validator=attr.validators.provides(IKubernetesClient))
@@ -67,8 +315,149 @@ class KubeClient(object):
         client = kubernetes.client()
         return cls(k8s=client)
 
+    def list(self, kind, selector=NullSelector()):
+        """
+        List the objects of one kind which match a selector.
+
+        When the underlying client talks to an API server, a selector which
+        picks a namespace lists that namespace's collection (so access to
+        that namespace is enough) and the labels are sent along as a
+        ``labelSelector`` so the server only sends back the matching objects.
+        They are still matched against the selector here, which costs little
+        once the server has done the filtering and keeps the result right for
+        servers (such as the in-memory one) which ignore the selectors or only
+        serve the cluster-wide collection.
+
+        :param kind: The type of the objects to list (eg ``v1.Pod``).
+
+        :param selector: The objects to include.
+
+        :return Deferred: Fires with the collection of matching objects.
+        """
+        query = selector.narrow(_ListQuery())
+        if query == _ListQuery():
+            return self.k8s.list(kind)
+        if query is None or _TxKubeNetwork.of(self.k8s) is None:
+            d = self.k8s.list(kind)
+        else:
+            d = self._list_query(kind, query)
+            d.addCallback(lambda page: page[0])
+        d.addCallback(
+            lambda collection: collection.set(
+                items=select(collection, selector),
+            ),
+        )
+        return d
+
+    def list_pages(self, kind, selector, handle_page, page_size=500):
+        """
+        List the objects of one kind which match a selector a page at a time.
+
+        Each page is requested using ``limit`` and the ``continue`` token
+        from the previous page so that neither the server nor this process
+        ever has the whole collection in one response.  Clients which cannot
+        be asked for pages (or servers which ignore ``limit``) deliver
+        everything as a single page.
+
+        :param kind: The type of the objects to list (eg ``v1.Pod``).
+
+        :param selector: The objects to include.
+
+        :param handle_page: A one-argument callable to call with a ``list``
+            of the matching objects on each page, in order.
+
+        :param int page_size: The most objects to ask for in one request.
+
+        :return Deferred: Fires with ``None`` after the last page has been
+            handled.
+        """
+        query = selector.narrow(_ListQuery())
+        if query is None or _TxKubeNetwork.of(self.k8s) is None:
+            d = self.k8s.list(kind)
+            d.addCallback(
+                lambda collection: handle_page(select(collection, selector)),
+            )
+            d.addCallback(lambda ignored: None)
+            return d
+
+        a = start_action(
+            action_type=u"kubeclient:list-pages",
+            kind=kind.kind,
+            page_size=page_size,
+        )
+        with a.context():
+            pages = [0]
+            def get_page(token):
+                d = self._list_query(kind, query, page_size, token)
+                d.addCallback(got_page)
+                return d
+            def got_page(page):
+                collection, token = page
+                pages[0] += 1
+                handle_page(select(collection, selector))
+                if token:
+                    return get_page(token)
+                a.add_success_fields(pages=pages[0])
+                return None
+            return DeferredContext(get_page(None)).addActionFinish()
+
+    def _list_query(self, kind, query, limit=None, token=None):
+        """
+        Issue one list request.
+
+        If the server does not allow listing a namespace's collection (as the
+        in-memory one does not), the whole of the cluster-wide collection is
+        listed instead.
+
+        :return Deferred: Fires with a two-tuple of the collection and the
+            token with which to request the next page (``None`` if this was
+            the last one).
+        """
+        a = start_action(
+            action_type=u"kubeclient:list",
+            kind=kind.kind,
+            namespace=query.namespace,
+            labels=query.labels,
+        )
+        with a.context():
+            network = _TxKubeNetwork.of(self.k8s)
+            url = network.collection_url(kind, query.namespace)
+            if query.labels or query.label_sets:
+                url = url.add(
+                    u"labelSelector",
+                    _label_selector_query(query.labels, query.label_sets),
+                )
+            if limit is not None:
+                url = url.add(u"limit", u"{}".format(limit))
+            if token is not None:
+                url = url.add(u"continue", token)
+            d = DeferredContext(network.request(b"GET", url))
+            def got_response(response):
+                if response.code == NOT_ALLOWED and query.namespace is not None:
+                    d = readBody(response)
+                    d.addCallback(lambda ignored: self.k8s.list(kind))
+                    d.addCallback(lambda collection: (collection, None))
+                    return d
+                d = network.check_status(response)
+                d.addCallback(readBody)
+                d.addCallback(lambda body: self._load_page(loads(body)))
+                return d
+            d.addCallback(got_response)
+            return d.addActionFinish()
+
+    def _load_page(self, raw):
+        # The model's ListMeta predates paging and rejects the fields which
+        # describe it.
+        metadata = raw.get(u"metadata") or {}
+        token = metadata.pop(u"continue", None)
+        metadata.pop(u"remainingItemCount", None)
+        return self.k8s.model.iobject_from_raw(raw), token
+
     def select(self, kind, selector):
-        return self.k8s.list(kind).addCallback(select, selector)
+        items = []
+        d = self.list_pages(kind, selector, items.extend)
+        d.addCallback(lambda ignored: items)
+        return d
 
     def get_configmaps(self, selector=NullSelector()):
         return self.select(self.k8s.model.v1.ConfigMap, selector)
@@ -85,11 +474,162 @@ class KubeClient(object):
     def get_pods(self, selector=NullSelector()):
         return self.select(self.k8s.model.v1.Pod, selector)
 
+    def get(self, obj):
+        return self.k8s.get(obj)
+
     def delete(self, obj):
         return self.k8s.delete(obj)
 
+    def delete_collection(self, kind, selector):
+        """
+        Delete the objects of one kind which match a selector.
+
+        When the underlying client talks to an API server and the selector
+        picks a namespace, this is a single *deletecollection* request with
+        the selector sent along as a ``labelSelector``.  Otherwise (or if the
+        server does not allow the request, as the in-memory one does not) the
+        matching objects are listed and deleted one by one.
+
+        :param kind: The type of the objects to delete (eg ``v1.Pod``).
+
+        :param selector: The objects to delete.
+
+        :return Deferred: Fires with ``None`` when the objects have been
+            deleted.
+        """
+        query = selector.narrow(_ListQuery())
+        network = _TxKubeNetwork.of(self.k8s)
+        if query is None or query.namespace is None or network is None:
+            return self._delete_each(kind, selector)
+
+        a = start_action(
+            action_type=u"kubeclient:delete-collection",
+            kind=kind.kind,
+            namespace=query.namespace,
+            labels=_label_selector_query(query.labels, query.label_sets),
+        )
+        with a.context():
+            url = network.collection_url(kind, query.namespace)
+            if query.labels or query.label_sets:
+                url = url.add(
+                    u"labelSelector",
+                    _label_selector_query(query.labels, query.label_sets),
+                )
+            d = DeferredContext(network.request(b"DELETE", url))
+            def got_response(response):
+                if response.code == NOT_ALLOWED:
+                    d = readBody(response)
+                    d.addCallback(
+                        lambda ignored: self._delete_each(kind, selector),
+                    )
+                    return d
+                d = network.check_status(response)
+                d.addCallback(readBody)
+                d.addCallback(lambda ignored: None)
+                return d
+            d.addCallback(got_response)
+            return d.addActionFinish()
+
+    def _delete_each(self, kind, selector):
+        d = self.select(kind, selector)
+        d.addCallback(
+            lambda objects: gatherResults(
+                list(self.delete(obj) for obj in objects),
+                consumeErrors=True,
+            ),
+        )
+        d.addCallback(lambda ignored: None)
+        return d
+
     def create(self, obj):
         return self.k8s.create(obj)
 
     def replace(self, obj):
         return self.k8s.replace(obj)
+
+    def watch(
+            self, kind, namespace, labels, resource_version, handle_event,
+            established=lambda: None,
+    ):
+        """
+        Watch a collection for changes.
+
+        ``IKubernetesClient`` has no watch operation so this issues the
+        request using the agent of the underlying network client directly
+        (see ``_TxKubeNetwork``).
+
+        :param kind: The type of the objects to watch (eg ``v1.Pod``).
+
+        :param unicode namespace: The namespace in which to watch.
+
+        :param dict labels: Only watch objects with these labels.
+
+        :param unicode resource_version: The version of the collection from
+            which to start watching, typically taken from the metadata of a
+            previous list.  Only changes after this version are reported.
+
+        :param handle_event: A one-argument callable to call with each
+            ``WatchEvent``.
+
+        :param established: A no-argument callable to call when the server
+            has accepted the watch, before any events are handled.
+
+        :return Deferred: Fires with ``None`` when the server ends the watch
+            (it does so periodically).  Fails with ``WatchExpired`` if
+            ``resource_version`` is too old.  The watch can be stopped by
+            cancelling this ``Deferred``.
+        """
+        a = start_action(
+            action_type=u"kubeclient:watch",
+            kind=kind.kind,
+            namespace=namespace,
+            resource_version=resource_version,
+        )
+        with a.context():
+            network = _TxKubeNetwork(self.k8s)
+            url = network.collection_url(kind, namespace).add(
+                u"watch", u"true",
+            ).add(
+                u"labelSelector", _label_selector_query(labels),
+            )
+            if resource_version is not None:
+                url = url.add(u"resourceVersion", resource_version)
+
+            protocol = _WatchEventsProtocol(self.k8s.model, handle_event)
+            requesting = []
+            def cancel(ignored):
+                if protocol.transport is None:
+                    requesting[0].cancel()
+                else:
+                    protocol.transport.stopProducing()
+            done = Deferred(cancel)
+            def finished(result):
+                # A cancelled watch has already fired ``done``.
+                if not done.called:
+                    done.callback(result)
+            protocol.done.addBoth(finished)
+
+            def got_response(response):
+                if response.code == GONE:
+                    # Some servers report an expired resource version in
+                    # response to the request rather than in the stream.
+                    d = readBody(response)
+                    d.addCallback(
+                        lambda body: finished(Failure(WatchExpired(body))),
+                    )
+                    return d
+                if response.code != OK:
+                    d = readBody(response)
+                    d.addCallback(
+                        lambda body: finished(Failure(
+                            UnexpectedWatchResponse(response.code, body),
+                        )),
+                    )
+                    return d
+                established()
+                response.deliverBody(protocol)
+            d = network.request(b"GET", url)
+            requesting.append(d)
+            d.addCallback(got_response)
+            d.addErrback(finished)
+            return DeferredContext(done).addActionFinish()
@@ -6,6 +6,8 @@ from attr import validators
 
 from pem import parse
 
+from pyrsistent import PMap, pmap
+
 from twisted.python.url import URL
 
 from foolscap.pb import Tub
@@ -20,6 +22,37 @@ validate_furl = all(
 
 
 
+def _positive(inst, attribute, value):
+    if value is not None and value <= 0:
+        raise ValueError(
+            "{} must be positive, not {!r}".format(attribute.name, value),
+        )
+
+
+
+@attr.s(frozen=True)
+class RouterLimits(object):
+    """
+    Limits the grid router enforces on the connections it proxies for one
+    subscription.  ``None`` means no limit.
+
+    :ivar int bandwidth: The maximum rate, in bytes per second, at which to
+        proxy data in both directions combined.
+
+    :ivar int connections: The maximum number of connections to proxy at
+        once.
+    """
+    bandwidth = attr.ib(
+        default=None,
+        validator=all(attr.validators.optional(attr.validators.instance_of(int)), _positive),
+    )
+    connections = attr.ib(
+        default=None,
+        validator=all(attr.validators.optional(attr.validators.instance_of(int)), _positive),
+    )
+
+
+
 @attr.s(frozen=True)
 class DeploymentConfiguration(object):
     domain = attr.ib(validator=attr.validators.instance_of(unicode))
@@ -53,6 +86,22 @@ class DeploymentConfiguration(object):
     log_gatherer_furl = attr.ib(default=None, validator=attr.validators.optional(validate_furl))
     stats_gatherer_furl = attr.ib(default=None, validator=attr.validators.optional(validate_furl))
 
+    # A mapping from plan identifier to the RouterLimits for subscriptions on
+    # that plan.  Plans not included are not limited.
+    router_limits = attr.ib(
+        default=pmap(),
+        convert=pmap,
+        validator=attr.validators.instance_of(PMap),
+    )
+
+    # The greatest number of existing customer grid deployments the
+    # subscription converger will change (restarting their pods) in one pass
+    # of convergence.  ``None`` for no limit.
+    max_disruption = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(int)),
+    )
+
 
 class NullDeploymentConfiguration(object):
     domain = None
@@ -67,6 +116,9 @@ class NullDeploymentConfiguration(object):
     log_gatherer_furl = None
     stats_gatherer_furl = None
 
+    router_limits = pmap()
+    max_disruption = None
+
 
 
 def _parse(pem_str):
@@ -0,0 +1,218 @@
+# Copyright Least Authority Enterprises.
+# See LICENSE for details.
+
+"""
+Divide the work of converging subscriptions between several converger
+replicas.
+
+Each replica records itself in a shared ConfigMap along with a time after
+which it is considered gone unless it records itself again.  The replicas
+found there are the members of the group.  Each subscription is owned by
+one member, chosen by rendezvous hashing of the subscription identifier, so
+when a member joins or leaves only the subscriptions it gains or loses move.
+The member with the lowest identity is the leader and also looks after the
+infrastructure shared by all subscriptions.
+"""
+
+from hashlib import sha256
+
+import attr
+
+from eliot import Message, start_action, write_failure
+from eliot.twisted import DeferredContext
+
+from twisted.internet.task import LoopingCall
+from twisted.application.service import Service
+from twisted.web.http import NOT_FOUND
+
+from txkube import KubernetesError
+
+# The name of the ConfigMap in which the members of the group record
+# themselves.
+SHARD_CONFIGMAP_NAME = u"s4-converger-shards"
+
+
+
+def shard_owner(subscription_id, members):
+    """
+    Choose the member which owns a subscription.
+
+    :param unicode subscription_id: The subscription.
+
+    :param members: The identities of the members of the group.
+
+    :return unicode: The identity of the owner.
+    """
+    sid = subscription_id.encode("utf-8")
+    return max(
+        members,
+        key=lambda member: sha256(member.encode("utf-8") + b"\0" + sid).digest(),
+    )
+
+
+
+@attr.s(frozen=True)
+class Shard(object):
+    """
+    The part of the work one member of the group is responsible for.
+
+    :ivar unicode identity: The member's identity.
+
+    :ivar tuple members: The sorted identities of all of the members,
+        including this one.
+    """
+    identity = attr.ib()
+    members = attr.ib(convert=lambda members: tuple(sorted(members)))
+
+    @property
+    def leader(self):
+        """
+        Whether this member is responsible for shared infrastructure.
+        """
+        return self.identity == self.members[0]
+
+
+    def owns(self, subscription_id):
+        """
+        :return bool: Whether this member is responsible for the subscription.
+        """
+        return shard_owner(subscription_id, self.members) == self.identity
+
+
+
+class ShardMembership(Service):
+    """
+    ``ShardMembership`` keeps one member's record in the shared ConfigMap up
+    to date and reports the current members.
+
+    The ConfigMap maps each member's identity to the time (in seconds since
+    the epoch) its record expires.  Every update replaces the ConfigMap at
+    the version which was read so that concurrent updates by other members
+    fail rather than being lost.  Expiry times are compared with this
+    member's clock so the clocks of the members should roughly agree.
+
+    While the service is running, the record is renewed three times per
+    ``_ttl`` so it only expires if several heartbeats in a row fail.
+
+    :ivar _ttl: How long (in seconds) a record lasts.
+
+    :ivar _shard: The ``Shard`` found by the most recent successful
+        heartbeat or ``None`` if there has not been one.
+
+    :ivar _expires: The time at which the record written by the most recent
+        successful heartbeat expires.
+    """
+    def __init__(self, clock, kube, namespace, identity, ttl):
+        self._clock = clock
+        self._kube = kube
+        self._namespace = namespace
+        self._identity = identity
+        self._ttl = ttl
+        self._members = None
+        self._shard = None
+        self._expires = None
+        self._loop = None
+
+
+    @property
+    def shard(self):
+        """
+        This member's ``Shard`` or ``None`` if it is not known whether this
+        member is still in the group.
+        """
+        if self._expires is None or self._clock.seconds() >= self._expires:
+            return None
+        return self._shard
+
+
+    def startService(self):
+        Service.startService(self)
+        self._loop = LoopingCall(self._beat)
+        self._loop.clock = self._clock
+        self._loop.start(self._ttl / 3.0, now=True)
+
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+
+    def _beat(self):
+        d = self.heartbeat()
+        d.addErrback(write_failure)
+        return d
+
+
+    def heartbeat(self):
+        """
+        Record this member again and find the other members.
+
+        :return Deferred(Shard): Fires with this member's shard once its
+            record has been written.
+        """
+        a = start_action(
+            action_type=u"shard-membership:heartbeat",
+            identity=self._identity,
+        )
+        with a.context():
+            model = self._kube.k8s.model
+            d = DeferredContext(self._kube.get(model.v1.ConfigMap(
+                metadata=dict(
+                    namespace=self._namespace, name=SHARD_CONFIGMAP_NAME,
+                ),
+            )))
+            def missing(reason):
+                reason.trap(KubernetesError)
+                if reason.value.code != NOT_FOUND:
+                    return reason
+                return None
+            d.addErrback(missing)
+            d.addCallback(self._update)
+            return d.addActionFinish()
+
+
+    def _update(self, configmap):
+        now = self._clock.seconds()
+        own_expires = now + self._ttl
+        members = {self._identity: own_expires}
+        if configmap is not None:
+            for (identity, expires) in (configmap.data or {}).items():
+                try:
+                    expires = float(expires)
+                except ValueError:
+                    continue
+                if identity != self._identity and expires > now:
+                    members[identity] = expires
+
+        data = {
+            identity: u"{:.3f}".format(expires)
+            for (identity, expires)
+            in members.items()
+        }
+        model = self._kube.k8s.model
+        if configmap is None:
+            d = self._kube.create(model.v1.ConfigMap(
+                metadata=dict(
+                    namespace=self._namespace, name=SHARD_CONFIGMAP_NAME,
+                ),
+                data=data,
+            ))
+        else:
+            d = self._kube.replace(configmap.set(data=data))
+
+        shard = Shard(identity=self._identity, members=members)
+        def written(ignored):
+            if shard.members != self._members:
+                Message.log(
+                    event_type=u"shard-membership:changed",
+                    members=list(shard.members),
+                    leader=shard.leader,
+                )
+                self._members = shard.members
+            self._shard = shard
+            self._expires = own_expires
+            return shard
+        d.addCallback(written)
+        return d
@@ -11,57 +11,91 @@ subscriptions.  If Kubernetes configuration is found which relates to
 inactive subscriptions, it is removed.  If subscriptions are found
 with no corresponding Kubernetes configuration, such is added for
 them.
+
+With ``--event-driven``, the loop instead runs only occasionally, as a full
+resync.  In between, Kubernetes watches and the subscription manager's
+change feed tell the service which subscriptions may need attention and only
+those are converged.
+
+With ``--shard-identity``, several replicas of the service share the work,
+each converging the subscriptions it owns according to ``sharding``.
+
+With ``--leader-identity``, several replicas of the service run but only the
+one holding a lease (see ``election``) converges.  With ``--event-driven``
+the others keep their caches up to date so they can take over without
+loading everything again.
 """
 
 from os import environ
+from sys import stdout
+from json import dumps, loads
+from xml.etree.ElementTree import XML, ParseError
 from functools import partial
+from collections import deque
 from hashlib import sha256
 
 import attr
-from pyrsistent import PClass, field
+from pyrsistent import PClass, field, pmap, pset
+
+from prometheus_client import Gauge, Histogram
 
 from eliot import Message, start_action, write_failure
 from eliot.twisted import DeferredContext
 
 from twisted.internet.defer import (
-    Deferred, maybeDeferred, gatherResults, succeed,
+    Deferred, DeferredLock, maybeDeferred, gatherResults, succeed,
 )
 from twisted.internet import task
-from twisted.application.service import MultiService
+from twisted.application.service import Service, MultiService
 from twisted.application.internet import TimerService
 from twisted.python.usage import Options as _Options, UsageError
 from twisted.python.filepath import FilePath
+from twisted.python.failure import Failure
 from twisted.python.url import URL
 from twisted.web.client import Agent
 
 from txaws.credentials import AWSCredentials
 from txaws.service import AWSServiceRegion
 from txaws.route53.model import (
-    Name, CNAME, RRSetKey, RRSet, delete_rrset, create_rrset, upsert_rrset,
+    Name, CNAME, RRSetKey, RRSet, delete_rrset, upsert_rrset,
 )
+from txaws.route53.client import Route53Error
 
+from lae_util import prometheus_exporter, retry_failure, backoff
 from lae_util.service import AsynchronousService
+from lae_util.k8s import merge_patch, apply_merge_patch
 from lae_util.fluentd_destination import (
     opt_eliot_destination,
     eliot_logging_service,
 )
 
-from .model import DeploymentConfiguration
+from .model import DeploymentConfiguration, RouterLimits
 from .subscription_manager import Client as SMClient
 from .containers import (
     CONTAINERIZED_SUBSCRIPTION_VERSION,
     CUSTOMER_METADATA_LABELS,
+    CONFIGURATION_HASH_ANNOTATION,
+    ROUTER_LIMIT_ANNOTATIONS,
     autopad_b32decode,
+    configuration_hash,
     configmap_name,
     deployment_name,
+    subscription_label,
     configmap_public_host,
     create_configuration,
     create_deployment,
     new_service,
+    retain_rendered,
+    router_limit_annotations,
 )
 from .initialize import create_user_bucket
 from .signup import get_bucket_name
-from .kubeclient import KubeClient, And, LabelSelector, NamespaceSelector
+from .kubeclient import (
+    KubeClient, And, LabelSelector, LabelInSelector, NamespaceSelector,
+)
+from .informer import Informer
+from .sharding import ShardMembership
+from .election import LeaderElection
 
 from txkube import (
     network_kubernetes, authenticate_with_serviceaccount,
@@ -69,6 +103,26 @@ from txkube import (
 )
 
 
+# The things converge jobs make changes to.  Each has its own concurrency
+# limit.
+_KUBERNETES = u"kubernetes"
+_ROUTE53 = u"route53"
+_S3 = u"s3"
+
+# Kubernetes handles concurrent requests well.  Route53 allows only a few
+# requests per second for each account and rejects a change to a zone while
+# another is still being applied.
+_DEFAULT_CONCURRENCY = {
+    _KUBERNETES: 8,
+    _ROUTE53: 1,
+    _S3: 4,
+}
+
+# The name of the ConfigMap holding the lease of the converger replica which
+# converges.
+LEADER_CONFIGMAP_NAME = u"s4-subscription-converger-leader"
+
+
 def _kubernetes_from_environ(environ):
     try:
         host = environ[u"KUBERNETES_SERVICE_HOST"]
@@ -135,7 +189,106 @@ class Options(_Options, KubernetesClientOptionsMixin):
         ("introducer-image", None, None, "The Docker image to run a Tahoe-LAFS introducer."),
         ("storageserver-image", None, None, "The Docker image to run a Tahoe-LAFS storage server."),
 
-        ("interval", None, 10.0, "The interval (in seconds) at which to iterate on convergence.", float),
+        ("interval", None, 10.0,
+         "The interval (in seconds) at which to iterate on convergence.  "
+         "With --event-driven, the interval between full resyncs.",
+         float,
+        ),
+
+        ("max-interval", None, 300.0,
+         "The longest interval (in seconds) to back off to while convergence "
+         "keeps failing.",
+         float,
+        ),
+
+        ("shard-identity", None, None,
+         "Share the work with the other converger replicas given an "
+         "identity, each converging only some of the subscriptions.  Give "
+         "each replica a different identity (eg its pod name).",
+        ),
+
+        ("shard-ttl", None, None,
+         "With --shard-identity, how long (in seconds) a replica is still "
+         "given work after it was last heard from.  Each replica is heard "
+         "from three times in this period.  The default is three times "
+         "--interval.",
+         float,
+        ),
+
+        ("leader-identity", None, None,
+         "Run as one of several converger replicas of which only the one "
+         "holding a lease converges.  Give each replica a different "
+         "identity (eg its pod name).",
+        ),
+
+        ("lease-duration", None, 30.0,
+         "With --leader-identity, how long (in seconds) a lease lasts "
+         "without being renewed.  A standby replica takes over within this "
+         "long of the leader going away.",
+         float,
+        ),
+
+        ("zone-refresh-interval", None, 300.0,
+         "The interval (in seconds) at which to reload the Route53 zone.  In "
+         "between, the zone is assumed to change only as the converger "
+         "changes it.",
+         float,
+        ),
+
+        ("bucket-refresh-interval", None, 3600.0,
+         "The interval (in seconds) at which to list the S3 buckets again.  In "
+         "between, buckets are assumed to be created only by the converger.",
+         float,
+        ),
+
+        ("change-interval", None, 1.0,
+         "With --event-driven, the interval (in seconds) at which to check "
+         "the subscription manager for changed subscriptions.",
+         float,
+        ),
+
+        ("router-limits", None, None,
+         "The path of a JSON file mapping plan identifiers to the limits the "
+         "grid router enforces for subscriptions on that plan.  For example, "
+         '{"plan": {"bandwidth": 1048576, "connections": 50}} limits each '
+         "subscription on \"plan\" to 1 MiB/s and 50 concurrent connections.",
+        ),
+
+        ("kubernetes-concurrency", None, _DEFAULT_CONCURRENCY[_KUBERNETES],
+         "The greatest number of Kubernetes changes to make at once.",
+         int,
+        ),
+        ("route53-concurrency", None, _DEFAULT_CONCURRENCY[_ROUTE53],
+         "The greatest number of Route53 changes to make at once.",
+         int,
+        ),
+        ("s3-concurrency", None, _DEFAULT_CONCURRENCY[_S3],
+         "The greatest number of S3 changes to make at once.",
+         int,
+        ),
+
+        ("max-disruption", None, 10,
+         "The greatest number of existing customer grids to update in one "
+         "pass of convergence.  Each update restarts the grid's pods.  The "
+         "rest are updated by later passes.",
+         int,
+        ),
+
+        ("metrics-port", None, None,
+         "A server endpoint description string on which to run a "
+         "metrics-exposing server.  By default, metrics are not exposed.",
+        ),
+    ]
+
+    optFlags = [
+        ("event-driven", None,
+         "Converge the subscriptions affected by each change as it happens "
+         "and only converge everything every --interval seconds.",
+        ),
+        ("plan-only", None,
+         "Work out the changes one convergence pass would make, write them "
+         "to stdout as JSON and exit without making them.",
+        ),
     ]
 
     opt_eliot_destination = opt_eliot_destination
@@ -149,6 +302,46 @@ class Options(_Options, KubernetesClientOptionsMixin):
             raise UsageError("--endpoint is required")
         if self["endpoint"].endswith("/"):
             self["endpoint"] = self["endpoint"][:-1]
+        self["router-limits"] = _load_router_limits(self["router-limits"])
+        for target in [_KUBERNETES, _ROUTE53, _S3]:
+            if self[target + "-concurrency"] < 1:
+                raise UsageError("--{}-concurrency must be at least 1".format(target))
+        if self["max-disruption"] < 1:
+            raise UsageError("--max-disruption must be at least 1")
+        if self["shard-identity"] is not None and self["event-driven"]:
+            raise UsageError("--shard-identity cannot be used with --event-driven")
+        if self["shard-identity"] is not None and self["leader-identity"] is not None:
+            raise UsageError("--shard-identity cannot be used with --leader-identity")
+        if self["shard-ttl"] is None:
+            self["shard-ttl"] = 3 * self["interval"]
+
+
+
+def _load_router_limits(path):
+    """
+    Read the grid router limits for each plan.
+
+    :param path: The path of a JSON file as described by the
+        ``--router-limits`` option or ``None`` to have no limits.
+
+    :raise UsageError: If the file does not contain valid limits.
+
+    :return: A ``dict`` mapping plan identifiers to ``RouterLimits``.
+    """
+    if path is None:
+        return {}
+    try:
+        return {
+            plan: RouterLimits(**{
+                key.encode("ascii"): value
+                for (key, value)
+                in limits.items()
+            })
+            for (plan, limits)
+            in loads(FilePath(path).getContent()).items()
+        }
+    except (IOError, ValueError, TypeError, AttributeError) as e:
+        raise UsageError("Invalid --router-limits {}: {}".format(path, e))
 
 
 
@@ -171,6 +364,11 @@ def makeService(options):
         cooperator=task,
     )
 
+    if options["metrics-port"] is not None:
+        prometheus_exporter(
+            reactor, options["metrics-port"],
+        ).setServiceParent(parent)
+
     kubernetes = options.get_kubernetes_service(reactor)
 
     def get_k8s_client():
@@ -179,6 +377,7 @@ def makeService(options):
             _finish_convergence_service,
             options,
             subscription_client,
+            reactor,
         )
         return d
 
@@ -190,16 +389,20 @@ def makeService(options):
 
 
 
-def _finish_convergence_service(k8s_client, options, subscription_client):
+def _finish_convergence_service(k8s_client, options, subscription_client, reactor):
     k8s = KubeClient(k8s=k8s_client)
 
     access_key_id = FilePath(options["aws-access-key-id-path"]).getContent().strip()
     secret_access_key = FilePath(options["aws-secret-access-key-path"]).getContent().strip()
 
-    aws = AWSServiceRegion(creds=AWSCredentials(
-        access_key=access_key_id,
-        secret_key=secret_access_key,
-    ))
+    aws = _CachingRegion(
+        AWSServiceRegion(creds=AWSCredentials(
+            access_key=access_key_id,
+            secret_key=secret_access_key,
+        )),
+        _ZoneCache(reactor, options["zone-refresh-interval"]),
+        _BucketCache(reactor, options["bucket-refresh-interval"]),
+    )
 
     Message.log(
         event=u"convergence-service:key-notification",
@@ -223,16 +426,81 @@ def _finish_convergence_service(k8s_client, options, subscription_client):
 
         log_gatherer_furl=None,
         stats_gatherer_furl=None,
+
+        router_limits=options["router-limits"],
+        max_disruption=options["max-disruption"],
     )
 
-    return TimerService(
+    concurrency = {
+        target: options[target + "-concurrency"]
+        for target in [_KUBERNETES, _ROUTE53, _S3]
+    }
+
+    if options["plan-only"]:
+        return _PlanService(
+            reactor,
+            partial(plan, config, subscription_client, k8s, aws, reactor),
+            stdout,
+        )
+
+    election = None
+    if options["leader-identity"] is not None:
+        election = LeaderElection(
+            reactor,
+            k8s,
+            config.kubernetes_namespace,
+            LEADER_CONFIGMAP_NAME,
+            options["leader-identity"].decode("ascii"),
+            options["lease-duration"],
+        )
+
+    if options["event-driven"]:
+        return _EventDrivenConvergence(
+            reactor,
+            options["interval"],
+            options["change-interval"],
+            config,
+            subscription_client,
+            k8s,
+            aws,
+            concurrency,
+            election,
+        )
+
+    membership = None
+    if options["shard-identity"] is not None:
+        membership = ShardMembership(
+            reactor,
+            k8s,
+            config.kubernetes_namespace,
+            options["shard-identity"].decode("ascii"),
+            options["shard-ttl"],
+        )
+        converge_once = partial(
+            _converge_shard, membership,
+            config, subscription_client, k8s, aws, concurrency, reactor,
+        )
+    else:
+        converge_once = partial(
+            converge, config, subscription_client, k8s, aws, concurrency, reactor,
+        )
+
+    if election is not None:
+        converge_once = partial(_when_leader, election, converge_once)
+
+    scheduler = _ConvergeScheduler(
+        reactor,
         options["interval"],
-        divert_errors_to_log(converge, u"subscription_converger"),
-        config,
-        subscription_client,
-        k8s,
-        aws,
+        options["max-interval"],
+        converge_once,
     )
+    if election is None and membership is None:
+        return scheduler
+    parent = MultiService()
+    for service in [election, membership, scheduler]:
+        if service is not None:
+            service.setServiceParent(parent)
+    return parent
 
 def divert_errors_to_log(f, scope):
     def g(*a, **kw):
@@ -286,12 +554,44 @@ def get_customer_grid_service(k8s, namespace):
 
 
 
+def _load_customer_grid_objects(k8s, namespace, kind, keep=lambda obj: obj):
+    """
+    Load the customer grid objects of one kind a page at a time.
+
+    :param keep: A one-argument callable which takes each loaded object and
+        returns the part of it to keep.  The rest of each page is discarded
+        before the next is loaded.
+
+    :return Deferred: Fires with a ``list`` of whatever ``keep`` returned.
+    """
+    objects = []
+    d = k8s.list_pages(
+        kind,
+        _s4_selector(namespace),
+        lambda page: objects.extend(keep(obj) for obj in page),
+    )
+    d.addCallback(lambda ignored: objects)
+    return d
+
+
+
+def _metadata_only(obj):
+    """
+    Strip everything but the metadata from a Kubernetes object.
+    """
+    return type(obj)(metadata=obj.metadata)
+
+
+
 def get_customer_grid_configmaps(k8s, namespace):
     action = start_action(action_type=u"load-configmaps")
     with action.context():
-        d = DeferredContext(k8s.get_configmaps(_s4_selector(namespace)))
+        # Converging configmaps only involves their metadata so the (large)
+        # Tahoe-LAFS configuration they carry is not kept.
+        d = DeferredContext(_load_customer_grid_objects(
+            k8s, namespace, k8s.k8s.model.v1.ConfigMap, _metadata_only,
+        ))
         def got_configmaps(configmaps):
-            configmaps = list(configmaps)
             action.add_success_fields(configmap_count=len(configmaps))
             return configmaps
         d.addCallback(got_configmaps)
@@ -302,9 +602,10 @@ def get_customer_grid_configmaps(k8s, namespace):
 def get_customer_grid_deployments(k8s, namespace):
     action = start_action(action_type=u"load-deployments")
     with action.context():
-        d = DeferredContext(k8s.get_deployments(_s4_selector(namespace)))
+        d = DeferredContext(_load_customer_grid_objects(
+            k8s, namespace, k8s.k8s.model.v1beta1.Deployment,
+        ))
         def got_deployments(deployments):
-            deployments = list(deployments)
             action.add_success_fields(deployment_count=len(deployments))
             return deployments
         d.addCallback(got_deployments)
@@ -315,9 +616,10 @@ def get_customer_grid_deployments(k8s, namespace):
 def get_customer_grid_replicasets(k8s, namespace):
     action = start_action(action_type=u"load-replicasets")
     with action.context():
-        d = DeferredContext(k8s.get_replicasets(_s4_selector(namespace)))
+        d = DeferredContext(_load_customer_grid_objects(
+            k8s, namespace, k8s.k8s.model.v1beta1.ReplicaSet, _metadata_only,
+        ))
         def got_replicasets(replicasets):
-            replicasets = list(replicasets)
             action.add_success_fields(replicaset_count=len(replicasets))
             return replicasets
         d.addCallback(got_replicasets)
@@ -328,9 +630,10 @@ def get_customer_grid_replicasets(k8s, namespace):
 def get_customer_grid_pods(k8s, namespace):
     action = start_action(action_type=u"load-pods")
     with action.context():
-        d = DeferredContext(k8s.get_pods(_s4_selector(namespace)))
+        d = DeferredContext(_load_customer_grid_objects(
+            k8s, namespace, k8s.k8s.model.v1.Pod,
+        ))
         def got_pods(pods):
-            pods = list(pods)
             action.add_success_fields(pod_count=len(pods))
             return pods
         d.addCallback(got_pods)
@@ -368,9 +671,305 @@ def get_s3_buckets(s3):
 
 
 
+class _BucketState(PClass):
+    """
+    :ivar names: The names of the S3 buckets known to exist.
+
+    :ivar subscriptions: A mapping from subscription identifier to bucket
+        name for each subscription whose bucket is known to exist.
+    """
+    names = field(factory=pset, initial=pset())
+    subscriptions = field(factory=pmap, initial=pmap())
+
+    def confirm(self, subscriptions):
+        """
+        Look for the buckets of subscriptions which do not have a known
+        bucket yet.
+
+        :param subscriptions: A mapping from subscription identifier to
+            ``SubscriptionDetails``.
+
+        :return _BucketState: A state which knows the buckets of any of
+            ``subscriptions`` which exist.
+        """
+        confirmed = {}
+        for sid in set(subscriptions) - set(self.subscriptions):
+            name = get_bucket_name(sid, subscriptions[sid].customer_id)
+            if name in self.names:
+                confirmed[sid] = name
+        if not confirmed:
+            return self
+        return self.set(subscriptions=self.subscriptions.update(confirmed))
+
+
+    def created(self, name):
+        """
+        :return _BucketState: A state which knows the bucket named ``name``
+            exists.
+        """
+        return self.set(names=self.names.add(name))
+
+
+
+class _BucketCache(object):
+    """
+    ``_BucketCache`` keeps track of which S3 buckets exist between
+    convergence passes.
+
+    The buckets are listed when first asked for and again once the listing is
+    ``ttl`` seconds old.  In between, buckets created through a
+    ``_CachingRegion`` are added to the cached state.  Which subscriptions
+    have a bucket is remembered across listings as long as the bucket is
+    still listed.
+
+    :ivar _loaded: The time the buckets were last listed or ``None``.
+
+    :ivar _BucketState _state: The cached state.
+    """
+    def __init__(self, clock, ttl):
+        self._clock = clock
+        self._ttl = ttl
+        self._loaded = None
+        self._state = _BucketState()
+
+
+    def get(self, s3):
+        """
+        :return Deferred(_BucketState): The state of the buckets.
+        """
+        now = self._clock.seconds()
+        if self._loaded is not None and now - self._loaded < self._ttl:
+            return succeed(self._state)
+
+        d = get_s3_buckets(s3)
+        def got_buckets(buckets):
+            names = pset(bucket.name for bucket in buckets)
+            self._loaded = now
+            self._state = _BucketState(
+                names=names,
+                subscriptions={
+                    sid: name
+                    for (sid, name)
+                    in self._state.subscriptions.items()
+                    if name in names
+                },
+            )
+            return self._state
+        d.addCallback(got_buckets)
+        return d
+
+
+    def confirm(self, subscriptions):
+        """
+        Remember which of ``subscriptions`` have a bucket.
+
+        :return _BucketState: The state of the buckets.
+        """
+        self._state = self._state.confirm(subscriptions)
+        return self._state
+
+
+    def invalidate(self):
+        """
+        List the buckets again when next asked for.
+        """
+        self._loaded = None
+
+
+    def created(self, name):
+        """
+        Record that the bucket named ``name`` has been created.
+        """
+        self._state = self._state.created(name)
+
+
+
 class _ZoneState(PClass):
+    """
+    :ivar zone: The ``HostedZone``.
+
+    :ivar rrsets: A mapping from ``RRSetKey`` to ``RRSet`` for everything in
+        the zone.
+
+    :ivar subscriptions: A mapping from subscription identifier to the
+        ``RRSetKey`` of that subscription's rrset.
+    """
     zone = field()
-    rrsets = field()
+    rrsets = field(factory=pmap, initial=pmap())
+    subscriptions = field(factory=pmap, initial=pmap())
+
+    @classmethod
+    def from_rrsets(cls, zone, rrsets):
+        """
+        :return _ZoneState: The state of a zone with the given rrsets.
+        """
+        subscriptions = {}
+        for key in rrsets:
+            subscription_id = _rrset_subscription_id(key, zone.name)
+            if subscription_id is not None:
+                subscriptions[subscription_id] = key
+        return cls(zone=zone, rrsets=rrsets, subscriptions=subscriptions)
+
+
+    def apply(self, changes):
+        """
+        :param changes: The ``IRRSetChange`` providers which Route53 accepted
+            for this zone.
+
+        :return _ZoneState: The state of this zone with ``changes`` made.
+        """
+        rrsets = self.rrsets.evolver()
+        subscriptions = self.subscriptions.evolver()
+        for change in changes:
+            key = RRSetKey(label=change.rrset.label, type=change.rrset.type)
+            subscription_id = _rrset_subscription_id(key, self.zone.name)
+            if change.action == u"DELETE":
+                if key in rrsets:
+                    rrsets.remove(key)
+                if subscription_id in subscriptions:
+                    subscriptions.remove(subscription_id)
+            else:
+                rrsets[key] = change.rrset
+                if subscription_id is not None:
+                    subscriptions[subscription_id] = key
+        return self.set(
+            rrsets=rrsets.persistent(),
+            subscriptions=subscriptions.persistent(),
+        )
+
+
+
+class _ZoneCache(object):
+    """
+    ``_ZoneCache`` keeps the state of hosted zones between convergence
+    passes.
+
+    A zone is loaded when it is first asked for and again once what was
+    loaded is ``ttl`` seconds old.  In between, changes which Route53 accepts
+    through a ``_CachingRegion`` are applied to the cached state.
+
+    :ivar dict _zones: A mapping from zone ``Name`` to a two-tuple of the
+        time the zone was loaded and its ``_ZoneState``.
+    """
+    def __init__(self, clock, ttl):
+        self._clock = clock
+        self._ttl = ttl
+        self._zones = {}
+
+
+    def get(self, route53, name):
+        """
+        :return Deferred(_ZoneState): The state of the hosted zone named
+            ``name``.
+        """
+        now = self._clock.seconds()
+        try:
+            loaded, state = self._zones[name]
+        except KeyError:
+            pass
+        else:
+            if now - loaded < self._ttl:
+                return succeed(state)
+
+        d = get_hosted_zone_by_name(route53, name)
+        def got_zone(state):
+            self._zones[name] = (now, state)
+            return state
+        d.addCallback(got_zone)
+        return d
+
+
+    def invalidate(self):
+        """
+        Forget everything so zones are loaded again when next asked for.
+        """
+        self._zones.clear()
+
+
+    def changed(self, zone_id, changes):
+        """
+        Update a cached zone with changes Route53 has accepted.
+        """
+        for name, (loaded, state) in self._zones.items():
+            if state.zone.identifier == zone_id:
+                self._zones[name] = (loaded, state.apply(changes))
+
+
+
+class _CachingRoute53(object):
+    """
+    A Route53 client which tells a ``_ZoneCache`` about the rrset changes it
+    makes.
+    """
+    def __init__(self, route53, zones):
+        self._route53 = route53
+        self._zones = zones
+
+
+    def __getattr__(self, name):
+        return getattr(self._route53, name)
+
+
+    def change_resource_record_sets(self, zone_id, changes):
+        changes = list(changes)
+        d = self._route53.change_resource_record_sets(zone_id, changes)
+        def changed(result):
+            self._zones.changed(zone_id, changes)
+            return result
+        d.addCallback(changed)
+        return d
+
+
+
+class _CachingS3(object):
+    """
+    An S3 client which tells a ``_BucketCache`` about the buckets it creates.
+    """
+    def __init__(self, s3, buckets):
+        self._s3 = s3
+        self._buckets = buckets
+
+
+    def __getattr__(self, name):
+        return getattr(self._s3, name)
+
+
+    def create_bucket(self, bucket):
+        d = self._s3.create_bucket(bucket)
+        def created(result):
+            self._buckets.created(bucket)
+            return result
+        d.addCallback(created)
+        return d
+
+
+
+class _CachingRegion(object):
+    """
+    An ``AWSServiceRegion`` which keeps hosted zone state in a
+    ``_ZoneCache`` and S3 bucket state in a ``_BucketCache``.
+
+    :ivar _ZoneCache zones: The cached hosted zones.
+
+    :ivar _BucketCache buckets: The cached buckets.
+    """
+    def __init__(self, aws, zones, buckets):
+        self._aws = aws
+        self.zones = zones
+        self.buckets = buckets
+
+
+    def __getattr__(self, name):
+        return getattr(self._aws, name)
+
+
+    def get_route53_client(self):
+        return _CachingRoute53(self._aws.get_route53_client(), self.zones)
+
+
+    def get_s3_client(self):
+        return _CachingS3(self._aws.get_s3_client(), self.buckets)
+
 
 
 
@@ -386,7 +985,22 @@ class _State(PClass):
 
 
 
-def _get_converge_inputs(config, subscriptions, k8s, aws):
+def _get_converge_inputs(config, subscriptions, k8s, aws, clock, shard=None):
+    """
+    Load the desired and actual state of everything convergence looks after.
+
+    :param Shard shard: The part of the work to load the state for or
+        ``None`` to load all of it.  Everything is listed in full but only
+        the subscriptions ``shard`` owns are looked at further.
+
+    The other parameters are as for ``converge``.
+
+    :return Deferred(_State): The state.
+    """
+    if not isinstance(aws, _CachingRegion):
+        # Load everything afresh.
+        aws = _CachingRegion(aws, _ZoneCache(clock, 0), _BucketCache(clock, 0))
+
     a = start_action(action_type=u"load-converge-inputs")
     with a.context():
         d = DeferredContext(
@@ -397,8 +1011,8 @@ def _get_converge_inputs(config, subscriptions, k8s, aws):
                 get_customer_grid_replicasets(k8s, config.kubernetes_namespace),
                 get_customer_grid_pods(k8s, config.kubernetes_namespace),
                 get_customer_grid_service(k8s, config.kubernetes_namespace),
-                get_hosted_zone_by_name(aws.get_route53_client(), Name(config.domain)),
-                get_s3_buckets(aws.get_s3_client()),
+                aws.zones.get(aws.get_route53_client(), Name(config.domain)),
+                aws.buckets.get(aws.get_s3_client()),
             ]),
         )
         d.addCallback(
@@ -416,45 +1030,79 @@ def _get_converge_inputs(config, subscriptions, k8s, aws):
                 ),
             )),
         )
+        if shard is not None:
+            d.addCallback(_shard_state, shard)
+        d.addCallback(
+            lambda state: state.set(
+                buckets=aws.buckets.confirm(state.subscriptions),
+            ),
+        )
         return d.addActionFinish()
 
 
 @with_action(action_type=u"converge-logic")
-def _converge_logic(actual, config, subscriptions, k8s, aws):
-    convergers = [
-        _converge_s3,
-        _converge_service,
-        _converge_configmaps,
-        _converge_deployments,
-        _converge_replicasets,
-        _converge_pods,
-        _converge_route53_customer,
-        _converge_route53_infrastructure,
-    ]
+def _converge_logic(actual, config, subscriptions, k8s, aws, clock, convergers=None):
+    if convergers is None:
+        convergers = _CONVERGERS
 
     jobs = []
     for converger in convergers:
         with start_action(action_type=converger.func_name):
-            jobs.extend(converger(actual, config, subscriptions, k8s, aws))
+            jobs.extend(converger(actual, config, subscriptions, k8s, aws, clock))
 
     return jobs
 
 
 
+@attr.s(frozen=True)
+class _Job(object):
+    """
+    One change to make to provisioned resources.
+
+    :ivar unicode target: What the change is made to: ``_KUBERNETES``,
+        ``_ROUTE53``, or ``_S3``.  Jobs for the same target share its
+        concurrency limit.
+
+    :ivar run: A no-argument callable which makes the change.  It may return
+        a ``Deferred`` which fires when the change has been made.
+
+    :ivar key: Something hashable identifying the job to jobs which must
+        come after it.  Several jobs may have the same key.
+
+    :ivar frozenset after: The keys of earlier jobs which must finish before
+        this one starts.
+
+    :ivar dict description: A JSON-compatible description of the change, for
+        people to read.
+    """
+    target = attr.ib()
+    run = attr.ib()
+    key = attr.ib(default=None)
+    after = attr.ib(default=frozenset(), convert=frozenset)
+    description = attr.ib(default=None)
+
+
+
 class _Changes(PClass):
     create = field()
     delete = field()
+    update = field(initial=())
 
 
 
-def _compute_changes(desired, actual):
+def _compute_changes(desired, actual, in_place=False):
     """
     Determine what changes to ``actual`` are necessary to agree with
     ``desired``.
+
+    :param bool in_place: If ``True``, things which need an update are
+        updated where they are.  Otherwise they are deleted and created
+        again.
     """
     # Start with the assumption that everything will need to be created.
     to_create = set(sorted(desired.iterkeys()))
     to_delete = set()
+    to_update = set()
 
     # Visit everything in the actual state and determine if it needs to be
     # changed somehow.  Since we started with the assumption that everything
@@ -474,9 +1122,14 @@ def _compute_changes(desired, actual):
 
         if actual.needs_update(subscription):
             # Something about the actual state disagrees with the subscription
-            # state.  Delete the current state and re-create the new state.
+            # state.  Either change it or delete the current state and
+            # re-create the new state.
             Message.log(condition=u"needs-update", subscription=sid)
-            to_delete.add(sid)
+            if in_place:
+                to_update.add(sid)
+                to_create.remove(sid)
+            else:
+                to_delete.add(sid)
         else:
             # It appears to be fine as-is.  Don't delete it and don't create
             # it.
@@ -485,38 +1138,50 @@ def _compute_changes(desired, actual):
     return _Changes(
         create=list(desired[sid] for sid in to_create),
         delete=to_delete,
+        update=list(desired[sid] for sid in sorted(to_update)),
     )
 
 
 
-def _converge_s3(actual, config, subscription, k8s, aws):
+def _converge_s3(actual, config, subscription, k8s, aws, clock):
     buckets = []
-    actual_bucket_names = {bucket.name for bucket in actual.buckets}
-    for subscription in actual.subscriptions.itervalues():
-        bucket_name = get_bucket_name(
-            subscription.subscription_id, subscription.customer_id,
-        )
-        if bucket_name not in actual_bucket_names:
-            Message.log(actor=u"converge-s3", bucket=bucket_name, activity=u"create")
-            buckets.append(bucket_name)
+    # Only subscriptions whose bucket was not found need a look.
+    for sid in set(actual.subscriptions) - set(actual.buckets.subscriptions):
+        subscription = actual.subscriptions[sid]
+        bucket_name = get_bucket_name(sid, subscription.customer_id)
+        Message.log(actor=u"converge-s3", bucket=bucket_name, activity=u"create")
+        buckets.append((sid, bucket_name))
 
     s3 = aws.get_s3_client()
-    from twisted.internet import reactor
-
     return list(
-        lambda n=n: create_user_bucket(reactor, s3, n)
-        for n
+        _Job(
+            target=_S3,
+            run=partial(create_user_bucket, clock, s3, bucket_name),
+            key=(u"bucket", sid),
+            description={
+                u"action": u"create-bucket",
+                u"subscription": sid,
+                u"bucket": bucket_name,
+            },
+        )
+        for (sid, bucket_name)
         in buckets
     )
 
 
 
-def _converge_service(actual, config, subscriptions, k8s, aws):
+def _converge_service(actual, config, subscriptions, k8s, aws, clock):
     create_service = (actual.service is None)
     if create_service:
         service = new_service(config.kubernetes_namespace, k8s.k8s.model)
         # Create it if it was missing.
-        return [lambda: k8s.create(service)]
+        return [
+            _Job(
+                target=_KUBERNETES,
+                run=lambda: k8s.create(service),
+                description={u"action": u"create-service"},
+            ),
+        ]
 
     return []
 
@@ -529,6 +1194,8 @@ class _ChangeableDeployments(PClass):
             for d in deployments
         },
     )
+    # The DeploymentConfiguration the deployments should agree with.
+    config = field()
 
     def itersubscription_ids(self):
         return sorted(self.deployments.iterkeys())
@@ -548,126 +1215,406 @@ class _ChangeableDeployments(PClass):
             subscription.storage_port_number != storage
         ) or (
             deployment.metadata.labels.version != CONTAINERIZED_SUBSCRIPTION_VERSION
+        ) or (
+            # The pods were started with some other configuration.
+            deployment.spec.template.metadata.annotations.get(
+                CONFIGURATION_HASH_ANNOTATION,
+            ) != configuration_hash(self.config, subscription)
+        ) or (
+            # The grid router would enforce some other limits on the pods.
+            _router_limits(deployment.spec.template) !=
+            router_limit_annotations(self.config, subscription)
         )
 
 
 
-def _converge_deployments(actual, config, subscriptions, k8s, aws):
-    # XXX Oh boy there's two more deployment states to deal with. :/ Merely
-    # deleting a deployment doesn't clean up its replicaset (nor its pod,
-    # therefore).  So instead we need to update the deployment with replicas =
-    # 0 and wait for it to settle, and only then delete it.
-    changes = _compute_changes(
-        actual.subscriptions,
-        _ChangeableDeployments(deployments=actual.deployments),
-    )
-    def delete(sid):
-        return k8s.delete(k8s.k8s.model.v1beta1.Deployment(
-            metadata=dict(
-                namespace=config.kubernetes_namespace,
-                name=deployment_name(sid),
-            ),
-        ))
-    def create(subscription):
-        return k8s.create(create_deployment(config, subscription, k8s.k8s.model))
+def _router_limits(obj):
+    """
+    :return dict: The grid router limit annotations on a Kubernetes object.
+    """
+    annotations = obj.metadata.annotations or {}
+    return {
+        name: annotations[name]
+        for name in ROUTER_LIMIT_ANNOTATIONS
+        if name in annotations
+    }
+
+
+
+# The fields of a deployment which are removed when updating it in place if
+# the desired deployment does not have them.  They are the limits of a plan
+# which no longer has them.
+_REMOVABLE_DEPLOYMENT_FIELDS = list(
+    prefix + [u"metadata", u"annotations", name]
+    for prefix in [[], [u"spec", u"template"]]
+    for name in ROUTER_LIMIT_ANNOTATIONS
+)
 
-    deletes = list(partial(delete, sid) for sid in changes.delete)
-    creates = list(partial(create, s) for s in changes.create)
-    return deletes + creates
 
 
-def _converge_replicasets(actual, config, subscriptions, k8s, aws):
-    # We don't ever have to create a ReplicaSet.  We'll just delete the ones
-    # we don't need anymore.
-    deletes = []
-    for replicaset in actual.replicasets:
-        sid = replicaset.metadata.annotations[u"subscription"]
-        if sid not in actual.subscriptions:
-            Message.log(condition=u"undesired", subscription=sid)
-            deletes.append(replicaset.metadata)
+def _limit_disruption(updates, maximum):
+    """
+    Choose the updates to make now without exceeding the maximum disruption.
 
-    def delete(metadata):
-        return k8s.delete(k8s.k8s.model.v1beta1.ReplicaSet(metadata=metadata))
+    :param list updates: The subscriptions whose resources need an update
+        which will disrupt them.
 
-    return list(partial(delete, metadata) for metadata in deletes)
+    :param maximum: The most updates to allow or ``None`` for no limit.
 
+    :return list: The updates to make now.  The rest are left for later
+        passes of convergence.
+    """
+    if maximum is None or len(updates) <= maximum:
+        return updates
+    for subscription in updates[maximum:]:
+        Message.log(
+            condition=u"update-deferred",
+            subscription=subscription.subscription_id,
+        )
+    return updates[:maximum]
 
-def _converge_pods(actual, config, subscriptions, k8s, aws):
-    # We don't ever have to create a Pod.  We'll just delete the ones we don't
-    # need anymore.
-    deletes = []
-    for pod in actual.pods:
-        sid = pod.metadata.annotations[u"subscription"]
-        if sid not in actual.subscriptions:
-            Message.log(condition=u"undesired", subscription=sid)
-            deletes.append(pod.metadata)
 
-    def delete(metadata):
-        return k8s.delete(k8s.k8s.model.v1.Pod(metadata=metadata))
 
-    return list(partial(delete, metadata) for metadata in deletes)
+def _get_path(document, path):
+    for key in path:
+        if not isinstance(document, dict) or key not in document:
+            return None
+        document = document[key]
+    return document
 
 
-class _ChangeableConfigMaps(PClass):
-    configmaps = field(
-        factory=lambda configmaps: {
-            c.metadata.annotations[u"subscription"]: c
-            for c in configmaps
-        },
-    )
 
-    def itersubscription_ids(self):
-        return sorted(self.configmaps.iterkeys())
+def _remove_path(patch, path):
+    """
+    Make a merge patch remove the field at ``path`` as well.
+    """
+    for key in path[:-1]:
+        patch = patch.setdefault(key, {})
+        if not isinstance(patch, dict):
+            # The patch already replaces the whole of this part.
+            return
+    patch[path[-1]] = None
 
 
-    def needs_update(self, subscription):
-        # TODO
-        return False
 
+def update_in_place(k8s, current, desired, removable=()):
+    """
+    Change an existing Kubernetes object so it agrees with a desired one.
 
+    Only the fields ``desired`` specifies are changed.  Everything else
+    (including the resource version, so a concurrent change is detected) is
+    kept from ``current``.
 
-def _converge_configmaps(actual, config, subscriptions, k8s, aws):
-    changes = _compute_changes(
-        actual.subscriptions,
-        _ChangeableConfigMaps(configmaps=actual.configmaps),
-    )
-    def delete(sid):
-        return k8s.delete(k8s.k8s.model.v1.ConfigMap(
-            metadata=dict(
-                namespace=config.kubernetes_namespace,
-                name=configmap_name(sid),
-            ),
-        ))
-    def create(subscription):
-        return k8s.create(create_configuration(config, subscription, k8s.k8s.model))
-    deletes = list(partial(delete, sid) for sid in changes.delete)
-    creates = list(partial(create, s) for s in changes.create)
-    return deletes + creates
+    :param KubeClient k8s: The client with which to make the change.
 
+    :param IObject current: The object as it exists now.
 
+    :param IObject desired: The object as it should be.
 
-def _introducer_domain(domain):
-    """
-    Construct a ``Name`` for the intermediate domain name that glues per-user
-    domain names to the load balancer hostname/address for the grid service.
-    """
-    return Name(u"introducer.{}".format(domain))
+    :param removable: The paths (lists of keys into the raw form of the
+        object) of fields which are removed if ``current`` has them and
+        ``desired`` does not.
+
+    :return Deferred: Fires when the object has been replaced.
+    """
+    model = k8s.k8s.model
+    document = model.iobject_to_raw(current)
+    wanted = model.iobject_to_raw(desired)
+    patch = merge_patch(document, wanted)
+    for path in removable:
+        if _get_path(document, path) is not None and _get_path(wanted, path) is None:
+            _remove_path(patch, path)
+    Message.log(
+        event_type=u"update-in-place",
+        kind=current.kind,
+        name=current.metadata.name,
+        patch=patch,
+    )
+    if not patch:
+        return succeed(None)
+    return k8s.replace(model.iobject_from_raw(apply_merge_patch(document, patch)))
+
+
+
+def _desired_deployment(config, subscription, model):
+    """
+    Create the deployment for a subscription, with its pod template carrying
+    the hash of the configuration the pods should use.
+    """
+    return create_deployment(config, subscription, model).transform(
+        [u"spec", u"template", u"metadata", u"annotations", CONFIGURATION_HASH_ANNOTATION],
+        configuration_hash(config, subscription),
+    )
+
+
+
+def _converge_deployments(actual, config, subscriptions, k8s, aws, clock):
+    # XXX Oh boy there's two more deployment states to deal with. :/ Merely
+    # deleting a deployment doesn't clean up its replicaset (nor its pod,
+    # therefore).  So instead we need to update the deployment with replicas =
+    # 0 and wait for it to settle, and only then delete it.
+    deployments = _ChangeableDeployments(
+        deployments=actual.deployments,
+        config=config,
+    )
+    # Outdated deployments are changed in place, letting Kubernetes roll their
+    # pods over, rather than being deleted and created again.
+    changes = _compute_changes(actual.subscriptions, deployments, in_place=True)
+    def delete(sid):
+        return k8s.delete(k8s.k8s.model.v1beta1.Deployment(
+            metadata=dict(
+                namespace=config.kubernetes_namespace,
+                name=deployment_name(sid),
+            ),
+        ))
+    def create(subscription):
+        return k8s.create(_desired_deployment(config, subscription, k8s.k8s.model))
+    def update(subscription):
+        return update_in_place(
+            k8s,
+            deployments.deployments[subscription.subscription_id],
+            _desired_deployment(config, subscription, k8s.k8s.model),
+            _REMOVABLE_DEPLOYMENT_FIELDS,
+        )
+
+    deletes = list(
+        _Job(
+            target=_KUBERNETES,
+            run=partial(delete, sid),
+            key=(u"delete-deployment", sid),
+            description={u"action": u"delete-deployment", u"subscription": sid},
+        )
+        for sid in changes.delete
+    )
+    creates = list(
+        _Job(
+            target=_KUBERNETES,
+            run=partial(create, s),
+            # The deployment's pods need its configuration and its bucket and
+            # it cannot be created while the old one is still there.
+            after={
+                (u"delete-deployment", s.subscription_id),
+                (u"configmap", s.subscription_id),
+                (u"bucket", s.subscription_id),
+            },
+            description={
+                u"action": u"create-deployment",
+                u"subscription": s.subscription_id,
+            },
+        )
+        for s in changes.create
+    )
+    updates = list(
+        _Job(
+            target=_KUBERNETES,
+            run=partial(update, s),
+            after={(u"configmap", s.subscription_id)},
+            description={
+                u"action": u"update-deployment",
+                u"subscription": s.subscription_id,
+            },
+        )
+        for s in _limit_disruption(changes.update, config.max_disruption)
+    )
+    return deletes + creates + updates
+
+
+# The most subscriptions whose orphaned objects of one kind are deleted by
+# one request.  The selector naming them all has to fit in a URL.
+_ORPHAN_BATCH_SIZE = 100
+
+
+
+def _orphaned_subscriptions(objects, subscriptions):
+    """
+    :param objects: Kubernetes objects belonging to subscriptions.
+
+    :param subscriptions: The identifiers of the active subscriptions.
+
+    :return: A sorted ``list`` of the identifiers of the subscriptions which
+        own some of ``objects`` but are not active.
+    """
+    owners = set(obj.metadata.annotations[u"subscription"] for obj in objects)
+    orphaned = sorted(owners.difference(subscriptions))
+    for sid in orphaned:
+        Message.log(condition=u"undesired", subscription=sid)
+    return orphaned
+
+
+
+def _delete_orphans(k8s, config, kind, orphaned, key, after):
+    """
+    Make jobs which delete the objects of one kind belonging to some
+    subscriptions using one request for each batch of subscriptions.
+
+    :param list orphaned: The identifiers of the subscriptions.
+
+    :param key: The key of each job.
+
+    :param after: A one-argument callable which returns the keys of the
+        jobs which must finish before the objects belonging to a
+        subscription are deleted.
+    """
+    jobs = []
+    for start in range(0, len(orphaned), _ORPHAN_BATCH_SIZE):
+        batch = orphaned[start:start + _ORPHAN_BATCH_SIZE]
+        selector = And([
+            _s4_selector(config.kubernetes_namespace),
+            LabelInSelector(
+                u"subscription",
+                list(subscription_label(sid) for sid in batch),
+            ),
+        ])
+        jobs.append(_Job(
+            target=_KUBERNETES,
+            run=partial(k8s.delete_collection, kind, selector),
+            key=key,
+            after=set(k for sid in batch for k in after(sid)),
+            description={
+                u"action": u"delete-" + kind.kind.lower() + u"s",
+                u"subscriptions": batch,
+            },
+        ))
+    return jobs
+
+
+
+def _converge_replicasets(actual, config, subscriptions, k8s, aws, clock):
+    # We don't ever have to create a ReplicaSet.  We'll just delete the ones
+    # we don't need anymore.  Deleting the deployment first keeps it from
+    # replacing the replicaset.
+    return _delete_orphans(
+        k8s, config, k8s.k8s.model.v1beta1.ReplicaSet,
+        _orphaned_subscriptions(actual.replicasets, actual.subscriptions),
+        key=u"delete-replicasets",
+        after=lambda sid: [(u"delete-deployment", sid)],
+    )
+
+
+def _converge_pods(actual, config, subscriptions, k8s, aws, clock):
+    # We don't ever have to create a Pod.  We'll just delete the ones we don't
+    # need anymore.
+    return _delete_orphans(
+        k8s, config, k8s.k8s.model.v1.Pod,
+        _orphaned_subscriptions(actual.pods, actual.subscriptions),
+        key=None,
+        after=lambda sid: [(u"delete-deployment", sid), u"delete-replicasets"],
+    )
+
+
+
+class _ChangeableConfigMaps(PClass):
+    configmaps = field(
+        factory=lambda configmaps: {
+            c.metadata.annotations[u"subscription"]: c
+            for c in configmaps
+        },
+    )
+    # The DeploymentConfiguration the configmaps should agree with.
+    config = field()
+
+    def itersubscription_ids(self):
+        return sorted(self.configmaps.iterkeys())
+
+
+    def needs_update(self, subscription):
+        configmap = self.configmaps[subscription.subscription_id]
+        return configmap.metadata.annotations.get(
+            CONFIGURATION_HASH_ANNOTATION,
+        ) != configuration_hash(self.config, subscription)
+
+
+
+def _converge_configmaps(actual, config, subscriptions, k8s, aws, clock):
+    configmaps = _ChangeableConfigMaps(
+        configmaps=actual.configmaps,
+        config=config,
+    )
+    # Changing a configmap does not disturb the pods using it.  They are
+    # replaced by the deployment update which follows from the changed
+    # configuration hash.
+    changes = _compute_changes(actual.subscriptions, configmaps, in_place=True)
+    def delete(sid):
+        return k8s.delete(k8s.k8s.model.v1.ConfigMap(
+            metadata=dict(
+                namespace=config.kubernetes_namespace,
+                name=configmap_name(sid),
+            ),
+        ))
+    def create(subscription):
+        return k8s.create(create_configuration(config, subscription, k8s.k8s.model))
+    def update(subscription):
+        return update_in_place(
+            k8s,
+            configmaps.configmaps[subscription.subscription_id],
+            create_configuration(config, subscription, k8s.k8s.model),
+        )
+    deletes = list(
+        _Job(
+            target=_KUBERNETES,
+            run=partial(delete, sid),
+            key=(u"delete-configmap", sid),
+            description={u"action": u"delete-configmap", u"subscription": sid},
+        )
+        for sid in changes.delete
+    )
+    creates = list(
+        _Job(
+            target=_KUBERNETES,
+            run=partial(create, s),
+            key=(u"configmap", s.subscription_id),
+            after={(u"delete-configmap", s.subscription_id)},
+            description={
+                u"action": u"create-configmap",
+                u"subscription": s.subscription_id,
+            },
+        )
+        for s in changes.create
+    )
+    updates = list(
+        _Job(
+            target=_KUBERNETES,
+            run=partial(update, s),
+            key=(u"configmap", s.subscription_id),
+            description={
+                u"action": u"update-configmap",
+                u"subscription": s.subscription_id,
+            },
+        )
+        for s in changes.update
+    )
+    return deletes + creates + updates
+
+
+
+def _introducer_domain(domain):
+    """
+    Construct a ``Name`` for the intermediate domain name that glues per-user
+    domain names to the load balancer hostname/address for the grid service.
+    """
+    return Name(u"introducer.{}".format(domain))
+
+
+
+def _rrset_subscription_id(key, domain):
+    """
+    :return: The identifier of the subscription the rrset with the given
+        ``RRSetKey`` belongs to or ``None`` if it does not belong to one.
+    """
+    if key.type == u"CNAME":
+        subscription_part, rest = key.label.text.split(u".", 1)
+        # XXX Ugh strings
+        if Name(rest) == _introducer_domain(domain):
+            return autopad_b32decode(subscription_part)
+    return None
 
 
 
 class _ChangeableZone(PClass):
-    zone = field()
-    rrsets = field()
-    domain = field()
+    zone = field(type=_ZoneState)
 
     def itersubscription_ids(self):
-        for key in self.rrsets:
-            if key.type == u"CNAME":
-                subscription_part, rest = key.label.text.split(u".", 1)
-                # XXX Ugh strings
-                if Name(rest) == _introducer_domain(self.domain):
-                    subscription_id = autopad_b32decode(subscription_part)
-                    yield subscription_id
+        return sorted(self.zone.subscriptions.iterkeys())
 
 
     def needs_update(self, subscription):
@@ -677,7 +1624,7 @@ class _ChangeableZone(PClass):
 
 
 
-def _converge_route53_customer(actual, config, subscriptions, k8s, aws):
+def _converge_route53_customer(actual, config, subscriptions, k8s, aws, clock):
     """
     Converge on the desired Route53 state relating to individual S4
     subscriptions.
@@ -689,26 +1636,43 @@ def _converge_route53_customer(actual, config, subscriptions, k8s, aws):
     """
     changes = _compute_changes(
         actual.subscriptions,
-        _ChangeableZone(
-            zone=actual.zone.zone,
-            rrsets=actual.zone.rrsets,
-            domain=config.domain,
-        ),
+        _ChangeableZone(zone=actual.zone),
+    )
+    zone = actual.zone.zone
+    # An upsert replaces whatever is there so a subscription being created
+    # needs no delete.
+    created = {s.subscription_id for s in changes.create}
+    rrset_changes = list(
+        delete_rrset(_rrset_for_subscription(sid, zone.name))
+        for sid in sorted(changes.delete - created)
+    ) + list(
+        upsert_rrset(_rrset_for_subscription(s.subscription_id, zone.name))
+        for s in changes.create
     )
-    # XXX Probably would be nice to group changes.  Also, issue changes insert
-    # of delete/create.  Some structured objects would make that easier.
+
     route53 = aws.get_route53_client()
-    def delete(sid):
-        return delete_route53_rrsets(route53, actual.zone.zone, [sid])
-    def create(subscription):
-        return create_route53_rrsets(route53, actual.zone.zone, [subscription])
-    deletes = list(partial(delete, sid) for sid in changes.delete)
-    creates = list(partial(create, s) for s in changes.create)
-    return deletes + creates
+    return list(
+        _Job(
+            target=_ROUTE53,
+            run=partial(change_route53_batch, clock, route53, zone, batch),
+            description={
+                u"action": u"change-rrsets",
+                u"changes": list(
+                    {
+                        u"action": change.action,
+                        u"label": change.rrset.label.text,
+                        u"type": change.rrset.type,
+                    }
+                    for change in batch
+                ),
+            },
+        )
+        for batch in _route53_batches(rrset_changes)
+    )
 
 
 
-def _converge_route53_infrastructure(actual, config, subscriptions, k8s, aws):
+def _converge_route53_infrastructure(actual, config, subscriptions, k8s, aws, clock):
     """
     Converge on the desired Route53 state relating to general S4
     infrastructure.
@@ -740,38 +1704,339 @@ def _converge_route53_infrastructure(actual, config, subscriptions, k8s, aws):
     # Create it or change it to what we want.
     route53 = aws.get_route53_client()
     return [
-        lambda: change_route53_rrsets(route53, actual.zone.zone, desired_rrset),
+        _Job(
+            target=_ROUTE53,
+            run=lambda: change_route53_rrsets(route53, actual.zone.zone, desired_rrset),
+            description={
+                u"action": u"upsert-rrset",
+                u"label": desired_rrset.label.text,
+                u"type": desired_rrset.type,
+            },
+        ),
     ]
 
 
-def _execute_converge_output(jobs):
-    if not jobs:
-        return succeed(None)
+# The convergers which only deal with resources belonging to individual
+# subscriptions.
+_SUBSCRIPTION_CONVERGERS = [
+    _converge_s3,
+    _converge_configmaps,
+    _converge_deployments,
+    _converge_replicasets,
+    _converge_pods,
+    _converge_route53_customer,
+]
+
+_CONVERGERS = [
+    _converge_s3,
+    _converge_service,
+    _converge_configmaps,
+    _converge_deployments,
+    _converge_replicasets,
+    _converge_pods,
+    _converge_route53_customer,
+    _converge_route53_infrastructure,
+]
+
+
+
+_queued_jobs = Gauge(
+    u"subscription_converger_jobs_queued",
+    u"Converge jobs which have not started yet.",
+    [u"target"],
+)
 
-    a = start_action(action_type=u"execute-converge-step")
-    with a.context():
-        job = jobs.pop(0)
-        d = DeferredContext(job())
-        d.addErrback(write_failure)
-        d = d.addActionFinish()
+_running_jobs = Gauge(
+    u"subscription_converger_jobs_in_flight",
+    u"Converge jobs which have started and not finished yet.",
+    [u"target"],
+)
+
+_job_latency = Histogram(
+    u"subscription_converger_job_seconds",
+    u"Time from starting a converge job to its finishing.",
+    [u"target"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float(u"inf")),
+)
+
+
+
+@attr.s(frozen=True)
+class _Outcome(object):
+    """
+    What happened when some converge jobs were run.
+
+    :ivar int jobs: The number of jobs run.
+
+    :ivar int failures: The number of those jobs which failed.
+    """
+    jobs = attr.ib()
+    failures = attr.ib()
+
+
+
+class _JobScheduler(object):
+    """
+    ``_JobScheduler`` runs a batch of converge jobs, as many at once as the
+    concurrency limit of each target allows, without starting any job before
+    the jobs it comes after have finished.
+
+    A job only waits for jobs earlier in the batch so there can be no cycle.
+    A failed job is logged and counts as finished: the ordering exists
+    because a later job would not work before an earlier one has been tried,
+    not because it cannot work if the earlier one failed.
+
+    :ivar int _pending: The number of jobs which have not started.
+
+    :ivar dict _ready_jobs: A mapping from target to a ``deque`` of the
+        indexes of the jobs for that target which are not waiting for any
+        other job and have not started, in the order they became ready.
 
-    if jobs:
-        # Capture whatever action context is active now and make sure it is
-        # also active when we get back here to process the next job.
-        DeferredContext(d).addCallback(
-            lambda ignored: _execute_converge_output(jobs),
+    :ivar list _blockers: For each job, the number of unfinished jobs it is
+        waiting for.
+
+    :ivar list _dependents: For each job, the indexes of the jobs waiting for
+        it.
+
+    :ivar dict _running: A mapping from target to the number of jobs for that
+        target which are running.
+    """
+    def __init__(self, clock, concurrency, jobs):
+        self._clock = clock
+        self._concurrency = concurrency
+        self._jobs = jobs
+        self._pending = len(jobs)
+        self._ready_jobs = {}
+        self._blockers = [0] * len(jobs)
+        self._dependents = list([] for job in jobs)
+        self._running = {}
+        self._starting = False
+        self._failures = 0
+        self._done = Deferred()
+
+        earlier = {}
+        for index, job in enumerate(jobs):
+            for key in job.after:
+                for blocker in earlier.get(key, ()):
+                    self._blockers[index] += 1
+                    self._dependents[blocker].append(index)
+            earlier.setdefault(job.key, []).append(index)
+            _queued_jobs.labels(target=job.target).inc()
+            if self._blockers[index] == 0:
+                self._make_ready(index)
+
+
+    def run(self):
+        """
+        Run all of the jobs.
+
+        :return Deferred: Fires with an ``_Outcome`` when every job has
+            finished.
+        """
+        self._start_ready()
+        return self._done
+
+
+    def _make_ready(self, index):
+        target = self._jobs[index].target
+        self._ready_jobs.setdefault(target, deque()).append(index)
+
+
+    def _ready(self):
+        """
+        :return: The index of a job which can start now or ``None``.  Of the
+            targets with room for another job, the one whose next job is
+            earliest in the batch is chosen.
+        """
+        chosen = None
+        for target, ready in self._ready_jobs.iteritems():
+            limit = self._concurrency.get(target, 1)
+            if ready and self._running.get(target, 0) < limit:
+                if chosen is None or ready[0] < chosen[0]:
+                    chosen = ready
+        if chosen is None:
+            return None
+        self._pending -= 1
+        return chosen.popleft()
+
+
+    def _start_ready(self):
+        if self._starting:
+            # A job finished synchronously while we were starting jobs.  The
+            # loop below will notice whatever became ready.
+            return
+        self._starting = True
+        try:
+            index = self._ready()
+            while index is not None:
+                self._start(index)
+                index = self._ready()
+        finally:
+            self._starting = False
+
+        if not self._pending and not any(self._running.values()):
+            self._done.callback(
+                _Outcome(jobs=len(self._jobs), failures=self._failures),
+            )
+
+
+    def _start(self, index):
+        job = self._jobs[index]
+        self._running[job.target] = self._running.get(job.target, 0) + 1
+        _queued_jobs.labels(target=job.target).dec()
+        _running_jobs.labels(target=job.target).inc()
+        started = self._clock.seconds()
+
+        a = start_action(
+            action_type=u"execute-converge-step",
+            target=job.target,
+            key=repr(job.key).decode("ascii"),
         )
-    return d
+        with a.context():
+            d = DeferredContext(maybeDeferred(job.run))
+            d.addErrback(self._failed)
+            d.addActionFinish()
+        d.result.addCallback(lambda ignored: self._finished(index, started))
+
 
+    def _failed(self, reason):
+        self._failures += 1
+        write_failure(reason)
 
-def _execute_converge_outputs(jobs):
-    a = start_action(action_type=u"execute-converge-steps")
+
+    def _finished(self, index, started):
+        job = self._jobs[index]
+        self._running[job.target] -= 1
+        _running_jobs.labels(target=job.target).dec()
+        _job_latency.labels(target=job.target).observe(
+            self._clock.seconds() - started,
+        )
+        for dependent in self._dependents[index]:
+            self._blockers[dependent] -= 1
+            if self._blockers[dependent] == 0:
+                self._make_ready(dependent)
+        self._start_ready()
+
+
+
+def _execute_converge_outputs(jobs, concurrency=None, clock=None):
+    """
+    Run converge jobs.
+
+    :param list jobs: The ``_Job`` instances to run or ``None`` to run none.
+
+    :param dict concurrency: A mapping from job target to the greatest number
+        of jobs for that target to run at once.  ``None`` for
+        ``_DEFAULT_CONCURRENCY``.
+
+    :param clock: The ``IReactorTime`` to use to time jobs.  ``None`` for
+        the global reactor.
+
+    :return Deferred: Fires with an ``_Outcome`` when every job has
+        finished.
+    """
+    if jobs is None:
+        # ``_converge_logic`` failed.  It has already logged why.
+        jobs = []
+    if concurrency is None:
+        concurrency = _DEFAULT_CONCURRENCY
+    if clock is None:
+        from twisted.internet import reactor as clock
+
+    a = start_action(action_type=u"execute-converge-steps", job_count=len(jobs))
     with a.context():
-        d = DeferredContext(_execute_converge_output(jobs))
+        d = DeferredContext(_JobScheduler(clock, concurrency, jobs).run())
         return d.addActionFinish()
 
 
-def converge(config, subscriptions, k8s, aws):
+_phase_latency = Histogram(
+    u"subscription_converger_phase_seconds",
+    u"Time taken by each phase of a convergence pass.",
+    [u"phase"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, float(u"inf")),
+)
+
+
+
+def _timed(clock, phase, f, *args):
+    """
+    Call a function and record how long the ``Deferred`` it returns takes to
+    fire, whether it succeeds or fails, in ``_phase_latency``.
+    """
+    started = clock.seconds()
+    d = maybeDeferred(f, *args)
+    def finished(result):
+        _phase_latency.labels(phase=phase).observe(clock.seconds() - started)
+        return result
+    d.addBoth(finished)
+    return d
+
+
+
+def _shard_state(state, shard):
+    """
+    :param Shard shard: The shard of the work to do.
+
+    :return _State: ``state`` restricted to the subscriptions ``shard``
+        owns.  Route53 records which belong to no subscription are kept.
+    """
+    def owned(objects):
+        return list(
+            obj
+            for obj
+            in objects
+            if shard.owns(obj.metadata.annotations[u"subscription"])
+        )
+
+    zone = state.zone
+    others = {
+        key
+        for (sid, key)
+        in zone.subscriptions.items()
+        if not shard.owns(sid)
+    }
+    return state.set(
+        subscriptions={
+            sid: subscription
+            for (sid, subscription)
+            in state.subscriptions.items()
+            if shard.owns(sid)
+        },
+        configmaps=owned(state.configmaps),
+        deployments=owned(state.deployments),
+        replicasets=owned(state.replicasets),
+        pods=owned(state.pods),
+        zone=zone.set(
+            rrsets={
+                key: rrset
+                for (key, rrset)
+                in zone.rrsets.items()
+                if key not in others
+            },
+            subscriptions={
+                sid: key
+                for (sid, key)
+                in zone.subscriptions.items()
+                if shard.owns(sid)
+            },
+        ),
+    )
+
+
+
+def _retain_rendered(state):
+    """
+    Keep the cached objects rendered for only the subscriptions in a complete
+    state.
+
+    :return _State: ``state``
+    """
+    retain_rendered(state.subscriptions)
+    return state
+
+
+
+def converge(config, subscriptions, k8s, aws, concurrency=None, clock=None, shard=None):
     """
     Bring provisioned resources in line with active subscriptions.
 
@@ -786,11 +2051,24 @@ def converge(config, subscriptions, k8s, aws):
 
     :param AWSServiceRegion aws: A client for interacting with AWS.
 
-    :return Deferred(NoneType): The returned ``Deferred`` fires after one
+    :param dict concurrency: The greatest number of changes to make at once
+        to each kind of resource.  See ``_execute_converge_outputs``.
+
+    :param clock: The ``IReactorTime`` to use to time the phases of
+        convergence.  ``None`` for the global reactor.
+
+    :param Shard shard: The part of the work to do or ``None`` to do all of
+        it.  Shared infrastructure is only converged by the leader.
+
+    :return Deferred(_Outcome): The returned ``Deferred`` fires after one
         attempt has been made to bring the actual state of provisioned
         resources in line with the desired state of provisioned resources
-        based on the currently active subscriptions.
+        based on the currently active subscriptions.  It fails if the
+        current state could not be loaded.
     """
+    if clock is None:
+        from twisted.internet import reactor as clock
+
     # Create and destroy deployments as necessary.  Use the
     # subscription manager to find out what subscriptions are active
     # and use look at the Kubernetes configuration to find out what
@@ -798,14 +2076,620 @@ def converge(config, subscriptions, k8s, aws):
     # mis-configurations and correct them.
     a = start_action(action_type=u"converge")
     with a.context():
-        d = DeferredContext(_get_converge_inputs(config, subscriptions, k8s, aws))
-        d.addCallback(_converge_logic, config, subscriptions, k8s, aws)
-        d.addCallback(_execute_converge_outputs)
-        d.addCallback(lambda result: None)
+        d = DeferredContext(_timed(
+            clock, u"load",
+            _get_converge_inputs, config, subscriptions, k8s, aws, clock, shard,
+        ))
+        d.addCallback(_retain_rendered)
+        convergers = _CONVERGERS
+        if shard is not None and not shard.leader:
+            convergers = _SUBSCRIPTION_CONVERGERS
+        d.addCallback(
+            lambda state: _timed(
+                clock, u"logic",
+                _converge_logic, state, config, subscriptions, k8s, aws, clock,
+                convergers,
+            ),
+        )
+        d.addCallback(
+            lambda jobs: _timed(
+                clock, u"execute",
+                _execute_converge_outputs, jobs, concurrency, clock,
+            ),
+        )
+        return d.addActionFinish()
+
+
+
+def _converge_shard(membership, config, subscriptions, k8s, aws, concurrency=None, clock=None):
+    """
+    ``converge`` the subscriptions this converger owns according to its
+    membership of the group of replicas sharing the work.
+
+    Members may briefly disagree about who owns a subscription while one
+    joins or leaves.  Some changes may then be attempted twice or be left
+    until the next pass.
+
+    :param ShardMembership membership: This converger's membership.  If it
+        is not known to be current, it is renewed first.
+
+    The other parameters are as for ``converge``.
+    """
+    shard = membership.shard
+    if shard is None:
+        d = membership.heartbeat()
+    else:
+        d = succeed(shard)
+    d.addCallback(
+        lambda shard: converge(
+            config, subscriptions, k8s, aws, concurrency, clock, shard,
+        ),
+    )
+    return d
+
+
+
+def _when_leader(election, converge):
+    """
+    Run a convergence pass only while holding the lease.
+
+    :param LeaderElection election: The election of the converger replica
+        which converges.
+
+    :param converge: A no-argument callable which runs one pass.
+
+    :return Deferred(_Outcome): The outcome of the pass.  A replica without
+        the lease runs no jobs.
+    """
+    if not election.leader:
+        Message.log(event_type=u"converge:standby")
+        return succeed(_Outcome(jobs=0, failures=0))
+    return converge()
+
+
+
+def _describe_job(job):
+    """
+    :return dict: A JSON-compatible description of ``job``.
+    """
+    def key(k):
+        if isinstance(k, tuple):
+            return list(k)
+        return k
+    return {
+        u"target": job.target,
+        u"key": key(job.key),
+        u"after": sorted(key(k) for k in job.after),
+        u"description": job.description,
+    }
+
+
+
+def plan(config, subscriptions, k8s, aws, clock=None):
+    """
+    Work out what ``converge`` would change without changing anything.
+
+    The parameters are as for ``converge``.
+
+    :return Deferred(list): Fires with a JSON-compatible description of each
+        job ``converge`` would run, in the order it would schedule them.
+    """
+    if clock is None:
+        from twisted.internet import reactor as clock
+
+    a = start_action(action_type=u"plan")
+    with a.context():
+        d = DeferredContext(
+            _get_converge_inputs(config, subscriptions, k8s, aws, clock),
+        )
+        d.addCallback(_converge_logic, config, subscriptions, k8s, aws, clock)
+        d.addCallback(lambda jobs: list(_describe_job(job) for job in jobs))
         return d.addActionFinish()
 
 
 
+class _PlanService(Service):
+    """
+    ``_PlanService`` works out what one convergence pass would change,
+    writes it out as JSON and then stops the reactor.
+
+    :ivar _plan: A no-argument callable returning a ``Deferred`` that fires
+        with the jobs as returned by ``plan``.
+
+    :ivar _output: A file to write the jobs to.
+    """
+    def __init__(self, reactor, plan, output):
+        self._reactor = reactor
+        self._plan = plan
+        self._output = output
+
+
+    def startService(self):
+        Service.startService(self)
+        d = maybeDeferred(self._plan)
+        def planned(jobs):
+            self._output.write(dumps(jobs, indent=2, sort_keys=True) + b"\n")
+            self._output.flush()
+        d.addCallbacks(planned, write_failure)
+        d.addBoth(lambda ignored: self._reactor.stop())
+
+
+
+_next_pass_delay = Gauge(
+    u"subscription_converger_next_pass_delay_seconds",
+    u"The time between the end of the last convergence pass and the start "
+    u"of the next one.",
+)
+
+
+
+class _ConvergeScheduler(Service):
+    """
+    ``_ConvergeScheduler`` runs convergence passes one after another.
+
+    A pass never starts before the previous one has finished.  After a
+    healthy pass the next one starts ``interval`` seconds after it began or,
+    if the pass took longer than half of that, as long after it finished as
+    it took.  Convergence therefore never occupies more than half of the
+    time, however slow the APIs it uses become.
+
+    A pass is unhealthy if the current state could not be loaded or if more
+    than ``max_error_rate`` of its jobs failed.  After an unhealthy pass the
+    delay grows as given by ``lae_util.backoff``, up to ``max_interval``
+    seconds, and goes back to normal after the next healthy pass.
+
+    Like ``TimerService``, stopping the service waits for a pass which is
+    running to finish.
+
+    :ivar _converge: A no-argument callable which runs one pass and returns
+        a ``Deferred`` that fires with an ``_Outcome``.
+
+    :ivar _running: The ``Deferred`` of the pass which is running or ``None``
+        if none is.
+    """
+    max_error_rate = 0.5
+
+    def __init__(self, clock, interval, max_interval, converge, jitter=0.2):
+        self._clock = clock
+        self._interval = interval
+        self._max_interval = max_interval
+        self._converge = converge
+        self._jitter = jitter
+        self._backoff = None
+        self._delayed = None
+        self._running = None
+
+
+    def startService(self):
+        Service.startService(self)
+        self._pass()
+
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+        self._delayed = None
+        if self._running is None:
+            return None
+        stopped = Deferred()
+        self._running.addBoth(lambda ignored: stopped.callback(None))
+        return stopped
+
+
+    def _pass(self):
+        self._delayed = None
+        started = self._clock.seconds()
+        d = maybeDeferred(self._converge)
+        d.addCallbacks(self._healthy, self._unhealthy)
+        d.addCallback(self._schedule, started)
+        d.addErrback(write_failure)
+        self._running = d
+        d.addBoth(self._finished)
+
+
+    def _finished(self, ignored):
+        self._running = None
+
+
+    def _healthy(self, outcome):
+        if outcome.failures > outcome.jobs * self.max_error_rate:
+            Message.log(
+                event_type=u"converge-scheduler:jobs-failed",
+                jobs=outcome.jobs,
+                failures=outcome.failures,
+            )
+            return False
+        return True
+
+
+    def _unhealthy(self, reason):
+        write_failure(reason)
+        return False
+
+
+    def _schedule(self, healthy, started):
+        duration = self._clock.seconds() - started
+        if healthy:
+            self._backoff = None
+            delay = max(self._interval - duration, duration)
+        else:
+            if self._backoff is None:
+                self._backoff = backoff(
+                    step=self._interval,
+                    maximum_step=self._max_interval,
+                    timeout=None,
+                    jitter=self._jitter,
+                )
+            delay = max(next(self._backoff), duration)
+        Message.log(
+            event_type=u"converge-scheduler:scheduled",
+            healthy=healthy,
+            duration=duration,
+            delay=delay,
+        )
+        _next_pass_delay.set(delay)
+        if self.running:
+            self._delayed = self._clock.callLater(delay, self._pass)
+
+
+
+class _EventDrivenConvergence(MultiService):
+    """
+    ``_EventDrivenConvergence`` converges only the subscriptions which may
+    have changed, as soon as it learns of the change, with an occasional
+    full resync.
+
+    Customer grid Kubernetes objects are kept in ``Informer`` caches.  A
+    change to one of them touches the subscription named by its
+    ``subscription`` annotation.  The subscription manager's change feed is
+    polled every ``change_interval`` seconds and touches each subscription it
+    reports.  Touched subscriptions are converged together using the cached
+    state, without loading anything.  Infrastructure which belongs to no
+    subscription is left alone.
+
+    Every ``interval`` seconds, everything is loaded and converged as
+    ``converge`` does.  In between, the Route53 zone and the S3 buckets are
+    kept in the caches of a ``_CachingRegion``.  Anything that goes wrong is
+    put right by the next resync.
+
+    Only one convergence pass runs at a time.
+
+    Given a ``LeaderElection``, nothing is converged unless the lease is
+    held.  A standby keeps its informers and its zone and bucket caches up
+    to date.  When it takes the lease it resyncs using them, without
+    listing them again.
+
+    :ivar _state: The ``_State`` as of the last resync, with its
+        ``subscriptions`` updated since then, or ``None`` if there has not
+        been a resync yet.  Its ``zone`` and ``buckets`` are not kept up to
+        date.
+
+    :ivar set _touched: The identifiers of the subscriptions touched since
+        the last pass began.
+
+    :ivar _feed: A two-tuple of the epoch and number of the latest change
+        taken from the subscription manager's change feed, or ``None``.
+    """
+    def __init__(
+        self, reactor, interval, change_interval, config, subscriptions, k8s,
+        aws, concurrency=None, election=None,
+    ):
+        MultiService.__init__(self)
+        self._reactor = reactor
+        self._election = election
+        self._concurrency = concurrency
+        self._config = config
+        self._subscriptions = subscriptions
+        self._k8s = k8s
+        if not isinstance(aws, _CachingRegion):
+            aws = _CachingRegion(
+                aws, _ZoneCache(reactor, interval), _BucketCache(reactor, interval),
+            )
+        self._aws = aws
+        self._lock = DeferredLock()
+        self._state = None
+        self._touched = set()
+        self._feed = None
+        self._scheduled = None
+
+        model = k8s.k8s.model
+        self._informers = {
+            name: Informer(
+                reactor, change_interval, k8s, kind,
+                config.kubernetes_namespace, CUSTOMER_METADATA_LABELS,
+                self._object_changed,
+            )
+            for (name, kind) in [
+                (u"configmaps", model.v1.ConfigMap),
+                (u"deployments", model.v1beta1.Deployment),
+                (u"replicasets", model.v1beta1.ReplicaSet),
+                (u"pods", model.v1.Pod),
+            ]
+        }
+        for informer in self._informers.values():
+            informer.setServiceParent(self)
+
+        if election is not None:
+            election.elected = self.takeover
+            election.setServiceParent(self)
+
+        resync = TimerService(interval, self.resync)
+        resync.clock = reactor
+        resync.setServiceParent(self)
+
+        poll = TimerService(change_interval, self.poll)
+        poll.clock = reactor
+        poll.setServiceParent(self)
+
+
+    def stopService(self):
+        if self._scheduled is not None and self._scheduled.active():
+            self._scheduled.cancel()
+        self._scheduled = None
+        return MultiService.stopService(self)
+
+
+    def resync(self):
+        """
+        Load everything and converge all subscriptions.
+        """
+        return self._lock.run(self._resync)
+
+
+    def takeover(self):
+        """
+        Converge all subscriptions using the cached zone and buckets.
+        """
+        return self._lock.run(self._resync, invalidate=False)
+
+
+    def _leading(self):
+        return self._election is None or self._election.leader
+
+
+    @with_action(action_type=u"event-driven-convergence:resync")
+    def _resync(self, invalidate=True):
+        if not self._leading():
+            return self._stand_by()
+        # Anything touched so far will be dealt with by this pass.
+        self._touched = set()
+        if invalidate:
+            self._aws.zones.invalidate()
+            self._aws.buckets.invalidate()
+        # Find the position in the change feed first so no change which
+        # happens while loading is missed.
+        d = DeferredContext(self._subscriptions.changes(None, None))
+        def got_feed(changes):
+            self._feed = (changes.epoch, changes.latest)
+            return self._load_state()
+        d.addCallback(got_feed)
+        def got_state(state):
+            self._state = _retain_rendered(state)
+            return self._converge(state, _CONVERGERS)
+        d.addCallback(got_state)
+        d.addErrback(write_failure)
+        return d.result
+
+
+    def _stand_by(self):
+        """
+        Forget the state so that nothing is converged from it without the
+        lease but load the zone and the buckets into their caches again if
+        they are old.
+        """
+        self._state = None
+        self._feed = None
+        self._touched = set()
+        d = DeferredContext(gatherResults([
+            self._aws.zones.get(
+                self._aws.get_route53_client(), Name(self._config.domain),
+            ),
+            self._aws.buckets.get(self._aws.get_s3_client()),
+        ]))
+        d.addCallback(lambda ignored: None)
+        d.addErrback(write_failure)
+        return d.result
+
+
+    def _load_state(self):
+        """
+        Load the current state, taking the customer grid Kubernetes objects
+        from the informers if they have them.
+
+        :return Deferred(_State): The state.
+        """
+        if not all(informer.synced for informer in self._informers.values()):
+            return _get_converge_inputs(
+                self._config, self._subscriptions, self._k8s, self._aws,
+                self._reactor,
+            )
+        d = gatherResults([
+            get_active_subscriptions(self._subscriptions),
+            get_customer_grid_service(self._k8s, self._config.kubernetes_namespace),
+            self._aws.zones.get(
+                self._aws.get_route53_client(), Name(self._config.domain),
+            ),
+            self._aws.buckets.get(self._aws.get_s3_client()),
+        ])
+        def loaded(results):
+            subscriptions, service, zone, buckets = results
+            return _State(
+                subscriptions=subscriptions,
+                service=service,
+                zone=zone,
+                buckets=self._aws.buckets.confirm(subscriptions),
+                **{
+                    name: list(informer.items())
+                    for (name, informer)
+                    in self._informers.items()
+                }
+            )
+        d.addCallback(loaded)
+        return d
+
+
+    def poll(self):
+        """
+        Check the subscription manager's change feed and touch the
+        subscriptions which changed.
+        """
+        if self._feed is None or self._state is None:
+            # The next resync will find everything.
+            return succeed(None)
+        epoch, latest = self._feed
+        a = start_action(action_type=u"event-driven-convergence:poll")
+        with a.context():
+            d = DeferredContext(self._subscriptions.changes(epoch, latest))
+            d.addCallback(self._got_changes)
+            d.addErrback(write_failure)
+            return d.addActionFinish()
+
+
+    def _got_changes(self, changes):
+        if changes.changes is None:
+            # Too much changed or the subscription manager restarted.
+            Message.log(event_type=u"event-driven-convergence:feed-lost")
+            self._feed = None
+            return self.resync()
+
+        self._feed = (changes.epoch, changes.latest)
+        subscriptions = dict(self._state.subscriptions)
+        for sid, details in changes.changes.items():
+            if details is None:
+                subscriptions.pop(sid, None)
+            else:
+                subscriptions[sid] = details
+        self._state = self._state.set(subscriptions=subscriptions)
+        self._touch(changes.changes)
+        return None
+
+
+    def _object_changed(self, event_type, obj):
+        annotations = obj.metadata.annotations
+        if annotations is not None and u"subscription" in annotations:
+            self._touch([annotations[u"subscription"]])
+
+
+    def _touch(self, subscription_ids):
+        """
+        Arrange for some subscriptions to be converged soon.
+        """
+        self._touched.update(subscription_ids)
+        if self._touched and self._scheduled is None and self.running:
+            self._scheduled = self._reactor.callLater(0, self._converge_touched)
+
+
+    def _converge_touched(self):
+        self._scheduled = None
+        return self._lock.run(self._incremental)
+
+
+    def _incremental(self):
+        if self._state is None or not all(
+            informer.synced for informer in self._informers.values()
+        ):
+            # Leave them for the resync.
+            return None
+        touched, self._touched = self._touched, set()
+        if not touched:
+            return None
+
+        a = start_action(
+            action_type=u"event-driven-convergence:incremental",
+            subscription_count=len(touched),
+        )
+        with a.context():
+            d = DeferredContext(gatherResults([
+                self._aws.zones.get(
+                    self._aws.get_route53_client(), Name(self._config.domain),
+                ),
+                self._aws.buckets.get(self._aws.get_s3_client()),
+            ]))
+            d.addCallback(
+                lambda zone_and_buckets: self._converge(
+                    self._touched_state(touched, zone_and_buckets[0]),
+                    _SUBSCRIPTION_CONVERGERS,
+                ),
+            )
+            d.addErrback(write_failure)
+            def done(ignored):
+                # Anything touched during this pass needs another one.
+                self._touch(())
+            d.addCallback(done)
+            return d.addActionFinish()
+
+
+    def _touched_state(self, touched, zone):
+        """
+        :param _ZoneState zone: The current state of the zone.  The current
+            state of the buckets comes from the bucket cache.
+
+        :return _State: The cached state restricted to the subscriptions in
+            ``touched``.
+        """
+        def owned(name):
+            return list(
+                obj
+                for obj
+                in self._informers[name].items()
+                if obj.metadata.annotations[u"subscription"] in touched
+            )
+
+        state = self._state
+        subscriptions = {
+            sid: state.subscriptions[sid]
+            for sid
+            in touched
+            if sid in state.subscriptions
+        }
+        return state.set(
+            subscriptions=subscriptions,
+            buckets=self._aws.buckets.confirm(subscriptions),
+            configmaps=owned(u"configmaps"),
+            deployments=owned(u"deployments"),
+            replicasets=owned(u"replicasets"),
+            pods=owned(u"pods"),
+            zone=zone.set(
+                rrsets={
+                    key: zone.rrsets[key]
+                    for (sid, key)
+                    in zone.subscriptions.items()
+                    if sid in touched
+                },
+                subscriptions={
+                    sid: key
+                    for (sid, key)
+                    in zone.subscriptions.items()
+                    if sid in touched
+                },
+            ),
+        )
+
+
+    def _converge(self, state, convergers):
+        """
+        Converge the subscriptions in ``state``.
+        """
+        if not self._leading():
+            # The lease was lost since the state was loaded.
+            Message.log(event_type=u"event-driven-convergence:standby")
+            return None
+        d = DeferredContext(_timed(
+            self._reactor, u"logic", _converge_logic,
+            state, self._config, self._subscriptions, self._k8s, self._aws,
+            self._reactor, convergers,
+        ))
+        d.addCallback(
+            lambda jobs: _timed(
+                self._reactor, u"execute",
+                _execute_converge_outputs, jobs, self._concurrency, self._reactor,
+            ),
+        )
+        return d.result
+
+
+
 @with_action(action_type=u"find-zones")
 def get_hosted_zone_by_name(route53, name):
     """
@@ -827,11 +2711,10 @@ def get_hosted_zone_by_name(route53, name):
             for zone in zones:
                 # XXX Bleuch zone.name should be a Name!
                 if Name(zone.name) == name:
-                    d = route53.list_resource_record_sets(zone_id=zone.identifier)
+                    d = list_all_rrsets(route53, zone.identifier)
                     d.addCallback(
-                        lambda rrsets, zone=zone: _ZoneState(
-                            zone=zone,
-                            rrsets=rrsets,
+                        lambda rrsets, zone=zone: _ZoneState.from_rrsets(
+                            zone, rrsets,
                         ),
                     )
                     return d
@@ -841,6 +2724,58 @@ def get_hosted_zone_by_name(route53, name):
 
 
 
+# The most rrsets Route53 will return in response to one request.
+_ROUTE53_PAGE_SIZE = 300
+
+
+def _route53_order(key):
+    """
+    :return: A sort key which puts ``RRSetKey`` instances in the order in
+        which Route53 lists them: by name with the labels reversed, then by
+        type.
+    """
+    return (tuple(reversed(key.label.text.lower().split(u"."))), key.type)
+
+
+
+def list_all_rrsets(route53, zone_id, page_size=_ROUTE53_PAGE_SIZE):
+    """
+    Get every rrset in a zone, however many requests it takes.
+
+    Each page after the first starts at the last rrset of the previous page.
+    txAWS does not tell us whether a response was truncated so the listing
+    ends with the first page which is not full.
+
+    :return Deferred(dict): A mapping from ``RRSetKey`` to ``RRSet``.
+    """
+    rrsets = {}
+    a = start_action(action_type=u"list-all-rrsets", zone=zone_id)
+    with a.context():
+        def get_page(name, type):
+            d = route53.list_resource_record_sets(
+                zone_id=zone_id, maxitems=page_size, name=name, type=type,
+            )
+            d.addCallback(got_page, name, type)
+            return d
+
+        def got_page(page, name, type):
+            rrsets.update(page)
+            if len(page) < page_size:
+                return rrsets
+            last = max(page, key=_route53_order)
+            if (last.label, last.type) == (name, type):
+                return rrsets
+            return get_page(last.label, last.type)
+
+        d = DeferredContext(get_page(None, None))
+        def got_rrsets(rrsets):
+            a.add_success_fields(rrset_count=len(rrsets))
+            return rrsets
+        d.addCallback(got_rrsets)
+        return d.addActionFinish()
+
+
+
 def _introducer_name_for_subscription(subscription_id, domain):
     return Name(configmap_public_host(subscription_id, domain))
 
@@ -864,27 +2799,157 @@ def _rrset_for_subscription(subscription_id, zone_name):
     )
 
 
-def delete_route53_rrsets(route53, zone, subscription_ids):
-    a = start_action(action_type=u"delete-route53", subscription_ids=list(subscription_ids))
-    with a.context():
-        d = route53.change_resource_record_sets(zone.identifier, list(
-            delete_rrset(_rrset_for_subscription(subscription_id, zone.name))
-            for subscription_id
-            in subscription_ids
-        ))
-        d = DeferredContext(d)
-        return d.addActionFinish()
+# Route53's limits on a single ChangeResourceRecordSets request.  An upsert
+# counts twice towards both.
+# http://docs.aws.amazon.com/Route53/latest/DeveloperGuide/DNSLimitations.html#limits-api-requests-changeresourcerecordsets
+_ROUTE53_BATCH_RECORDS = 1000
+_ROUTE53_BATCH_CHARACTERS = 32000
+
+# The Route53 error codes which mean the same request may succeed later.
+_ROUTE53_RETRY_CODES = {
+    u"Throttling", u"PriorRequestNotComplete", u"ServiceUnavailable",
+}
+
+
+
+def _record_length(record):
+    """
+    :return: The number of characters Route53 counts for a record.
+    """
+    if isinstance(record, CNAME):
+        # Avoid ``to_text`` which fails for a name which is not valid.  Let
+        # Route53 be the one to reject it.
+        return len(record.canonical_name.text)
+    return len(record.to_text())
+
+
+
+def _route53_batches(changes):
+    """
+    Divide rrset changes into batches small enough for Route53 to accept
+    each in one request.
 
+    :param list changes: The ``IRRSetChange`` providers to divide.
 
-def create_route53_rrsets(route53, zone, subscriptions):
-    a = start_action(action_type=u"create-route53")
+    :return: A ``list`` of ``list`` of the changes, in the original order.
+    """
+    batches = []
+    batch = []
+    records = characters = 0
+    for change in changes:
+        weight = 2 if change.action == u"UPSERT" else 1
+        change_records = weight * len(change.rrset.records)
+        change_characters = weight * sum(
+            _record_length(record)
+            for record in change.rrset.records
+        )
+        if batch and (
+            records + change_records > _ROUTE53_BATCH_RECORDS or
+            characters + change_characters > _ROUTE53_BATCH_CHARACTERS
+        ):
+            batches.append(batch)
+            batch = []
+            records = characters = 0
+        batch.append(change)
+        records += change_records
+        characters += change_characters
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+
+class _Route53Retry(Exception):
+    """
+    Route53 rejected a request for a reason which may go away if it is tried
+    again.
+    """
+
+
+
+def _route53_error_codes(reason):
+    """
+    :return: The ``set`` of Route53 error codes in a failed request's
+        response.
+    """
+    if not reason.check(Route53Error):
+        return set()
+    # txAWS only parses the errors out of responses with a 5xx status.
+    codes = {error.get(u"Code") for error in reason.value.errors}
+    try:
+        tree = XML(reason.value.original)
+    except ParseError:
+        return codes
+    codes.update(
+        element.text
+        for element in tree.iter()
+        if element.tag.rsplit(u"}", 1)[-1] == u"Code"
+    )
+    return codes
+
+
+
+def change_route53_batch(reactor, route53, zone, changes):
+    """
+    Make a batch of changes to the rrsets in a zone.
+
+    The request is retried with increasing delays while Route53 reports it
+    is being throttled.  If Route53 rejects the batch because of one of the
+    changes in it, the batch is split in half and each half is tried so the
+    rest of the changes can still be made.
+
+    :param zone: The ``HostedZone`` to change.
+
+    :param list changes: The ``IRRSetChange`` providers to make.  There must
+        be few enough to fit in one request.
+
+    :return Deferred: Fires when the changes have been made.
+    """
+    a = start_action(
+        action_type=u"change-route53-batch",
+        zone=zone.identifier,
+        changes=list(
+            {u"action": change.action, u"label": change.rrset.label.text}
+            for change in changes
+        ),
+    )
     with a.context():
-        d = route53.change_resource_record_sets(zone.identifier, list(
-            create_rrset(_rrset_for_subscription(subscription.subscription_id, zone.name))
-            for subscription
-            in subscriptions
+        def attempt():
+            d = route53.change_resource_record_sets(zone.identifier, changes)
+            def retryable(reason):
+                if _route53_error_codes(reason) & _ROUTE53_RETRY_CODES:
+                    Message.log(event_type=u"change-route53-batch:throttled")
+                    raise _Route53Retry(reason.value)
+                return reason
+            d.addErrback(retryable)
+            return d
+
+        d = DeferredContext(retry_failure(
+            reactor, attempt, expected=[_Route53Retry],
+            steps=backoff(step=1.0, maximum_step=30.0, timeout=5 * 60.0),
         ))
-        d = DeferredContext(d)
+
+        def split(reason):
+            if len(changes) < 2 or u"InvalidChangeBatch" not in _route53_error_codes(reason):
+                return reason
+            write_failure(reason)
+            middle = len(changes) // 2
+            d = change_route53_batch(reactor, route53, zone, changes[:middle])
+            def second_half(first_result):
+                d = change_route53_batch(reactor, route53, zone, changes[middle:])
+                if isinstance(first_result, Failure):
+                    # Report the first failure once the second half is done,
+                    # logging it if there is another to report instead.
+                    def report(second_result):
+                        if isinstance(second_result, Failure):
+                            write_failure(first_result)
+                            return second_result
+                        return first_result
+                    d.addBoth(report)
+                return d
+            d.addBoth(second_half)
+            return d
+        d.addErrback(split)
         return d.addActionFinish()
 
 
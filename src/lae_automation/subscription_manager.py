@@ -8,8 +8,10 @@ provides persistence of S4 subscriptions.
 
 from io import BytesIO
 from json import loads, dumps
-from os import O_CREAT, O_EXCL, O_WRONLY, open as os_open, fdopen
+from os import O_CREAT, O_EXCL, O_WRONLY, open as os_open, fdopen, urandom
 from base64 import b32encode, b32decode
+from collections import deque
+from errno import ENOENT
 
 import attr
 from attr import validators
@@ -55,18 +57,129 @@ def create(path):
     return fdopen(os_open(path.path, flags), "w")
 
 
+@attr.s
+class ChangeLog(object):
+    """
+    A bounded, in-memory record of which subscriptions have changed, in the
+    order they changed.
+
+    Each change is numbered.  A client which remembers the number of the
+    last change it saw can ask for just the subscriptions which changed
+    after that.  If those changes have been forgotten (because there were
+    too many or because the subscription manager restarted and so has a new
+    ``epoch``), the client must look at all of the subscriptions again.
+
+    :ivar unicode epoch: An identifier for this log which is different for
+        every log.
+
+    :ivar int limit: The most changes to remember.
+
+    :ivar int latest: The number of the most recent change.
+    """
+    epoch = attr.ib(default=attr.Factory(lambda: urandom(8).encode("hex").decode("ascii")))
+    limit = attr.ib(default=10000)
+    latest = attr.ib(default=0)
+    _changes = attr.ib(default=attr.Factory(deque))
+
+    def record(self, subscription_id):
+        """
+        Note that a subscription has changed.
+        """
+        self.latest += 1
+        self._changes.append((self.latest, subscription_id))
+        if len(self._changes) > self.limit:
+            self._changes.popleft()
+
+
+    def since(self, epoch, sequence):
+        """
+        :param unicode epoch: The epoch of the log ``sequence`` was taken from.
+
+        :param int sequence: The number of a change.
+
+        :return: A ``list`` of the identifiers of the subscriptions which
+            changed after change ``sequence`` or ``None`` if that is not
+            known.
+        """
+        if epoch != self.epoch or sequence is None or sequence > self.latest:
+            return None
+        oldest = self._changes[0][0] if self._changes else self.latest + 1
+        if oldest > sequence + 1:
+            return None
+        changed = []
+        seen = set()
+        for number, subscription_id in reversed(self._changes):
+            if number <= sequence:
+                break
+            if subscription_id not in seen:
+                seen.add(subscription_id)
+                changed.append(subscription_id)
+        changed.reverse()
+        return changed
+
+
+
+class Changes(Resource):
+    """
+    Handle requests for the subscriptions which changed recently.
+
+    GET /?epoch=<epoch>&since=<n> -> the changes after change n
+    """
+    isLeaf = True
+
+    def __init__(self, database, changes):
+        Resource.__init__(self)
+        self.database = database
+        self.changes = changes
+
+    def render_GET(self, request):
+        """
+        Get the current state of each subscription which changed after the
+        given change.  ``changes`` is ``null`` if that is not known, in which
+        case all subscriptions must be examined.
+        """
+        epoch = request.args.get(b"epoch", [None])[0]
+        since = request.args.get(b"since", [None])[0]
+        try:
+            since = None if since is None else int(since)
+        except ValueError:
+            since = None
+        changed = self.changes.since(
+            None if epoch is None else epoch.decode("ascii"), since,
+        )
+        if changed:
+            # Only the changed subscriptions are read so that polling is
+            # cheap however many subscriptions there are.
+            changed = list(self._change(sid) for sid in changed)
+        request.responseHeaders.setRawHeaders(u"content-type", [u"application/json"])
+        return dumps(dict(
+            epoch=self.changes.epoch,
+            latest=self.changes.latest,
+            changes=changed,
+        ))
+
+    def _change(self, subscription_id):
+        details = self.database.get_active_subscription(subscription_id)
+        return dict(
+            subscription_id=subscription_id,
+            details=None if details is None else marshal_subscription(details),
+        )
+
+
+
 class Subscriptions(Resource):
     """
     Handle requests relating to the collection of subscriptions.
 
     GET / -> list of subscription identifiers
     """
-    def __init__(self, database):
+    def __init__(self, database, changes):
         Resource.__init__(self)
         self.database = database
+        self.changes = changes
 
     def getChild(self, name, request):
-        return Subscription(self.database, name)
+        return Subscription(self.database, self.changes, name)
 
     def render_POST(self, request):
         """
@@ -78,6 +191,7 @@ class Subscriptions(Resource):
             subscription_id=request_details.subscription_id,
             details=request_details,
         )
+        self.changes.record(response_details.subscription_id)
         request.setResponseCode(CREATED)
         return dumps(attr.asdict(response_details))
 
@@ -115,9 +229,10 @@ class Subscription(Resource):
     PUT /<subscription id> -> create new subscription
     DELETE /<subscription id> -> cancel an existing subscription
     """
-    def __init__(self, database, subscription_id):
+    def __init__(self, database, changes, subscription_id):
         Resource.__init__(self)
         self.database = database
+        self.changes = changes
         self.subscription_id = subscription_id
 
 
@@ -138,6 +253,7 @@ class Subscription(Resource):
         response_details = self.database.load_subscription(
             details=request_details,
         )
+        self.changes.record(self.subscription_id)
         request.setResponseCode(CREATED)
         return dumps(attr.asdict(response_details))
 
@@ -157,6 +273,7 @@ class Subscription(Resource):
         Deactivate the subscription represented by this resource.
         """
         self.database.deactivate_subscription(subscription_id=self.subscription_id)
+        self.changes.record(self.subscription_id)
         request.setResponseCode(NO_CONTENT)
         return b""
 
@@ -306,6 +423,23 @@ class SubscriptionDatabase(object):
         state = loads(path.getContent())
         return getattr(self, "_load_{}".format(state["version"]))(state)
 
+    def get_active_subscription(self, subscription_id):
+        """
+        :return: The ``SubscriptionDetails`` of the subscription or ``None``
+            if it does not exist or has been deactivated.
+        """
+        path = self._subscription_path(subscription_id)
+        try:
+            content = path.getContent()
+        except IOError as e:
+            if e.errno != ENOENT:
+                raise
+            return None
+        state = loads(content)
+        if not state["details"]["active"]:
+            return None
+        return getattr(self, "_load_{}".format(state["version"]))(state)
+
     def _load_1(self, state):
         details = state["details"]
         return SubscriptionDetails(
@@ -343,8 +477,10 @@ def required(options, key):
 
 def make_resource(path, domain):
     database = SubscriptionDatabase.from_directory(path, domain=domain)
+    changes = ChangeLog()
     v1 = Resource()
-    v1.putChild("subscriptions", Subscriptions(database))
+    v1.putChild("subscriptions", Subscriptions(database, changes))
+    v1.putChild("changes", Changes(database, changes))
 
     root = Resource()
     root.putChild("v1", v1)
@@ -517,6 +653,72 @@ class Client(object):
         d.addCallback(lambda ignored: None)
         return d
 
+    def changes(self, epoch, since):
+        """
+        Get the subscriptions which changed after a particular change.
+
+        This issues a ``GET`` to ``/v1/changes``.
+
+        :param unicode epoch: The ``epoch`` of a previous ``SubscriptionChanges``
+            or ``None``.
+
+        :param int since: The ``latest`` of a previous ``SubscriptionChanges``
+            or ``None``.
+
+        :return: A ``Deferred`` that fires with a ``SubscriptionChanges``.
+        """
+        url = URL.fromText(self.endpoint.decode("utf-8")).child(u"v1", u"changes")
+        if epoch is not None and since is not None:
+            url = url.add(u"epoch", epoch).add(u"since", u"{}".format(since))
+        d = self.agent.request(
+            b"GET", url.asURI().asText().encode("ascii"),
+        )
+        d.addCallback(require_code(OK))
+        d.addCallback(readBody)
+        d.addCallback(loads)
+        d.addCallback(decode_changes)
+        return d
+
+
+
+@attr.s(frozen=True)
+class SubscriptionChanges(object):
+    """
+    The subscriptions which changed after a particular change.
+
+    :ivar unicode epoch: Identifies the change log these changes came from.
+
+    :ivar int latest: The number of the most recent change.  Pass this and
+        ``epoch`` to ``Client.changes`` to find out about later changes.
+
+    :ivar changes: ``None`` if the changes are not known.  Otherwise, a
+        ``dict`` mapping the identifier of each subscription which changed to
+        its ``SubscriptionDetails`` or to ``None`` if it is not active.
+    """
+    epoch = attr.ib()
+    latest = attr.ib()
+    changes = attr.ib()
+
+
+
+def decode_changes(fields):
+    changes = fields["changes"]
+    if changes is not None:
+        changes = {
+            change["subscription_id"]: (
+                None
+                if change["details"] is None
+                else decode_subscription(change["details"])
+            )
+            for change
+            in changes
+        }
+    return SubscriptionChanges(
+        epoch=fields["epoch"],
+        latest=fields["latest"],
+        changes=changes,
+    )
+
 
 @attr.s
 class UnexpectedResponseCode(Exception):
@@ -9,11 +9,13 @@ from __future__ import unicode_literals
 
 from json import loads
 
+import attr
+
 from hypothesis import given
 
 from foolscap.furl import decode_furl
 
-from testtools.matchers import Equals
+from testtools.matchers import Equals, Not, Contains, Is
 
 from txkube import v1_5_model as model
 
@@ -21,7 +23,11 @@ from lae_util.testtools import TestCase
 
 from .strategies import deployment_configurations, subscription_details
 
-from ..containers import create_configuration
+from ..model import RouterLimits
+from .. import containers
+from ..containers import (
+    _RenderCache, _content_hash, create_configuration, create_deployment,
+)
 
 
 class CreateConfigurationTests(TestCase):
@@ -51,3 +57,145 @@ class CreateConfigurationTests(TestCase):
             introducer_furl,
             Equals(loads(config.data["storage.json"])["storage"]["introducer_furl"]),
         )
+
+
+
+class CreateDeploymentTests(TestCase):
+    """
+    Tests for ``create_deployment``.
+    """
+    @given(deployment_configurations(), subscription_details())
+    def test_router_limits(self, deploy_config, details):
+        """
+        The pod template is annotated with the grid router limits configured
+        for the subscription's plan.
+        """
+        deploy_config = attr.evolve(deploy_config, router_limits={
+            details.product_id: RouterLimits(bandwidth=1024, connections=10),
+        })
+        annotations = create_deployment(
+            deploy_config, details, model,
+        ).spec.template.metadata.annotations
+        self.expectThat(
+            annotations["leastauthority.com/router-bandwidth-limit"],
+            Equals("1024"),
+        )
+        self.expectThat(
+            annotations["leastauthority.com/router-connection-limit"],
+            Equals("10"),
+        )
+
+
+    @given(deployment_configurations(), subscription_details())
+    def test_partial_router_limits(self, deploy_config, details):
+        """
+        Only the limits configured for the subscription's plan are included in
+        the pod template annotations.
+        """
+        deploy_config = attr.evolve(deploy_config, router_limits={
+            details.product_id: RouterLimits(bandwidth=1024),
+            "other-plan": RouterLimits(connections=10),
+        })
+        annotations = create_deployment(
+            deploy_config, details, model,
+        ).spec.template.metadata.annotations
+        self.expectThat(
+            annotations,
+            Not(Contains("leastauthority.com/router-connection-limit")),
+        )
+
+
+
+class RenderCacheTests(TestCase):
+    """
+    Tests for the caching of rendered objects.
+    """
+    @given(deployment_configurations(), subscription_details())
+    def test_memoized(self, deploy_config, details):
+        """
+        ``create_deployment`` and ``create_configuration`` return the same
+        object for equal configuration and details and a different one if
+        either changes.
+        """
+        for create in [create_deployment, create_configuration]:
+            first = create(deploy_config, details, model)
+            self.expectThat(
+                create(attr.evolve(deploy_config), attr.assoc(details), model),
+                Is(first),
+            )
+            changed = create(
+                deploy_config,
+                attr.assoc(details, storage_port_number=details.storage_port_number + 1),
+                model,
+            )
+            self.expectThat(changed, Not(Is(first)))
+
+
+    def test_latest_only(self):
+        """
+        ``_RenderCache`` keeps only the objects rendered from the latest
+        details of each subscription, however many subscriptions there are.
+        """
+        renders = []
+        def render(key):
+            renders.append(key)
+            return key
+        config = deployment_configurations().example()
+        details = subscription_details().example()
+        sweep = list(
+            attr.assoc(details, subscription_id="{}".format(n))
+            for n in range(10)
+        )
+        changed = attr.assoc(sweep[0], storage_port_number=details.storage_port_number + 1)
+        cache = _RenderCache()
+        for each in sweep + sweep + [changed, sweep[0]]:
+            cache.get(config, each, "key", lambda each=each: render(each))
+        self.assertThat(renders, Equals(sweep + [changed, sweep[0]]))
+
+
+    def test_retain(self):
+        """
+        ``_RenderCache.retain`` discards the objects rendered for every
+        subscription except the given ones.
+        """
+        renders = []
+        def render(key):
+            renders.append(key)
+            return key
+        config = deployment_configurations().example()
+        details = subscription_details().example()
+        kept = attr.assoc(details, subscription_id="kept")
+        cancelled = attr.assoc(details, subscription_id="cancelled")
+        cache = _RenderCache()
+        for each in [kept, cancelled]:
+            cache.get(config, each, "key", lambda each=each: render(each))
+        cache.retain({kept.subscription_id})
+        self.expectThat(sorted(cache._entries), Equals([kept.subscription_id]))
+        for each in [kept, cancelled]:
+            cache.get(config, each, "key", lambda each=each: render(each))
+        self.expectThat(renders, Equals([kept, cancelled, cancelled]))
+
+
+    def test_hashed_once(self):
+        """
+        When several objects are rendered for each of several subscriptions
+        with one configuration, the configuration and each subscription's
+        details are hashed only once.
+        """
+        hashed = []
+        def content_hash(obj):
+            hashed.append(obj)
+            return _content_hash(obj)
+        self.patch(containers, "_content_hash", content_hash)
+
+        config = deployment_configurations().example()
+        details = subscription_details().example()
+        sweep = list(
+            attr.assoc(details, subscription_id="{}".format(n))
+            for n in range(3)
+        )
+        cache = _RenderCache()
+        for each in sweep:
+            for key in ["a", "b", "c"]:
+                cache.get(config, each, key, lambda: None)
+        self.assertThat(hashed, Equals(sweep[:1] + [config] + sweep[1:]))
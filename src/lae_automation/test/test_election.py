@@ -0,0 +1,87 @@
+# Copyright Least Authority Enterprises.
+# See LICENSE for details.
+
+"""
+Tests for ``lae_automation.election``.
+"""
+
+from testtools.matchers import Equals
+
+from twisted.internet.task import Clock
+
+from txkube import memory_kubernetes
+
+from lae_util.testtools import TestCase
+
+from ..kubeclient import KubeClient
+from ..election import LeaderElection
+
+
+
+class LeaderElectionTests(TestCase):
+    """
+    Tests for ``LeaderElection``.
+    """
+    def setUp(self):
+        super(LeaderElectionTests, self).setUp()
+        self.clock = Clock()
+        self.kube = KubeClient(k8s=memory_kubernetes().client())
+        self.elected = []
+
+
+    def election(self, identity):
+        election = LeaderElection(
+            self.clock, self.kube, u"testing", u"leader", identity, 30,
+        )
+        election.elected = lambda: self.elected.append(identity)
+        return election
+
+
+    def test_one_leader(self):
+        """
+        Only the first replica to renew takes the lease.  It keeps it for as
+        long as it renews it.
+        """
+        a = self.election(u"a")
+        b = self.election(u"b")
+        for n in range(3):
+            self.successResultOf(a.renew())
+            self.successResultOf(b.renew())
+            self.expectThat((a.leader, b.leader), Equals((True, False)))
+            self.clock.advance(20)
+        self.expectThat(self.elected, Equals([u"a"]))
+
+
+    def test_expired(self):
+        """
+        Once the lease expires, the leader stops leading and another replica
+        may take it.
+        """
+        a = self.election(u"a")
+        b = self.election(u"b")
+        self.successResultOf(a.renew())
+        self.clock.advance(30)
+        self.expectThat(a.leader, Equals(False))
+        self.successResultOf(b.renew())
+        self.expectThat(b.leader, Equals(True))
+        self.successResultOf(a.renew())
+        self.expectThat(a.leader, Equals(False))
+        self.expectThat(self.elected, Equals([u"a", u"b"]))
+
+
+    def test_stop(self):
+        """
+        A leader which stops gives up the lease so another replica can take it
+        straight away.
+        """
+        a = self.election(u"a")
+        b = self.election(u"b")
+        a.startService()
+        b.startService()
+        self.addCleanup(b.stopService)
+        self.expectThat(self.elected, Equals([u"a"]))
+        self.successResultOf(a.stopService())
+        self.expectThat(a.leader, Equals(False))
+        self.clock.advance(10)
+        self.expectThat(b.leader, Equals(True))
+        self.expectThat(self.elected, Equals([u"a", u"b"]))
@@ -0,0 +1,411 @@
+# Copyright Least Authority Enterprises.
+# See LICENSE for details.
+
+"""
+Tests for ``lae_automation.kubeclient``.
+"""
+
+from json import dumps
+
+from testtools.matchers import Equals, HasLength, Is, Not
+
+from twisted.python.url import URL
+from twisted.web.resource import Resource
+
+from txkube import (
+    KubernetesError, memory_kubernetes, network_kubernetes, v1_5_model as model,
+)
+
+from lae_util.testtools import TestCase
+from lae_util.memoryagent import MemoryAgent
+
+from ..kubeclient import (
+    KubeClient, WatchExpired, UnexpectedWatchResponse,
+    And, LabelSelector, LabelInSelector, NamespaceSelector,
+    _TxKubeNetwork,
+)
+
+
+class _EventsResource(Resource):
+    """
+    Respond to any request with a fixed response body, recording the request.
+    """
+    isLeaf = True
+
+    def __init__(self, code, body):
+        Resource.__init__(self)
+        self.code = code
+        self.body = body
+        self.requests = []
+
+    def render_GET(self, request):
+        self.requests.append(request)
+        request.setResponseCode(self.code)
+        return self.body
+
+    render_DELETE = render_GET
+
+
+
+class _PagesResource(Resource):
+    """
+    Respond to list requests with pages of a collection, using the index of
+    the next page as the ``continue`` token.
+    """
+    isLeaf = True
+
+    def __init__(self, pages):
+        Resource.__init__(self)
+        self.pages = pages
+        self.requests = []
+
+    def render_GET(self, request):
+        self.requests.append(request)
+        index = int(request.args.get(b"continue", [b"0"])[0])
+        page = model.iobject_to_raw(model.v1.PodList(items=self.pages[index]))
+        page[u"metadata"] = {u"resourceVersion": u"7"}
+        if index + 1 < len(self.pages):
+            page[u"metadata"][u"continue"] = u"{}".format(index + 1)
+        return dumps(page)
+
+
+
+def _event(event_type, obj):
+    return dumps({
+        u"type": event_type,
+        u"object": model.iobject_to_raw(obj),
+    }) + b"\n"
+
+
+
+def _pod(name, namespace=u"testing", labels=None):
+    return model.v1.Pod(
+        metadata=dict(
+            namespace=namespace, name=name, resourceVersion=u"5", labels=labels,
+        ),
+    )
+
+
+
+class TxKubeNetworkTests(TestCase):
+    """
+    Tests for ``_TxKubeNetwork``, which depends on private txkube APIs.  If
+    these fail after txkube is upgraded, ``_TxKubeNetwork`` must be ported to
+    whatever replaced those APIs.
+    """
+    def test_clients(self):
+        """
+        ``_TxKubeNetwork`` can be used with both network and in-memory txkube
+        clients.
+        """
+        network = network_kubernetes(
+            base_url=URL.fromText(u"https://kubernetes.invalid/"),
+            agent=MemoryAgent(Resource()),
+        )
+        for client in [network.client(), memory_kubernetes().client()]:
+            self.expectThat(_TxKubeNetwork.of(client), Not(Is(None)))
+
+
+    def test_collection_url(self):
+        """
+        ``_TxKubeNetwork.collection_url`` gives the location of a cluster-wide
+        or namespaced collection beneath the client's base URL.
+        """
+        network = _TxKubeNetwork.of(network_kubernetes(
+            base_url=URL.fromText(u"https://kubernetes.invalid/"),
+            agent=MemoryAgent(Resource()),
+        ).client())
+        self.expectThat(
+            network.collection_url(model.v1.Pod).asText(),
+            Equals(u"https://kubernetes.invalid/api/v1/pods"),
+        )
+        self.expectThat(
+            network.collection_url(model.v1beta1.Deployment, u"testing").asText(),
+            Equals(
+                u"https://kubernetes.invalid/apis/extensions/v1beta1/"
+                u"namespaces/testing/deployments"
+            ),
+        )
+
+
+    def test_request(self):
+        """
+        ``_TxKubeNetwork.request`` issues a request with the client's agent and
+        ``_TxKubeNetwork.check_status`` fails with ``KubernetesError`` for a
+        response with an unexpected code.
+        """
+        status = model.v1.Status(
+            status=u"Failure", code=404, reason=u"NotFound", message=u"missing",
+            details={}, metadata={},
+        )
+        resource = _EventsResource(404, dumps(model.iobject_to_raw(status)))
+        network = _TxKubeNetwork.of(network_kubernetes(
+            base_url=URL.fromText(u"https://kubernetes.invalid/"),
+            agent=MemoryAgent(resource),
+        ).client())
+        url = network.collection_url(model.v1.Pod, u"testing")
+        response = self.successResultOf(network.request(b"GET", url))
+        self.expectThat(
+            self.successResultOf(network.check_status(response, (404,))),
+            Is(response),
+        )
+        reason = self.failureResultOf(network.check_status(response), KubernetesError)
+        self.expectThat(reason.value.status, Equals(status))
+        [request] = resource.requests
+        self.expectThat(request.uri, Equals(b"/api/v1/namespaces/testing/pods"))
+
+
+
+class WatchTests(TestCase):
+    """
+    Tests for ``KubeClient.watch``.
+    """
+    def watch(self, code, body):
+        resource = _EventsResource(code, body)
+        kubernetes = network_kubernetes(
+            base_url=URL.fromText(u"https://kubernetes.invalid/"),
+            agent=MemoryAgent(resource),
+        )
+        events = []
+        d = KubeClient(k8s=kubernetes.client()).watch(
+            model.v1.Pod, u"testing", {u"app": u"s4"}, u"3", events.append,
+            lambda: events.append(u"established"),
+        )
+        return resource, events, d
+
+
+    def test_events(self):
+        """
+        Once the server accepts the watch, each event in the response body is
+        passed to the event handler and the returned ``Deferred`` fires when
+        the response is complete.
+        """
+        resource, events, d = self.watch(
+            200, _event(u"ADDED", _pod(u"a")) + _event(u"DELETED", _pod(u"b")),
+        )
+        self.assertThat(self.successResultOf(d), Equals(None))
+        established, events = events[0], events[1:]
+        self.expectThat(established, Equals(u"established"))
+        self.expectThat(
+            list((event.type, event.object.metadata.name) for event in events),
+            Equals([(u"ADDED", u"a"), (u"DELETED", u"b")]),
+        )
+        [request] = resource.requests
+        self.expectThat(
+            request.uri,
+            Equals(
+                b"/api/v1/namespaces/testing/pods"
+                b"?watch=true&labelSelector=app%3Ds4&resourceVersion=3"
+            ),
+        )
+
+
+    def test_expired(self):
+        """
+        If the server reports the resource version has expired, the returned
+        ``Deferred`` fails with ``WatchExpired``.
+        """
+        status = model.v1.Status(
+            status=u"Failure", code=410, reason=u"Gone", message=u"too old",
+            details={}, metadata={},
+        )
+        resource, events, d = self.watch(200, _event(u"ERROR", status))
+        self.failureResultOf(d, WatchExpired)
+        self.expectThat(events, Equals([u"established"]))
+
+
+    def test_expired_response(self):
+        """
+        If the server responds to the watch request with *410 Gone*, the
+        returned ``Deferred`` fails with ``WatchExpired``.
+        """
+        resource, events, d = self.watch(410, b"too old")
+        self.failureResultOf(d, WatchExpired)
+        # The watch was never established.
+        self.expectThat(events, HasLength(0))
+
+
+    def test_error_response(self):
+        """
+        If the server responds with an error code, the returned ``Deferred``
+        fails with ``UnexpectedWatchResponse``.
+        """
+        resource, events, d = self.watch(500, b"broken")
+        reason = self.failureResultOf(d, UnexpectedWatchResponse)
+        self.expectThat(reason.value.code, Equals(500))
+
+
+
+class ListTests(TestCase):
+    """
+    Tests for ``KubeClient.list``.
+    """
+    selector = And([
+        LabelSelector({u"app": u"s4", u"component": u"Tahoe-LAFS"}),
+        NamespaceSelector(u"testing"),
+    ])
+
+    def test_server_side(self):
+        """
+        With a network client, the namespace's collection is listed with the
+        rest of the selector sent to the server as a ``labelSelector``.
+        """
+        pods = model.v1.PodList(
+            metadata=dict(resourceVersion=u"7"),
+            items=[
+                _pod(u"a", labels={u"app": u"s4", u"component": u"Tahoe-LAFS"}),
+            ],
+        )
+        resource = _EventsResource(200, dumps(model.iobject_to_raw(pods)))
+        kubernetes = network_kubernetes(
+            base_url=URL.fromText(u"https://kubernetes.invalid/"),
+            agent=MemoryAgent(resource),
+        )
+        d = KubeClient(k8s=kubernetes.client()).list(model.v1.Pod, self.selector)
+        self.expectThat(self.successResultOf(d), Equals(pods))
+        [request] = resource.requests
+        self.expectThat(
+            request.uri,
+            Equals(
+                b"/api/v1/namespaces/testing/pods"
+                b"?labelSelector=app%3Ds4,component%3DTahoe-LAFS"
+            ),
+        )
+
+
+    def test_client_side(self):
+        """
+        With a server which ignores the selectors and only serves the
+        cluster-wide collection, only the matching objects are included in
+        the result anyway.
+        """
+        client = memory_kubernetes().client()
+        labels = {u"app": u"s4", u"component": u"Tahoe-LAFS"}
+        for pod in [
+            _pod(u"a", labels=labels),
+            _pod(u"b", labels={u"app": u"s4"}),
+            _pod(u"c", namespace=u"other", labels=labels),
+            _pod(u"d"),
+        ]:
+            self.successResultOf(client.create(pod))
+        d = KubeClient(k8s=client).list(model.v1.Pod, self.selector)
+        self.assertThat(
+            list(pod.metadata.name for pod in self.successResultOf(d).items),
+            Equals([u"a"]),
+        )
+
+
+
+class ListPagesTests(TestCase):
+    """
+    Tests for ``KubeClient.list_pages``.
+    """
+    def test_pages(self):
+        """
+        Each page is requested with ``limit`` and the ``continue`` token from
+        the previous page and the matching objects on it are passed to the
+        page handler.
+        """
+        labels = {u"app": u"s4"}
+        resource = _PagesResource([
+            [_pod(u"a", labels=labels), _pod(u"b")],
+            [_pod(u"c", labels=labels)],
+        ])
+        kubernetes = network_kubernetes(
+            base_url=URL.fromText(u"https://kubernetes.invalid/"),
+            agent=MemoryAgent(resource),
+        )
+        pages = []
+        d = KubeClient(k8s=kubernetes.client()).list_pages(
+            model.v1.Pod, LabelSelector(labels), pages.append, page_size=2,
+        )
+        self.assertThat(self.successResultOf(d), Equals(None))
+        self.expectThat(
+            list(list(pod.metadata.name for pod in page) for page in pages),
+            Equals([[u"a"], [u"c"]]),
+        )
+        self.expectThat(
+            list(request.uri for request in resource.requests),
+            Equals([
+                b"/api/v1/pods?labelSelector=app%3Ds4&limit=2",
+                b"/api/v1/pods?labelSelector=app%3Ds4&limit=2&continue=1",
+            ]),
+        )
+
+
+    def test_unpaged(self):
+        """
+        With a server which ignores ``limit``, all of the matching objects are
+        passed to the page handler at once.
+        """
+        client = memory_kubernetes().client()
+        for pod in [_pod(u"a", labels={u"app": u"s4"}), _pod(u"b")]:
+            self.successResultOf(client.create(pod))
+        pages = []
+        d = KubeClient(k8s=client).list_pages(
+            model.v1.Pod, LabelSelector({u"app": u"s4"}), pages.append,
+        )
+        self.assertThat(self.successResultOf(d), Equals(None))
+        self.expectThat(
+            list(list(pod.metadata.name for pod in page) for page in pages),
+            Equals([[u"a"]]),
+        )
+
+
+
+class DeleteCollectionTests(TestCase):
+    """
+    Tests for ``KubeClient.delete_collection``.
+    """
+    selector = And([
+        LabelSelector({u"app": u"s4"}),
+        LabelInSelector(u"subscription", [u"b", u"a"]),
+        NamespaceSelector(u"testing"),
+    ])
+
+    def test_server_side(self):
+        """
+        With a network client, the objects are deleted by one request to the
+        namespace's collection with the selector as a ``labelSelector``.
+        """
+        status = model.v1.Status(status=u"Success")
+        resource = _EventsResource(200, dumps(model.iobject_to_raw(status)))
+        kubernetes = network_kubernetes(
+            base_url=URL.fromText(u"https://kubernetes.invalid/"),
+            agent=MemoryAgent(resource),
+        )
+        d = KubeClient(k8s=kubernetes.client()).delete_collection(
+            model.v1.Pod, self.selector,
+        )
+        self.expectThat(self.successResultOf(d), Equals(None))
+        [request] = resource.requests
+        self.expectThat(request.method, Equals(b"DELETE"))
+        self.expectThat(
+            request.uri,
+            Equals(
+                b"/api/v1/namespaces/testing/pods"
+                b"?labelSelector=app%3Ds4,subscription%20in%20(a,b)"
+            ),
+        )
+
+
+    def test_client_side(self):
+        """
+        With a server which does not allow deleting a collection, the matching
+        objects are deleted one by one.
+        """
+        client = memory_kubernetes().client()
+        for pod in [
+            _pod(u"a", labels={u"app": u"s4", u"subscription": u"a"}),
+            _pod(u"b", labels={u"app": u"s4", u"subscription": u"b"}),
+            _pod(u"c", labels={u"app": u"s4", u"subscription": u"c"}),
+            _pod(u"d", namespace=u"other", labels={u"app": u"s4", u"subscription": u"a"}),
+        ]:
+            self.successResultOf(client.create(pod))
+        d = KubeClient(k8s=client).delete_collection(model.v1.Pod, self.selector)
+        self.expectThat(self.successResultOf(d), Equals(None))
+        pods = self.successResultOf(client.list(model.v1.Pod))
+        self.expectThat(
+            sorted(pod.metadata.name for pod in pods.items),
+            Equals([u"c", u"d"]),
+        )
@@ -0,0 +1,140 @@
+# Copyright Least Authority Enterprises.
+# See LICENSE for details.
+
+"""
+Tests for ``lae_automation.sharding``.
+"""
+
+from testtools.matchers import Equals
+
+from twisted.internet.task import Clock
+
+from txkube import memory_kubernetes
+
+from lae_util.testtools import TestCase
+
+from ..kubeclient import KubeClient
+from ..sharding import (
+    SHARD_CONFIGMAP_NAME, Shard, ShardMembership, shard_owner,
+)
+
+SUBSCRIPTIONS = list(u"subscription-{}".format(n) for n in range(200))
+
+
+
+class ShardOwnerTests(TestCase):
+    """
+    Tests for ``shard_owner`` and ``Shard``.
+    """
+    def test_spread(self):
+        """
+        Every member owns some subscriptions.
+        """
+        members = [u"a", u"b", u"c"]
+        owners = set(shard_owner(sid, members) for sid in SUBSCRIPTIONS)
+        self.assertThat(owners, Equals(set(members)))
+
+
+    def test_join(self):
+        """
+        When a member joins, the only subscriptions which change owner are
+        those which move to it.
+        """
+        before = {sid: shard_owner(sid, [u"a", u"b"]) for sid in SUBSCRIPTIONS}
+        after = {sid: shard_owner(sid, [u"c", u"a", u"b"]) for sid in SUBSCRIPTIONS}
+        moved = set(after[sid] for sid in SUBSCRIPTIONS if after[sid] != before[sid])
+        self.assertThat(moved, Equals({u"c"}))
+
+
+    def test_shard(self):
+        """
+        ``Shard.owns`` agrees with ``shard_owner`` and the member with the
+        lowest identity is the leader.
+        """
+        shards = list(Shard(identity=m, members=[u"b", u"a"]) for m in [u"a", u"b"])
+        self.expectThat(list(s.leader for s in shards), Equals([True, False]))
+        for sid in SUBSCRIPTIONS:
+            self.expectThat(
+                list(s.owns(sid) for s in shards),
+                Equals(list(shard_owner(sid, [u"a", u"b"]) == s.identity for s in shards)),
+            )
+
+
+
+class ShardMembershipTests(TestCase):
+    """
+    Tests for ``ShardMembership``.
+    """
+    def setUp(self):
+        super(ShardMembershipTests, self).setUp()
+        self.clock = Clock()
+        self.kube = KubeClient(k8s=memory_kubernetes().client())
+
+
+    def membership(self, identity):
+        return ShardMembership(self.clock, self.kube, u"testing", identity, 60)
+
+
+    def test_members(self):
+        """
+        Each member's heartbeat finds the members which have recorded
+        themselves within the last ``ttl`` seconds.
+        """
+        a = self.membership(u"a")
+        b = self.membership(u"b")
+        self.expectThat(
+            self.successResultOf(a.heartbeat()),
+            Equals(Shard(identity=u"a", members=[u"a"])),
+        )
+        self.clock.advance(30)
+        self.expectThat(
+            self.successResultOf(b.heartbeat()),
+            Equals(Shard(identity=u"b", members=[u"a", u"b"])),
+        )
+        self.clock.advance(30)
+        self.expectThat(
+            self.successResultOf(b.heartbeat()),
+            Equals(Shard(identity=u"b", members=[u"b"])),
+        )
+        self.expectThat(
+            self.successResultOf(a.heartbeat()),
+            Equals(Shard(identity=u"a", members=[u"a", u"b"])),
+        )
+
+
+    def test_configmap(self):
+        """
+        The members are recorded in a ConfigMap with the time each record
+        expires.
+        """
+        self.clock.advance(1000)
+        self.successResultOf(self.membership(u"a").heartbeat())
+        configmap = self.successResultOf(self.kube.get(
+            self.kube.k8s.model.v1.ConfigMap(
+                metadata=dict(namespace=u"testing", name=SHARD_CONFIGMAP_NAME),
+            ),
+        ))
+        self.assertThat(configmap.data, Equals({u"a": u"1060.000"}))
+
+
+    def test_service(self):
+        """
+        While the service runs, the member's record is renewed three times
+        per ``ttl`` and its shard is known.  Once the record has expired
+        without being renewed, the shard is no longer known.
+        """
+        membership = self.membership(u"a")
+        self.expectThat(membership.shard, Equals(None))
+        membership.startService()
+        self.expectThat(membership.shard, Equals(Shard(identity=u"a", members=[u"a"])))
+        self.successResultOf(self.membership(u"b").heartbeat())
+        self.clock.advance(20)
+        self.expectThat(
+            membership.shard,
+            Equals(Shard(identity=u"a", members=[u"a", u"b"])),
+        )
+        membership.stopService()
+        self.clock.advance(59)
+        self.expectThat(membership.shard, Equals(Shard(identity=u"a", members=[u"a", u"b"])))
+        self.clock.advance(1)
+        self.expectThat(membership.shard, Equals(None))
@@ -5,7 +5,8 @@
 Tests for ``lae_automation.subscription_converger``.
 """
 
-from json import dumps
+from io import BytesIO
+from json import dumps, loads
 
 from zope.interface.verify import verifyObject
 
@@ -24,16 +25,22 @@ from testtools.assertions import assert_that
 from testtools.matchers import (
     AfterPreprocessing, Equals, Is, Not, MatchesPredicate, LessThan,
     GreaterThan, MatchesAll, MatchesRegex, Contains, HasLength,
-    MatchesAny,
+    MatchesAny, Raises, MatchesException,
 )
 
 from twisted.python.filepath import FilePath
+from twisted.python.usage import UsageError
 from twisted.application.service import IService
 from twisted.python.failure import Failure
+from twisted.python.components import proxyForInterface
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.task import Clock
 
 from txaws.testing.service import FakeAWSServiceRegion
-from txaws.route53.model import RRSetKey, RRSet, HostedZone
-from txaws.route53.client import Name, CNAME
+from txaws.route53.model import (
+    RRSetKey, RRSet, HostedZone, upsert_rrset, delete_rrset,
+)
+from txaws.route53.client import Name, CNAME, Route53Error
 
 from lae_util.k8s import (
     derive_pod, derive_replicaset, get_replicasets, get_pods,
@@ -51,14 +58,43 @@ from lae_automation.subscription_converger import (
     get_customer_grid_service,
     converge, get_hosted_zone_by_name,
     divert_errors_to_log,
+    _load_router_limits,
+    _EventDrivenConvergence,
+    _Job,
+    _Outcome,
+    _execute_converge_outputs,
+    _ConvergeScheduler,
+    plan,
+    _PlanService,
+    _route53_batches,
+    change_route53_batch,
+    _rrset_for_subscription,
+    _ZoneState,
+    _ZoneCache,
+    _BucketCache,
+    _CachingRegion,
+    list_all_rrsets,
+    _State,
+    _converge_deployments,
+    _converge_configmaps,
+    _converge_replicasets,
+    _converge_pods,
+    _router_limits,
 )
+from lae_automation.model import RouterLimits
 from lae_automation.containers import (
+    CONTAINERIZED_SUBSCRIPTION_VERSION,
+    CONFIGURATION_HASH_ANNOTATION,
+    ROUTER_BANDWIDTH_LIMIT_ANNOTATION,
+    ROUTER_CONNECTION_LIMIT_ANNOTATION,
+    configuration_hash,
     S4_CUSTOMER_GRID_NAME,
     new_service,
     create_configuration,
     create_deployment,
     configmap_name,
     deployment_name,
+    _render_cache,
 )
 from lae_automation.signup import get_bucket_name
 
@@ -66,9 +102,11 @@ from .strategies import (
     domains, subscription_id, subscription_details, deployment_configuration,
     node_pems, ipv4_addresses,
 )
-from ..kubeclient import KubeClient
+from ..kubeclient import KubeClient, WatchEvent
+from ..sharding import Shard
+from ..election import LeaderElection
 
-from txkube import memory_kubernetes
+from txkube import IKubernetesClient, memory_kubernetes
 
 def is_lower():
     return MatchesPredicate(
@@ -166,6 +204,528 @@ class ConvergeHelperTests(TestCase):
 
 
 
+class DeploymentUpdateTests(TestCase):
+    """
+    Tests for the changes ``_converge_deployments`` and
+    ``_converge_configmaps`` make to existing deployments and configmaps.
+    """
+    def setUp(self):
+        super(DeploymentUpdateTests, self).setUp()
+        self.kubernetes = memory_kubernetes()
+        self.client = KubeClient(k8s=self.kubernetes.client())
+        self.config = deployment_configuration().example()
+        self.subscriptions = {
+            sid: attr.assoc(subscription_details().example(), subscription_id=sid)
+            for sid in [u"first", u"second"]
+        }
+        # Deployments made by some older version of the converger.
+        for subscription in self.subscriptions.values():
+            deployment = create_deployment(
+                self.config, subscription, self.client.k8s.model,
+            ).transform(
+                [u"metadata", u"labels", u"version"], u"0",
+                # Something the converger does not manage which is lost if
+                # the deployment is deleted and created again.
+                [u"metadata", u"annotations", u"example"], u"kept",
+            )
+            self.successResultOf(self.client.create(deployment))
+
+
+    def converge(self, config):
+        actual = _State(
+            subscriptions=self.subscriptions,
+            deployments=self.successResultOf(self.client.get_deployments()),
+        )
+        jobs = _converge_deployments(actual, config, None, self.client, None, None)
+        self.successResultOf(_execute_converge_outputs(jobs))
+        return {
+            deployment.metadata.annotations[u"subscription"]: deployment
+            for deployment
+            in self.successResultOf(self.client.get_deployments())
+        }
+
+
+    def test_in_place(self):
+        """
+        Outdated deployments are replaced by up-to-date ones rather than being
+        deleted.
+        """
+        after = self.converge(self.config)
+        self.expectThat(
+            set(d.metadata.annotations.get(u"example") for d in after.values()),
+            Equals({u"kept"}),
+        )
+        self.expectThat(
+            set(d.metadata.labels[u"version"] for d in after.values()),
+            Equals({CONTAINERIZED_SUBSCRIPTION_VERSION}),
+        )
+
+
+    def test_max_disruption(self):
+        """
+        No more deployments are updated in one pass of convergence than the
+        configured maximum disruption allows.  Later passes update the rest.
+        """
+        config = attr.assoc(self.config, max_disruption=1)
+        after = self.converge(config)
+        self.expectThat(
+            {sid: d.metadata.labels[u"version"] for (sid, d) in after.items()},
+            Equals({u"first": CONTAINERIZED_SUBSCRIPTION_VERSION, u"second": u"0"}),
+        )
+        after = self.converge(config)
+        self.expectThat(
+            after[u"second"].metadata.labels[u"version"],
+            Equals(CONTAINERIZED_SUBSCRIPTION_VERSION),
+        )
+
+
+
+    def test_router_limits_changed(self):
+        """
+        When the grid router limits of a subscription's plan change, its
+        deployment and pod template are given the new limits.  Limits the
+        plan no longer has are removed.
+        """
+        def limits(**kwargs):
+            return attr.assoc(self.config, router_limits={
+                subscription.product_id: RouterLimits(**kwargs)
+                for subscription in self.subscriptions.values()
+            })
+
+        def annotations(deployments):
+            return {
+                sid: (
+                    _router_limits(deployment),
+                    _router_limits(deployment.spec.template),
+                )
+                for (sid, deployment) in deployments.items()
+            }
+
+        def expected(limits):
+            return {
+                sid: (limits, limits)
+                for sid in self.subscriptions
+            }
+
+        self.expectThat(
+            annotations(self.converge(limits(bandwidth=1024, connections=10))),
+            Equals(expected({
+                ROUTER_BANDWIDTH_LIMIT_ANNOTATION: u"1024",
+                ROUTER_CONNECTION_LIMIT_ANNOTATION: u"10",
+            })),
+        )
+        self.expectThat(
+            annotations(self.converge(limits(connections=5))),
+            Equals(expected({ROUTER_CONNECTION_LIMIT_ANNOTATION: u"5"})),
+        )
+        self.expectThat(
+            annotations(self.converge(self.config)),
+            Equals(expected({})),
+        )
+
+
+    def test_configuration_changed(self):
+        """
+        When the configuration for a subscription changes, its configmap is
+        changed and its deployment's pod template is given the hash of the
+        new configuration so that Kubernetes replaces the pods.
+        """
+        for subscription in self.subscriptions.values():
+            self.successResultOf(self.client.create(create_configuration(
+                self.config, subscription, self.client.k8s.model,
+            )))
+        self.converge(self.config)
+
+        config = attr.assoc(self.config, s3_secret_key=u"new secret")
+        actual = _State(
+            subscriptions=self.subscriptions,
+            configmaps=self.successResultOf(self.client.get_configmaps()),
+        )
+        jobs = _converge_configmaps(actual, config, None, self.client, None, None)
+        self.successResultOf(_execute_converge_outputs(jobs))
+        deployments = self.converge(config)
+
+        expected = {
+            sid: configuration_hash(config, subscription)
+            for (sid, subscription) in self.subscriptions.items()
+        }
+        self.expectThat(
+            {
+                configmap.metadata.annotations[u"subscription"]: (
+                    configmap.metadata.annotations[CONFIGURATION_HASH_ANNOTATION]
+                )
+                for configmap
+                in self.successResultOf(self.client.get_configmaps())
+            },
+            Equals(expected),
+        )
+        self.expectThat(
+            {
+                sid: deployment.spec.template.metadata.annotations[
+                    CONFIGURATION_HASH_ANNOTATION
+                ]
+                for (sid, deployment) in deployments.items()
+            },
+            Equals(expected),
+        )
+
+
+
+def _route53_error(code):
+    return Route53Error(
+        b'<?xml version="1.0"?>\n'
+        b'<ErrorResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">'
+        b'<Error><Type>Sender</Type><Code>%s</Code><Message>No</Message></Error>'
+        b'<RequestId>abc</RequestId>'
+        b'</ErrorResponse>' % (code,),
+        400,
+    )
+
+
+
+@attr.s
+class _ScriptedRoute53(object):
+    """
+    A Route53 client which gives canned responses to change requests.
+
+    :ivar respond: A one-argument callable which is called with each list of
+        changes and returns the result of the request.
+    """
+    respond = attr.ib()
+    requests = attr.ib(default=attr.Factory(list))
+
+    def change_resource_record_sets(self, zone_id, changes):
+        self.requests.append(list(changes))
+        return self.respond(changes)
+
+
+
+class OrphanTests(TestCase):
+    """
+    Tests for the replicasets and pods ``_converge_replicasets`` and
+    ``_converge_pods`` delete.
+    """
+    def setUp(self):
+        super(OrphanTests, self).setUp()
+        self.kubernetes = memory_kubernetes()
+        self.client = KubeClient(k8s=self.kubernetes.client())
+        self.config = deployment_configuration().example()
+        self.subscriptions = {
+            sid: attr.assoc(subscription_details().example(), subscription_id=sid)
+            for sid in [u"first", u"second", u"third"]
+        }
+        model = self.client.k8s.model
+        for subscription in self.subscriptions.values():
+            deployment = create_deployment(self.config, subscription, model)
+            self.successResultOf(self.client.create(
+                derive_replicaset(model, deployment),
+            ))
+            self.successResultOf(self.client.create(
+                derive_pod(model, deployment, u"10.0.0.1"),
+            ))
+
+
+    def owners(self, objects):
+        return sorted(obj.metadata.annotations[u"subscription"] for obj in objects)
+
+
+    def test_grouped(self):
+        """
+        The replicasets and pods of all of the cancelled subscriptions are
+        deleted by one job for each kind.  Those of active subscriptions are
+        left alone.
+        """
+        actual = _State(
+            subscriptions={u"third": self.subscriptions[u"third"]},
+            replicasets=self.successResultOf(self.client.get_replicasets()),
+            pods=self.successResultOf(self.client.get_pods()),
+        )
+        jobs = (
+            _converge_replicasets(actual, self.config, None, self.client, None, None) +
+            _converge_pods(actual, self.config, None, self.client, None, None)
+        )
+        self.expectThat(
+            list(job.description for job in jobs),
+            Equals([
+                {u"action": u"delete-replicasets", u"subscriptions": [u"first", u"second"]},
+                {u"action": u"delete-pods", u"subscriptions": [u"first", u"second"]},
+            ]),
+        )
+        self.successResultOf(_execute_converge_outputs(jobs))
+        self.expectThat(
+            self.owners(self.successResultOf(self.client.get_replicasets())),
+            Equals([u"third"]),
+        )
+        self.expectThat(
+            self.owners(self.successResultOf(self.client.get_pods())),
+            Equals([u"third"]),
+        )
+
+
+
+class Route53BatchTests(TestCase):
+    """
+    Tests for ``_route53_batches`` and ``change_route53_batch``.
+    """
+    def setUp(self):
+        super(Route53BatchTests, self).setUp()
+        self.zone = HostedZone(
+            name=u"example.invalid.",
+            identifier=u"abcdef",
+            rrset_count=0,
+            reference=u"unique string",
+        )
+
+
+    def rrset(self, n):
+        return RRSet(
+            label=Name(u"{}.example.invalid.".format(n)),
+            type=u"CNAME",
+            ttl=60,
+            records={CNAME(canonical_name=Name(u"introducer.example.invalid."))},
+        )
+
+
+    def test_batches(self):
+        """
+        ``_route53_batches`` puts as many changes in each batch as Route53
+        allows, counting upserts twice, and keeps them in order.
+        """
+        upserts = list(upsert_rrset(self.rrset(n)) for n in range(600))
+        deletes = list(delete_rrset(self.rrset(n)) for n in range(1200))
+        self.expectThat(
+            list(len(batch) for batch in _route53_batches(upserts)),
+            Equals([500, 100]),
+        )
+        self.expectThat(
+            list(len(batch) for batch in _route53_batches(deletes)),
+            Equals([1000, 200]),
+        )
+        changes = deletes[:998] + upserts[:2]
+        self.expectThat(
+            _route53_batches(changes),
+            Equals([deletes[:998] + upserts[:1], upserts[1:2]]),
+        )
+        self.expectThat(_route53_batches([]), Equals([]))
+
+
+    def test_throttled(self):
+        """
+        ``change_route53_batch`` retries the request after a delay while
+        Route53 says it is throttling requests.
+        """
+        responses = [
+            fail(_route53_error(b"Throttling")),
+            fail(_route53_error(b"PriorRequestNotComplete")),
+            succeed(None),
+        ]
+        route53 = _ScriptedRoute53(lambda changes: responses.pop(0))
+        clock = Clock()
+        changes = [upsert_rrset(self.rrset(0))]
+        d = change_route53_batch(clock, route53, self.zone, changes)
+        self.expectThat(route53.requests, HasLength(1))
+        clock.advance(2)
+        clock.advance(3)
+        self.assertThat(self.successResultOf(d), Is(None))
+        self.expectThat(route53.requests, Equals([changes] * 3))
+
+
+    @capture_logging(None)
+    def test_invalid_batch(self, logger):
+        """
+        If Route53 rejects a batch because of one of its changes,
+        ``change_route53_batch`` splits the batch until the bad change is on
+        its own and makes the other changes.
+        """
+        bad = delete_rrset(self.rrset(1))
+        def respond(changes):
+            if bad in changes:
+                return fail(_route53_error(b"InvalidChangeBatch"))
+            return succeed(None)
+        route53 = _ScriptedRoute53(respond)
+        changes = list(upsert_rrset(self.rrset(n)) for n in range(4))
+        changes[1] = bad
+        d = change_route53_batch(Clock(), route53, self.zone, changes)
+        self.failureResultOf(d, Route53Error)
+        self.expectThat(
+            route53.requests,
+            Equals([changes, changes[:2], changes[:1], changes[1:2], changes[2:]]),
+        )
+        logger.flush_tracebacks(Route53Error)
+
+
+    def test_other_error(self):
+        """
+        ``change_route53_batch`` gives up right away if Route53 fails the
+        request for another reason.
+        """
+        route53 = _ScriptedRoute53(
+            lambda changes: fail(_route53_error(b"AccessDenied")),
+        )
+        changes = [upsert_rrset(self.rrset(0)), upsert_rrset(self.rrset(1))]
+        d = change_route53_batch(Clock(), route53, self.zone, changes)
+        self.failureResultOf(d, Route53Error)
+        self.expectThat(route53.requests, HasLength(1))
+
+
+
+@attr.s
+class _PagingRoute53(object):
+    """
+    A Route53 client which lists rrsets a page at a time the way Route53
+    does.
+    """
+    rrsets = attr.ib()
+    requests = attr.ib(default=attr.Factory(list))
+
+    def list_resource_record_sets(self, zone_id, maxitems=None, name=None, type=None):
+        self.requests.append((name, type))
+        def order(key):
+            return (key.label.text.split(u".")[::-1], key.type)
+        keys = sorted(self.rrsets, key=order)
+        if name is not None:
+            start = order(RRSetKey(label=name, type=type))
+            keys = list(key for key in keys if order(key) >= start)
+        return succeed({key: self.rrsets[key] for key in keys[:maxitems]})
+
+
+
+class ZoneTests(TestCase):
+    """
+    Tests for ``list_all_rrsets``, ``_ZoneState``, and ``_ZoneCache``.
+    """
+    def setUp(self):
+        super(ZoneTests, self).setUp()
+        self.zone = HostedZone(
+            name=u"s4.example.com.",
+            identifier=u"abcdef",
+            rrset_count=0,
+            reference=u"unique string",
+        )
+
+
+    def rrset(self, sid):
+        rrset = _rrset_for_subscription(sid, self.zone.name)
+        return RRSetKey(label=rrset.label, type=rrset.type), rrset
+
+
+    def test_list_all_rrsets(self):
+        """
+        ``list_all_rrsets`` gets all of the rrsets from a zone which has more
+        than fit in one response.
+        """
+        rrsets = dict(self.rrset(u"sid-{}".format(n)) for n in range(25))
+        rrsets[RRSetKey(label=Name(u"s4.example.com"), type=u"SOA")] = None
+        route53 = _PagingRoute53(rrsets)
+        d = list_all_rrsets(route53, self.zone.identifier, page_size=10)
+        self.expectThat(self.successResultOf(d), Equals(rrsets))
+        self.expectThat(route53.requests, HasLength(3))
+
+
+    def test_index(self):
+        """
+        ``_ZoneState`` maps each subscription to the key of its rrset and
+        keeps the mapping up to date as changes are applied.
+        """
+        other = RRSetKey(label=Name(u"s4.example.com"), type=u"SOA")
+        a_key, a_rrset = self.rrset(u"a")
+        b_key, b_rrset = self.rrset(u"b")
+        state = _ZoneState.from_rrsets(
+            self.zone, {a_key: a_rrset, other: None},
+        )
+        self.expectThat(state.subscriptions, Equals({u"a": a_key}))
+
+        state = state.apply([upsert_rrset(b_rrset), delete_rrset(a_rrset)])
+        self.expectThat(state.subscriptions, Equals({u"b": b_key}))
+        self.expectThat(state.rrsets, Equals({b_key: b_rrset, other: None}))
+
+
+    def test_cache(self):
+        """
+        ``_ZoneCache`` loads a zone once per ``ttl`` seconds and in between
+        applies the changes made through a ``_CachingRegion``.
+        """
+        region = FakeAWSServiceRegion(
+            access_key="access key id",
+            secret_key="secret access key",
+        )
+        route53 = region.get_route53_client()
+        zone = self.successResultOf(
+            route53.create_hosted_zone(u"unique", self.zone.name),
+        )
+        clock = Clock()
+        aws = _CachingRegion(region, _ZoneCache(clock, 60), _BucketCache(clock, 60))
+        get = lambda: self.successResultOf(
+            aws.zones.get(aws.get_route53_client(), Name(self.zone.name)),
+        )
+        self.expectThat(get().subscriptions, Equals({}))
+
+        a_key, a_rrset = self.rrset(u"a")
+        b_key, b_rrset = self.rrset(u"b")
+        # Made behind the converger's back.
+        self.successResultOf(route53.change_resource_record_sets(
+            zone.identifier, [upsert_rrset(a_rrset)],
+        ))
+        # Made by the converger.
+        self.successResultOf(aws.get_route53_client().change_resource_record_sets(
+            zone.identifier, [upsert_rrset(b_rrset)],
+        ))
+        self.expectThat(get().subscriptions, Equals({u"b": b_key}))
+
+        clock.advance(60)
+        self.expectThat(
+            get().subscriptions, Equals({u"a": a_key, u"b": b_key}),
+        )
+
+
+
+class BucketCacheTests(TestCase):
+    """
+    Tests for ``_BucketCache``.
+    """
+    def test_cache(self):
+        """
+        ``_BucketCache`` lists the buckets once per ``ttl`` seconds, adds the
+        buckets created through a ``_CachingRegion`` in between, and
+        remembers which subscriptions have a bucket.
+        """
+        region = FakeAWSServiceRegion(
+            access_key="access key id",
+            secret_key="secret access key",
+        )
+        s3 = region.get_s3_client()
+        clock = Clock()
+        aws = _CachingRegion(region, _ZoneCache(clock, 60), _BucketCache(clock, 60))
+        a, b = (
+            attr.assoc(subscription_details().example(), subscription_id=sid)
+            for sid in [u"a", u"b"]
+        )
+        subscriptions = {u"a": a, u"b": b}
+        a_bucket = get_bucket_name(u"a", a.customer_id)
+        b_bucket = get_bucket_name(u"b", b.customer_id)
+
+        self.successResultOf(aws.buckets.get(aws.get_s3_client()))
+        self.expectThat(aws.buckets.confirm(subscriptions).subscriptions, Equals({}))
+
+        # Made behind the converger's back.
+        self.successResultOf(s3.create_bucket(a_bucket))
+        # Made by the converger.
+        self.successResultOf(aws.get_s3_client().create_bucket(b_bucket))
+        self.successResultOf(aws.buckets.get(aws.get_s3_client()))
+        self.expectThat(
+            aws.buckets.confirm(subscriptions).subscriptions,
+            Equals({u"b": b_bucket}),
+        )
+
+        clock.advance(60)
+        self.successResultOf(aws.buckets.get(aws.get_s3_client()))
+        self.expectThat(
+            aws.buckets.confirm(subscriptions).subscriptions,
+            Equals({u"a": a_bucket, u"b": b_bucket}),
+        )
+
+
+
 class MakeServiceTests(TestCase):
     def test_interface(self):
         """
@@ -226,6 +786,319 @@ class MakeServiceTests(TestCase):
         verifyObject(IService, service)
 
 
+
+class OptionsTests(TestCase):
+    """
+    Tests for ``Options``.
+    """
+    def options(self, *extra):
+        options = Options()
+        options.parseOptions([
+            b"--domain", b"s4.example.com",
+            b"--endpoint", b"http://localhost:8000/",
+            b"--kubernetes-namespace", b"testing",
+            b"--k8s-context", b"testing",
+        ] + list(extra))
+        return options
+
+
+    def test_concurrency(self):
+        """
+        ``Options`` accepts a concurrency limit for each target and rejects
+        one less than one.
+        """
+        for option in [b"--kubernetes-concurrency", b"--route53-concurrency", b"--s3-concurrency"]:
+            self.expectThat(self.options(option, b"3")[option[2:]], Equals(3))
+            self.expectThat(
+                lambda option=option: self.options(option, b"0"),
+                Raises(MatchesException(UsageError)),
+            )
+
+
+    def test_shard_identity(self):
+        """
+        ``Options`` rejects ``--shard-identity`` with ``--event-driven``.
+        """
+        self.expectThat(
+            self.options(b"--shard-identity", b"a")["shard-identity"],
+            Equals(b"a"),
+        )
+        self.expectThat(
+            lambda: self.options(b"--shard-identity", b"a", b"--event-driven"),
+            Raises(MatchesException(UsageError)),
+        )
+
+
+    def test_shard_ttl(self):
+        """
+        ``Options`` defaults ``--shard-ttl`` to three times ``--interval``.
+        """
+        self.expectThat(
+            self.options(b"--interval", b"5")["shard-ttl"],
+            Equals(15.0),
+        )
+        self.expectThat(
+            self.options(b"--shard-ttl", b"100")["shard-ttl"],
+            Equals(100.0),
+        )
+
+
+    def test_leader_identity(self):
+        """
+        ``Options`` rejects ``--leader-identity`` with ``--shard-identity``.
+        """
+        self.expectThat(
+            self.options(b"--leader-identity", b"a")["leader-identity"],
+            Equals(b"a"),
+        )
+        self.expectThat(
+            lambda: self.options(
+                b"--leader-identity", b"a", b"--shard-identity", b"a",
+            ),
+            Raises(MatchesException(UsageError)),
+        )
+
+
+    def test_max_disruption(self):
+        """
+        ``Options`` accepts a maximum disruption and rejects one less than one.
+        """
+        self.expectThat(self.options(b"--max-disruption", b"3")["max-disruption"], Equals(3))
+        self.expectThat(
+            lambda: self.options(b"--max-disruption", b"0"),
+            Raises(MatchesException(UsageError)),
+        )
+
+
+
+class LoadRouterLimitsTests(TestCase):
+    """
+    Tests for ``_load_router_limits``.
+    """
+    def test_limits(self):
+        """
+        ``_load_router_limits`` returns a ``RouterLimits`` for each plan in the
+        file.
+        """
+        path = FilePath(self.mktemp())
+        path.setContent(dumps({
+            u"a": {u"bandwidth": 1024, u"connections": 10},
+            u"b": {u"connections": 5},
+        }))
+        self.assertThat(
+            _load_router_limits(path.path),
+            Equals({
+                u"a": RouterLimits(bandwidth=1024, connections=10),
+                u"b": RouterLimits(connections=5),
+            }),
+        )
+
+
+    def test_invalid(self):
+        """
+        ``_load_router_limits`` raises ``UsageError`` if the file is missing or
+        does not describe valid limits.
+        """
+        path = FilePath(self.mktemp())
+        self.assertRaises(UsageError, _load_router_limits, path.path)
+        for content in [
+                b"[]",
+                dumps({u"a": {u"bandwidth": 0}}),
+                dumps({u"a": {u"burst": 10}}),
+        ]:
+            path.setContent(content)
+            self.assertRaises(UsageError, _load_router_limits, path.path)
+
+
+class ExecuteConvergeOutputsTests(TestCase):
+    """
+    Tests for ``_execute_converge_outputs``.
+    """
+    def setUp(self):
+        super(ExecuteConvergeOutputsTests, self).setUp()
+        self.started = []
+        self.running = {}
+
+
+    def job(self, name, target=u"kubernetes", key=None, after=()):
+        def run():
+            self.started.append(name)
+            self.running[name] = Deferred()
+            return self.running[name]
+        return _Job(target=target, run=run, key=key, after=after)
+
+
+    def test_concurrency(self):
+        """
+        No more jobs for a target run at once than its concurrency limit
+        allows.  Jobs for other targets are not held up.
+        """
+        jobs = list(self.job(n) for n in range(4)) + [self.job(u"r", u"route53")]
+        d = _execute_converge_outputs(
+            jobs, {u"kubernetes": 2, u"route53": 1}, Clock(),
+        )
+        self.expectThat(self.started, Equals([0, 1, u"r"]))
+        self.running[1].callback(None)
+        self.expectThat(self.started, Equals([0, 1, u"r", 2]))
+        for name in [0, 2, u"r"]:
+            self.running[name].callback(None)
+        self.expectThat(self.started, Equals([0, 1, u"r", 2, 3]))
+        self.assertNoResult(d)
+        self.running[3].callback(None)
+        self.assertThat(
+            self.successResultOf(d),
+            Equals(_Outcome(jobs=5, failures=0)),
+        )
+
+
+    @capture_logging(None)
+    def test_after(self, logger):
+        """
+        A job does not start until the earlier jobs with the keys it comes
+        after have finished, successfully or not.
+        """
+        jobs = [
+            self.job(u"a", key=u"a"),
+            self.job(u"b", key=u"b"),
+            self.job(u"c", after={u"a", u"b"}),
+            self.job(u"d", key=u"a"),
+        ]
+        d = _execute_converge_outputs(jobs, {u"kubernetes": 10}, Clock())
+        self.expectThat(self.started, Equals([u"a", u"b", u"d"]))
+        self.running[u"a"].callback(None)
+        self.expectThat(self.started, Equals([u"a", u"b", u"d"]))
+        self.running[u"b"].errback(CustomException())
+        self.expectThat(self.started, Equals([u"a", u"b", u"d", u"c"]))
+        self.running[u"c"].callback(None)
+        self.running[u"d"].callback(None)
+        self.expectThat(
+            self.successResultOf(d),
+            Equals(_Outcome(jobs=4, failures=1)),
+        )
+        self.assertThat(logger.flush_tracebacks(CustomException), HasLength(1))
+
+
+    def test_synchronous(self):
+        """
+        Jobs which finish synchronously all run and the result fires
+        synchronously.
+        """
+        started = []
+        jobs = list(
+            _Job(target=u"s3", run=lambda n=n: started.append(n), key=n, after={n - 1})
+            for n in range(5)
+        )
+        d = _execute_converge_outputs(jobs, {u"s3": 1}, Clock())
+        self.expectThat(started, Equals(list(range(5))))
+        self.assertThat(
+            self.successResultOf(d),
+            Equals(_Outcome(jobs=5, failures=0)),
+        )
+
+
+
+class ConvergeSchedulerTests(TestCase):
+    """
+    Tests for ``_ConvergeScheduler``.
+    """
+    def setUp(self):
+        super(ConvergeSchedulerTests, self).setUp()
+        self.clock = Clock()
+        self.passes = []
+        self.service = _ConvergeScheduler(
+            self.clock, 10, 35, self.converge, jitter=None,
+        )
+        self.addCleanup(self.service.stopService)
+
+
+    def converge(self):
+        self.passes.append(Deferred())
+        return self.passes[-1]
+
+
+    def test_no_overlap(self):
+        """
+        A pass does not start while the previous one is still running however
+        much time passes.
+        """
+        self.service.startService()
+        self.clock.advance(1000)
+        self.expectThat(self.passes, HasLength(1))
+        self.passes[0].callback(_Outcome(jobs=1, failures=0))
+        self.clock.advance(999)
+        self.expectThat(self.passes, HasLength(1))
+        self.clock.advance(1)
+        self.expectThat(self.passes, HasLength(2))
+
+
+    def test_interval(self):
+        """
+        After a quick pass, the next one starts ``interval`` seconds after the
+        previous one started.
+        """
+        self.service.startService()
+        self.clock.advance(2)
+        self.passes[0].callback(_Outcome(jobs=1, failures=0))
+        self.clock.advance(7)
+        self.expectThat(self.passes, HasLength(1))
+        self.clock.advance(1)
+        self.expectThat(self.passes, HasLength(2))
+
+
+    @capture_logging(None)
+    def test_backoff(self, logger):
+        """
+        After passes which fail to load their inputs or in which most jobs
+        fail, the delay grows up to ``max_interval``.  It goes back to
+        ``interval`` after a healthy pass.
+        """
+        self.service.startService()
+        delays = []
+        for n in range(6):
+            if n % 2:
+                self.passes[-1].errback(CustomException())
+            else:
+                self.passes[-1].callback(_Outcome(jobs=4, failures=3))
+            [call] = self.clock.getDelayedCalls()
+            delays.append(call.getTime() - self.clock.seconds())
+            self.clock.advance(delays[-1])
+
+        self.expectThat(delays, Equals([10, 20, 30, 35, 35, 35]))
+        self.passes[-1].callback(_Outcome(jobs=4, failures=2))
+        [call] = self.clock.getDelayedCalls()
+        self.expectThat(call.getTime() - self.clock.seconds(), Equals(10))
+        self.assertThat(logger.flush_tracebacks(CustomException), HasLength(3))
+
+
+    def test_stop(self):
+        """
+        No more passes start after the service is stopped.
+        """
+        self.service.startService()
+        self.passes[0].callback(_Outcome(jobs=0, failures=0))
+        self.service.stopService()
+        self.expectThat(self.clock.getDelayedCalls(), Equals([]))
+        self.service.startService()
+        self.passes[1].callback(_Outcome(jobs=0, failures=0))
+        self.service.stopService()
+        self.clock.advance(1000)
+        self.assertThat(self.passes, HasLength(2))
+
+
+    def test_stop_waits(self):
+        """
+        The ``Deferred`` returned by ``stopService`` fires when the pass which
+        is running finishes.
+        """
+        self.service.startService()
+        d = self.service.stopService()
+        self.assertNoResult(d)
+        self.passes[0].callback(_Outcome(jobs=0, failures=0))
+        self.expectThat(self.successResultOf(d), Equals(None))
+        self.expectThat(self.clock.getDelayedCalls(), Equals([]))
+
+
+
 from hypothesis.stateful import RuleBasedStateMachine, rule, run_state_machine_as_test
 
 from tempfile import mkdtemp
@@ -527,10 +1400,15 @@ class SubscriptionConvergence(RuleBasedStateMachine):
     def check_deployments(self, database, config, subscriptions, k8s_state, aws):
         for sid in subscriptions:
             actual = k8s_state.deployments.item_by_name(deployment_name(sid))
+            subscription = database.get_subscription(sid)
             reference = create_deployment(
                 config,
-                database.get_subscription(sid),
+                subscription,
                 self.kube_model,
+            ).transform(
+                # The pods are tied to the configuration they are started with.
+                [u"spec", u"template", u"metadata", u"annotations", CONFIGURATION_HASH_ANNOTATION],
+                configuration_hash(config, subscription),
             )
             def drop_transients(deployment):
                 simplified = deployment.transform(
@@ -641,6 +1519,357 @@ class SubscriptionConvergenceTests(TestCase):
 
 
 
+class _NotifyingClient(proxyForInterface(IKubernetesClient, "_client")):
+    """
+    An ``IKubernetesClient`` which counts lists and reports the objects it
+    creates and deletes to the watchers registered by ``_WatchingKubeClient``.
+    """
+    def __init__(self, client):
+        self._client = client
+        self.lists = 0
+        self.watchers = []
+
+    def list(self, kind):
+        self.lists += 1
+        return self._client.list(kind)
+
+    def create(self, obj):
+        d = self._client.create(obj)
+        d.addCallback(self._notify, u"ADDED")
+        return d
+
+    def delete(self, obj):
+        d = self._client.get(obj)
+        def got(existing):
+            deleting = self._client.delete(obj)
+            deleting.addCallback(lambda result: self._notify(existing, u"DELETED") and result)
+            return deleting
+        d.addCallback(got)
+        return d
+
+    def _notify(self, obj, event_type):
+        for kind, handle_event in self.watchers:
+            if kind.kind == obj.kind:
+                handle_event(WatchEvent(type=event_type, object=obj))
+        return obj
+
+
+
+class _WatchingKubeClient(KubeClient):
+    """
+    A ``KubeClient`` whose watches report only the changes made through
+    ``_NotifyingClient``.
+    """
+    def watch(
+            self, kind, namespace, labels, resource_version, handle_event,
+            established=lambda: None,
+    ):
+        self.k8s.watchers.append((kind, handle_event))
+        return Deferred()
+
+
+
+class EventDrivenConvergenceTests(TestCase):
+    """
+    Tests for ``_EventDrivenConvergence``.
+    """
+    def setUp(self):
+        super(EventDrivenConvergenceTests, self).setUp()
+        self.clock = Clock()
+        self.config = attr.evolve(
+            deployment_configuration().example(), domain=u"s4.example.com",
+        )
+        self.subscriptions = memory_client(
+            FilePath(mkdtemp().decode("utf-8")), self.config.domain,
+        )
+        self.kubernetes = memory_kubernetes()
+        self.client = _NotifyingClient(self.kubernetes.client())
+        self.kube = _WatchingKubeClient(k8s=self.client)
+        self.aws = FakeAWSServiceRegion(
+            access_key="access_key_id",
+            secret_key="secret_access_key",
+        )
+        self.successResultOf(self.aws.get_route53_client().create_hosted_zone(
+            caller_reference=u"opaque reference",
+            name=self.config.domain,
+        ))
+        self.service = _EventDrivenConvergence(
+            self.clock, 600, 1, self.config, self.subscriptions, self.kube, self.aws,
+        )
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+
+
+    def create(self, details):
+        return self.successResultOf(self.subscriptions.create(
+            details.subscription_id, attr.assoc(details, oldsecrets=None),
+        ))
+
+
+    def deployments(self):
+        return sorted(
+            deployment.metadata.annotations[u"subscription"]
+            for deployment
+            in self.kubernetes._state.deployments.items
+        )
+
+
+    def test_changes(self):
+        """
+        ``_EventDrivenConvergence`` converges everything when it starts and
+        then converges the subscriptions reported by the subscription
+        manager's change feed without listing anything from Kubernetes.
+        """
+        first = attr.assoc(subscription_details().example(), subscription_id=u"first")
+        second = attr.assoc(first, subscription_id=u"second")
+        self.create(first)
+        self.clock.advance(600)
+        self.expectThat(self.deployments(), Equals([first.subscription_id]))
+        lists = self.client.lists
+
+        self.create(second)
+        self.clock.advance(1)
+        self.expectThat(
+            self.deployments(),
+            Equals(sorted([first.subscription_id, second.subscription_id])),
+        )
+
+        self.successResultOf(self.subscriptions.delete(first.subscription_id))
+        self.clock.advance(1)
+        self.expectThat(self.deployments(), Equals([second.subscription_id]))
+        self.expectThat(self.client.lists, Equals(lists))
+
+
+    def test_standby(self):
+        """
+        Given a ``LeaderElection``, nothing is converged without the lease.
+        When the lease is taken, everything is converged without listing the
+        customer grid objects again.
+        """
+        # Replace the service started by setUp with one which must wait for
+        # the lease held by another replica.
+        self.service.stopService()
+        namespace = self.config.kubernetes_namespace
+        other = LeaderElection(
+            self.clock, self.kube, namespace, u"leader", u"other", 30,
+        )
+        self.successResultOf(other.renew())
+        standby = LeaderElection(
+            self.clock, self.kube, namespace, u"leader", u"standby", 30,
+        )
+        service = _EventDrivenConvergence(
+            self.clock, 600, 1, self.config, self.subscriptions, self.kube,
+            self.aws, None, standby,
+        )
+        service.startService()
+        self.addCleanup(service.stopService)
+
+        self.create(subscription_details().example())
+        self.clock.advance(1)
+        self.expectThat(self.deployments(), Equals([]))
+        lists = self.client.lists
+
+        # The other replica goes away without giving up the lease.
+        self.clock.advance(30)
+        self.expectThat(self.deployments(), HasLength(1))
+        # Only the service is listed.
+        self.expectThat(self.client.lists, Equals(lists + 1))
+
+
+    def test_object_changed(self):
+        """
+        A change reported by a Kubernetes watch causes the subscription which
+        owns the changed object to be converged.
+        """
+        details = subscription_details().example()
+        self.create(details)
+        self.clock.advance(600)
+        [deployment] = self.kubernetes._state.deployments.items
+        self.successResultOf(self.kube.delete(deployment))
+        self.expectThat(self.deployments(), Equals([]))
+        self.clock.advance(0)
+        self.expectThat(self.deployments(), Equals([details.subscription_id]))
+
+
+    def test_cancelled_forgotten(self):
+        """
+        The objects rendered for a subscription are discarded by the first
+        full convergence after the subscription is cancelled.
+        """
+        details = subscription_details().example()
+        self.create(details)
+        self.clock.advance(600)
+        self.expectThat(_render_cache._entries, Contains(details.subscription_id))
+
+        self.successResultOf(self.subscriptions.delete(details.subscription_id))
+        self.clock.advance(600)
+        self.expectThat(self.deployments(), Equals([]))
+        self.expectThat(
+            _render_cache._entries,
+            Not(Contains(details.subscription_id)),
+        )
+
+
+
+class PlanTests(TestCase):
+    """
+    Tests for ``plan`` and ``_PlanService``.
+    """
+    def setUp(self):
+        super(PlanTests, self).setUp()
+        self.config = attr.evolve(
+            deployment_configuration().example(), domain=u"s4.example.com",
+        )
+        self.subscriptions = memory_client(
+            FilePath(mkdtemp().decode("utf-8")), self.config.domain,
+        )
+        self.kubernetes = memory_kubernetes()
+        self.kube = KubeClient(k8s=self.kubernetes.client())
+        self.aws = FakeAWSServiceRegion(
+            access_key="access_key_id",
+            secret_key="secret_access_key",
+        )
+        self.successResultOf(self.aws.get_route53_client().create_hosted_zone(
+            caller_reference=u"opaque reference",
+            name=self.config.domain,
+        ))
+
+
+    def test_plan(self):
+        """
+        ``plan`` describes the jobs a convergence pass would run without
+        running any of them.
+        """
+        details = attr.assoc(
+            subscription_details().example(),
+            subscription_id=u"example",
+            oldsecrets=None,
+        )
+        self.successResultOf(
+            self.subscriptions.create(details.subscription_id, details),
+        )
+        jobs = self.successResultOf(
+            plan(self.config, self.subscriptions, self.kube, self.aws),
+        )
+        self.expectThat(
+            sorted(job[u"description"][u"action"] for job in jobs),
+            Equals([
+                u"change-rrsets",
+                u"create-bucket",
+                u"create-configmap",
+                u"create-deployment",
+                u"create-service",
+            ]),
+        )
+        [deployment] = (
+            job for job in jobs
+            if job[u"description"][u"action"] == u"create-deployment"
+        )
+        self.expectThat(
+            deployment,
+            Equals({
+                u"target": u"kubernetes",
+                u"key": None,
+                u"after": [
+                    [u"bucket", u"example"],
+                    [u"configmap", u"example"],
+                    [u"delete-deployment", u"example"],
+                ],
+                u"description": {
+                    u"action": u"create-deployment",
+                    u"subscription": u"example",
+                },
+            }),
+        )
+        self.expectThat(loads(dumps(jobs)), Equals(jobs))
+        self.expectThat(self.kubernetes._state.deployments.items, HasLength(0))
+        self.expectThat(self.kubernetes._state.configmaps.items, HasLength(0))
+
+
+    def test_service(self):
+        """
+        ``_PlanService`` writes the plan out as JSON and stops the reactor.
+        """
+        class Reactor(object):
+            stopped = False
+            def stop(self):
+                self.stopped = True
+
+        reactor = Reactor()
+        output = BytesIO()
+        jobs = [{u"target": u"s3"}]
+        _PlanService(reactor, lambda: succeed(jobs), output).startService()
+        self.expectThat(loads(output.getvalue()), Equals(jobs))
+        self.expectThat(reactor.stopped, Equals(True))
+
+
+
+class ShardedConvergenceTests(TestCase):
+    """
+    Tests for ``converge`` given a ``Shard``.
+    """
+    def setUp(self):
+        super(ShardedConvergenceTests, self).setUp()
+        self.config = attr.evolve(
+            deployment_configuration().example(), domain=u"s4.example.com",
+        )
+        self.subscriptions = memory_client(
+            FilePath(mkdtemp().decode("utf-8")), self.config.domain,
+        )
+        self.kubernetes = memory_kubernetes()
+        self.kube = KubeClient(k8s=self.kubernetes.client())
+        self.aws = FakeAWSServiceRegion(
+            access_key="access_key_id",
+            secret_key="secret_access_key",
+        )
+        self.successResultOf(self.aws.get_route53_client().create_hosted_zone(
+            caller_reference=u"opaque reference",
+            name=self.config.domain,
+        ))
+        details = attr.assoc(subscription_details().example(), oldsecrets=None)
+        self.sids = list(u"subscription-{}".format(n) for n in range(6))
+        for sid in self.sids:
+            self.successResultOf(self.subscriptions.create(
+                sid, attr.assoc(details, subscription_id=sid),
+            ))
+
+
+    def converge(self, identity):
+        shard = Shard(identity=identity, members=[u"a", u"b"])
+        self.successResultOf(converge(
+            self.config, self.subscriptions, self.kube, self.aws,
+            clock=Clock(), shard=shard,
+        ))
+        return shard
+
+
+    def deployments(self):
+        return set(
+            deployment.metadata.annotations[u"subscription"]
+            for deployment
+            in self.kubernetes._state.deployments.items
+        )
+
+
+    def test_shards(self):
+        """
+        Each member converges only the subscriptions it owns, leaving the
+        others' alone, and only the leader creates shared infrastructure.
+        """
+        b = self.converge(u"b")
+        self.expectThat(
+            self.deployments(),
+            Equals(set(sid for sid in self.sids if b.owns(sid))),
+        )
+        self.expectThat(self.kubernetes._state.services.items, HasLength(0))
+        self.converge(u"a")
+        self.expectThat(self.deployments(), Equals(set(self.sids)))
+        self.expectThat(self.kubernetes._state.services.items, HasLength(1))
+        self.converge(u"b")
+        self.expectThat(self.deployments(), Equals(set(self.sids)))
+
+
+
 class DivertErrorsToLogTests(TestCase):
     """
     Tests for ``divert_errors_to_log``.
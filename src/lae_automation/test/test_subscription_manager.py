@@ -19,7 +19,7 @@ from testtools.matchers import Equals, Is, Not
 from hypothesis import given, assume
 
 from lae_automation.subscription_manager import (
-    Options, makeService, memory_client,
+    Options, makeService, memory_client, ChangeLog, SubscriptionDatabase,
 )
 
 from lae_util.testtools import TestCase
@@ -133,6 +133,109 @@ class SubscriptionManagerTestMixin(object):
 
 
 
+    @given(partial_subscription_details())
+    def test_changes(self, details):
+        """
+        ``changes`` reports the subscriptions which were created or deactivated
+        after the given change, along with their current details.
+        """
+        client = self.get_client()
+        start = self.successResultOf(client.changes(None, None))
+        self.expectThat(start.changes, Is(None))
+
+        created = self.successResultOf(client.create(details.subscription_id, details))
+        after_create = self.successResultOf(client.changes(start.epoch, start.latest))
+        self.expectThat(
+            after_create.changes,
+            Equals({details.subscription_id: created}),
+        )
+
+        self.successResultOf(client.delete(details.subscription_id))
+        after_delete = self.successResultOf(
+            client.changes(after_create.epoch, after_create.latest),
+        )
+        self.expectThat(
+            after_delete.changes,
+            Equals({details.subscription_id: None}),
+        )
+        self.expectThat(
+            self.successResultOf(
+                client.changes(after_delete.epoch, after_delete.latest),
+            ).changes,
+            Equals({}),
+        )
+
+
+    def test_changes_unknown(self):
+        """
+        ``changes`` reports that the changes are not known if it is asked
+        about a different epoch.
+        """
+        client = self.get_client()
+        start = self.successResultOf(client.changes(None, None))
+        self.expectThat(
+            self.successResultOf(client.changes(start.epoch + u"x", start.latest)).changes,
+            Is(None),
+        )
+
+
+
+class ChangeLogTests(TestCase):
+    """
+    Tests for ``ChangeLog``.
+    """
+    def test_since(self):
+        """
+        ``ChangeLog.since`` returns each subscription which changed after the
+        given change once, in the order of their latest change.
+        """
+        log = ChangeLog()
+        for sid in [u"a", u"b", u"a", u"c"]:
+            log.record(sid)
+        self.expectThat(log.since(log.epoch, 0), Equals([u"b", u"a", u"c"]))
+        self.expectThat(log.since(log.epoch, 2), Equals([u"a", u"c"]))
+        self.expectThat(log.since(log.epoch, 4), Equals([]))
+
+
+    def test_forgotten(self):
+        """
+        ``ChangeLog.since`` returns ``None`` if some of the changes after the
+        given change are no longer remembered.
+        """
+        log = ChangeLog(limit=2)
+        for sid in [u"a", u"b", u"c"]:
+            log.record(sid)
+        self.expectThat(log.since(log.epoch, 0), Is(None))
+        self.expectThat(log.since(log.epoch, 1), Equals([u"b", u"c"]))
+        self.expectThat(log.since(log.epoch, 4), Is(None))
+
+
+
+class SubscriptionDatabaseTests(TestCase):
+    """
+    Tests for ``SubscriptionDatabase``.
+    """
+    @given(subscription_details())
+    def test_get_active_subscription(self, details):
+        """
+        ``get_active_subscription`` returns the details of an active
+        subscription and ``None`` for one which is missing or deactivated.
+        """
+        database = SubscriptionDatabase.from_directory(
+            FilePath(mkdtemp().decode("utf-8")), u"s4.example.com",
+        )
+        sid = details.subscription_id
+        self.expectThat(database.get_active_subscription(sid), Is(None))
+        database.load_subscription(details)
+        self.expectThat(
+            database.get_active_subscription(sid),
+            GoodEquals(database.get_subscription(sid)),
+        )
+        database.deactivate_subscription(sid)
+        self.expectThat(database.get_active_subscription(sid), Is(None))
+
+
+
 class SubscriptionManagerTests(SubscriptionManagerTestMixin, TestCase):
     def get_client(self):
         return memory_client(
@@ -6,16 +6,20 @@ from twisted.application.internet import StreamServerEndpointService
 from twisted.web.resource import Resource
 from twisted.web.server import Site
 
+from prometheus_client import REGISTRY
 from prometheus_client.twisted import MetricsResource
 
 
-def prometheus_exporter(reactor, port_string):
+def prometheus_exporter(reactor, port_string, registry=REGISTRY):
     """
     Create an ``IService`` that exposes Prometheus metrics from this process
     on an HTTP server on the given port.
+
+    :param registry: The Prometheus registry from which to collect the
+        metrics to expose.
     """
     root = Resource()
-    root.putChild(b"metrics", MetricsResource())
+    root.putChild(b"metrics", MetricsResource(registry))
     service = StreamServerEndpointService(
         serverFromString(reactor, port_string),
         Site(root),
@@ -70,3 +70,52 @@ def selectors_match_metadata(selector, metadata):
         for (key, value)
         in selector.matchLabels.iteritems()
     )
+
+
+def merge_patch(current, desired):
+    """
+    Compute a JSON merge patch (RFC 7386) which gives the fields of
+    ``current`` the values they have in ``desired``.
+
+    Only fields present in ``desired`` are considered so anything else in
+    ``current`` (the status, server-assigned defaults, the resource version)
+    is left alone.  Lists are compared and replaced whole.
+
+    :param dict current: The raw form of an object as it is now.
+
+    :param dict desired: The raw form of the object as it should be.
+
+    :return dict: The patch.  It is empty if nothing needs to change.
+    """
+    patch = {}
+    for key, value in desired.iteritems():
+        old = current.get(key)
+        if isinstance(value, dict) and isinstance(old, dict):
+            changes = merge_patch(old, value)
+            if changes:
+                patch[key] = changes
+        elif old != value:
+            patch[key] = value
+    return patch
+
+
+def apply_merge_patch(document, patch):
+    """
+    Apply a JSON merge patch (RFC 7386).
+
+    :param dict document: The raw form of an object.
+
+    :param dict patch: The patch to apply, as computed by ``merge_patch``.
+
+    :return dict: A new raw object with the patch applied.  ``document`` is
+        not modified.
+    """
+    result = dict(document)
+    for key, value in patch.iteritems():
+        if value is None:
+            result.pop(key, None)
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = apply_merge_patch(result[key], value)
+        else:
+            result[key] = value
+    return result
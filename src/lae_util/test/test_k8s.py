@@ -0,0 +1,76 @@
+# Copyright Least Authority Enterprises.
+# See LICENSE for details.
+
+"""
+Tests for ``lae_util.k8s``.
+"""
+
+from testtools.matchers import Equals
+
+from lae_util.testtools import TestCase
+
+from ..k8s import merge_patch, apply_merge_patch
+
+
+class MergePatchTests(TestCase):
+    """
+    Tests for ``merge_patch`` and ``apply_merge_patch``.
+    """
+    current = {
+        u"metadata": {
+            u"name": u"foo",
+            u"resourceVersion": u"3",
+            u"labels": {u"version": u"1", u"app": u"s4"},
+        },
+        u"spec": {
+            u"replicas": 1,
+            u"ports": [{u"port": 1}, {u"port": 2}],
+        },
+        u"status": {u"replicas": 1},
+    }
+
+    def test_unchanged(self):
+        """
+        ``merge_patch`` computes an empty patch if the desired fields already
+        have the desired values, whatever other fields there are.
+        """
+        desired = {
+            u"metadata": {u"name": u"foo", u"labels": {u"app": u"s4"}},
+            u"spec": {u"replicas": 1},
+        }
+        self.assertThat(merge_patch(self.current, desired), Equals({}))
+
+
+    def test_changed(self):
+        """
+        ``merge_patch`` computes a patch including only the changed fields and
+        applying it gives those fields their new values while leaving the
+        rest alone.
+        """
+        desired = {
+            u"metadata": {u"name": u"foo", u"labels": {u"version": u"2"}},
+            u"spec": {u"replicas": 1, u"ports": [{u"port": 1}, {u"port": 3}]},
+        }
+        patch = merge_patch(self.current, desired)
+        self.expectThat(
+            patch,
+            Equals({
+                u"metadata": {u"labels": {u"version": u"2"}},
+                u"spec": {u"ports": [{u"port": 1}, {u"port": 3}]},
+            }),
+        )
+        self.expectThat(
+            apply_merge_patch(self.current, patch),
+            Equals({
+                u"metadata": {
+                    u"name": u"foo",
+                    u"resourceVersion": u"3",
+                    u"labels": {u"version": u"2", u"app": u"s4"},
+                },
+                u"spec": {
+                    u"replicas": 1,
+                    u"ports": [{u"port": 1}, {u"port": 3}],
+                },
+                u"status": {u"replicas": 1},
+            }),
+        )
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+#
+# Flood the grid router's Foolscap negotiation parser with fragmented
+# handshakes and report how quickly it gets through them.
+#
+# Each profile delivers complete negotiation headers split into chunks of a
+# fixed size, as a slow or deliberately awkward client might send them.  A
+# final profile sends data which never completes a header to show that it is
+# cut off at the header size limit rather than buffered forever.
+#
+# No network or Kubernetes is involved.  Connections are delivered straight
+# to the Foolscap proxy protocol and outgoing connections are captured by a
+# memory reactor.
+#
+# Usage:
+#
+#     benchmark-grid-router-handshakes.py [connection count]
+#
+
+from __future__ import print_function
+
+from sys import argv
+from time import time
+
+from twisted.test.proto_helpers import StringTransport, MemoryReactorClock
+
+from grid_router._router import _GridRouterService
+
+TUB_ID = u"abcdefghijklmnopqrstuvwxyz234567"
+
+HEADER = (
+    b"GET /id/%s HTTP/1.1\r\n"
+    b"Host: example.invalid\r\n"
+    b"Upgrade: TLS/1.0\r\n"
+    b"Connection: Upgrade\r\n"
+    b"\r\n"
+) % (TUB_ID.encode("ascii"),)
+
+
+def fragments(data, size):
+    return list(data[i:i + size] for i in range(0, len(data), size))
+
+
+def flood(factory, count, chunks):
+    """
+    Deliver ``count`` connections, each of which sends ``chunks``.
+
+    :return: The number of connections dropped by the router.
+    """
+    dropped = 0
+    for i in range(count):
+        protocol = factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        for chunk in chunks:
+            protocol.dataReceived(chunk)
+            if transport.disconnecting:
+                dropped += 1
+                break
+        protocol.connectionLost(None)
+    return dropped
+
+
+def main(count=5000):
+    count = int(count)
+    reactor = MemoryReactorClock()
+    router = _GridRouterService(reactor)
+    router.set_route_mapping({TUB_ID: (None, (u"10.0.0.1", 10000))})
+    factory = router.factory()
+
+    garbage = b"X" * 64
+    profiles = [
+        ("whole header", [HEADER]),
+        ("16 byte fragments", fragments(HEADER, 16)),
+        ("1 byte fragments", fragments(HEADER, 1)),
+        (
+            "unterminated, 64 byte fragments",
+            [garbage] * (factory.protocol.maximum_header_size // len(garbage) + 2),
+        ),
+    ]
+    for label, chunks in profiles:
+        start = time()
+        dropped = flood(factory, count, chunks)
+        elapsed = time() - start
+        del reactor.tcpClients[:]
+        print("{:<34} {:>9.0f} handshakes/s {:>9.0f} chunks/s  dropped {}".format(
+            label, count / elapsed, count * len(chunks) / elapsed, dropped,
+        ))
+
+
+if __name__ == '__main__':
+    main(*argv[1:])
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+#
+# Measure how many concurrent proxied connections the grid router can
+# sustain and how quickly it moves data through them.
+#
+# The grid router runs in a child process with a fixed, in-memory route
+# table pointing at fake Foolscap servers listening on loopback in this
+# process.  Clients in this process connect through the router, send a
+# Foolscap negotiation header (whole or in delayed fragments), wait for the
+# fake server's response and then transfer a payload.
+#
+# The report gives the rate at which connections were accepted and
+# completed, the 50th and 99th percentile handshake latency (from starting to
+# connect until the first byte of the server's response), payload throughput,
+# and the growth of the router's resident set size per concurrent
+# connection.  RSS is read from /proc so this only works on Linux.
+#
+# Usage:
+#
+#     benchmark-grid-router-proxy.py [options]
+#
+# For example, to compare the effect of keeping idle upstream connections:
+#
+#     benchmark-grid-router-proxy.py --connections 5000 --concurrency 500
+#     benchmark-grid-router-proxy.py --connections 5000 --concurrency 500 \
+#         --upstream-spares 8
+#
+# See --help for the other options.
+#
+
+from __future__ import print_function
+
+import sys
+from json import dumps, loads
+from itertools import count
+
+from twisted.python.usage import Options as _Options, UsageError
+from twisted.internet.task import react, LoopingCall
+from twisted.internet.defer import Deferred, DeferredSemaphore, gatherResults
+from twisted.internet.protocol import Factory, Protocol, ProcessProtocol
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP4ServerEndpoint
+
+HEADER = (
+    b"GET /id/%s HTTP/1.1\r\n"
+    b"Host: example.invalid\r\n"
+    b"Upgrade: TLS/1.0\r\n"
+    b"Connection: Upgrade\r\n"
+    b"\r\n"
+)
+
+RESPONSE = (
+    b"HTTP/1.1 101 Switching Protocols\r\n"
+    b"Upgrade: TLS/1.0, PB/1.0\r\n"
+    b"Connection: Upgrade\r\n"
+    b"\r\n"
+)
+
+
+
+class Options(_Options):
+    optParameters = [
+        ("connections", None, 1000, "The total number of connections to make.", int),
+        ("concurrency", None, 100, "The number of connections to have open at once.", int),
+        ("backends", None, 4, "The number of fake Foolscap servers.", int),
+        ("payload", None, 64 * 1024, "The number of payload bytes to transfer on each connection.", int),
+        ("direction", None, "upload",
+         "Which way the payload goes: upload (client to server), download, or both.",
+        ),
+        ("fragment-size", None, 0,
+         "If non-zero, send the negotiation header in fragments of this many bytes.",
+         int,
+        ),
+        ("fragment-delay", None, 0.001, "The seconds to wait between header fragments.", float),
+        ("upstream-spares", None, 0, "Passed on to the grid router.", int),
+    ]
+
+    optFlags = [
+        ("connect-early", None, "Passed on to the grid router."),
+        # Internal.  Run the grid router side of the benchmark.
+        ("serve-router", None, "For internal use."),
+    ]
+
+    def parseArgs(self, *extra):
+        self.extra = extra
+
+    def postOptions(self):
+        if self["direction"] not in ("upload", "download", "both"):
+            raise UsageError("--direction must be upload, download, or both")
+
+
+
+def tub_id(n):
+    return u"{:032d}".format(n)
+
+
+
+def serve_router(reactor, options, routes):
+    """
+    Run the grid router with a fixed route table.  Write the port number it
+    is listening on to stdout.
+    """
+    from grid_router._router import _GridRouterService
+
+    router = _GridRouterService(
+        reactor, options["connect-early"], options["upstream-spares"],
+    )
+    router.set_route_mapping({
+        tub: (None, (host, port))
+        for (tub, (host, port))
+        in routes.items()
+    })
+    d = TCP4ServerEndpoint(reactor, 0, backlog=1024, interface="127.0.0.1").listen(
+        router.factory(),
+    )
+    def listening(port):
+        sys.stdout.write(b"%d\n" % (port.getHost().port,))
+        sys.stdout.flush()
+        return Deferred()
+    d.addCallback(listening)
+    return d
+
+
+
+class Backend(Protocol):
+    """
+    Just enough of a Foolscap server: read the negotiation header, respond,
+    and then exchange the payload.
+    """
+    def connectionMade(self):
+        self.buffered = b""
+        self.received = 0
+        self.negotiated = False
+
+
+    def dataReceived(self, data):
+        if not self.negotiated:
+            self.buffered += data
+            if b"\r\n\r\n" not in self.buffered:
+                return
+            self.negotiated = True
+            data = self.buffered.split(b"\r\n\r\n", 1)[1]
+            self.transport.write(RESPONSE)
+            if self.factory.direction in ("download", "both"):
+                self.transport.write(b"x" * self.factory.payload)
+            if self.factory.direction == "download":
+                self.transport.loseConnection()
+                return
+
+        self.received += len(data)
+        if self.received >= self.factory.payload:
+            self.transport.loseConnection()
+
+
+
+class Client(Protocol):
+    """
+    Connect through the router, negotiate, and exchange the payload.
+
+    :ivar float started: When the connection attempt began.
+
+    :ivar float first_byte: When the first byte of the server's response
+        arrived.
+    """
+    def __init__(self, reactor, options, header, started):
+        self.reactor = reactor
+        self.options = options
+        self.header = header
+        self.started = started
+        self.first_byte = None
+        self.received = 0
+        self.done = Deferred()
+
+
+    def connectionMade(self):
+        fragment_size = self.options["fragment-size"]
+        if fragment_size:
+            fragments = list(
+                self.header[i:i + fragment_size]
+                for i in range(0, len(self.header), fragment_size)
+            )
+            for n, fragment in enumerate(fragments):
+                self.reactor.callLater(
+                    n * self.options["fragment-delay"], self.transport.write, fragment,
+                )
+        else:
+            self.transport.write(self.header)
+
+
+    def dataReceived(self, data):
+        if self.first_byte is None:
+            self.first_byte = self.reactor.seconds()
+            if self.options["direction"] in ("upload", "both"):
+                self.transport.write(b"x" * self.options["payload"])
+        self.received += len(data)
+
+
+    def connectionLost(self, reason):
+        self.done.callback(self)
+
+
+
+class RouterProcess(ProcessProtocol):
+    def __init__(self):
+        self.listening = Deferred()
+        self.ended = Deferred()
+        self._output = b""
+
+
+    def outReceived(self, data):
+        if self.listening is None:
+            return
+        self._output += data
+        if b"\n" in self._output:
+            listening, self.listening = self.listening, None
+            listening.callback(int(self._output.split(b"\n")[0]))
+
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+
+    def rss(self):
+        """
+        :return int: The resident set size of the router process in bytes.
+        """
+        with open("/proc/{}/status".format(self.transport.pid)) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+
+def run_clients(reactor, options, router_port, backend_count, router):
+    """
+    Make all of the connections, ``--concurrency`` at a time.
+
+    :return Deferred: Fires with a list of the finished ``Client`` instances
+        and the peak router RSS.
+    """
+    semaphore = DeferredSemaphore(options["concurrency"])
+    endpoint = TCP4ClientEndpoint(reactor, "127.0.0.1", router_port)
+    peak = [router.rss()]
+
+    def sample():
+        peak[0] = max(peak[0], router.rss())
+    sampler = LoopingCall(sample)
+    sampler.clock = reactor
+    sampler.start(0.05)
+
+    def one(n):
+        header = HEADER % (tub_id(n % backend_count).encode("ascii"),)
+        client = Client(reactor, options, header, reactor.seconds())
+        d = endpoint.connect(Factory.forProtocol(lambda: client))
+        d.addCallback(lambda ignored: client.done)
+        # A client which never received anything counts as a failure.
+        d.addErrback(lambda reason: client)
+        return d
+
+    d = gatherResults(list(
+        semaphore.run(one, n)
+        for n in range(options["connections"])
+    ), consumeErrors=True)
+
+    def finished(clients):
+        sampler.stop()
+        return clients, peak[0]
+    d.addCallback(finished)
+    return d
+
+
+
+def report(options, clients, elapsed, base_rss, peak_rss):
+    latencies = list(
+        client.first_byte - client.started
+        for client in clients
+        if client.first_byte is not None
+    )
+    uploaded = options["direction"] in ("upload", "both")
+    payload_bytes = sum(
+        max(0, client.received - len(RESPONSE)) + (options["payload"] if uploaded else 0)
+        for client in clients
+        if client.first_byte is not None
+    )
+    failures = len(clients) - len(latencies)
+    concurrency = min(options["concurrency"], options["connections"])
+
+    print("connections: {}  concurrency: {}  handshake: {}  payload: {} bytes ({})".format(
+        options["connections"],
+        options["concurrency"],
+        "fragments of {} bytes".format(options["fragment-size"]) if options["fragment-size"] else "whole",
+        options["payload"],
+        options["direction"],
+    ))
+    print("    {:<20} {:>10.1f} connections/s".format("accept rate", len(clients) / elapsed))
+    if latencies:
+        print("    {:<20} p50 {:.2f} ms  p99 {:.2f} ms".format(
+            "handshake latency",
+            percentile(latencies, 0.50) * 1000,
+            percentile(latencies, 0.99) * 1000,
+        ))
+    print("    {:<20} {:>10.1f} MiB/s".format("throughput", payload_bytes / elapsed / 2 ** 20))
+    print("    {:<20} base {:.1f} MiB  peak {:.1f} MiB  {:.1f} KiB/connection".format(
+        "router RSS",
+        base_rss / 2.0 ** 20,
+        peak_rss / 2.0 ** 20,
+        (peak_rss - base_rss) / 2.0 ** 10 / concurrency,
+    ))
+    print("    {:<20} {:>10}".format("failures", failures))
+
+
+
+def benchmark(reactor, options):
+    backend_factory = Factory.forProtocol(Backend)
+    backend_factory.direction = options["direction"]
+    backend_factory.payload = options["payload"]
+
+    d = gatherResults(list(
+        TCP4ServerEndpoint(reactor, 0, backlog=1024, interface="127.0.0.1").listen(backend_factory)
+        for n in range(options["backends"])
+    ))
+
+    def start_router(backends):
+        routes = {
+            tub_id(n): ("127.0.0.1", backend.getHost().port)
+            for (n, backend) in zip(count(), backends)
+        }
+        router = RouterProcess()
+        argv = [sys.executable, __file__, "--serve-router"]
+        if options["connect-early"]:
+            argv.append("--connect-early")
+        argv.append("--upstream-spares={}".format(options["upstream-spares"]))
+        argv.append(dumps(routes))
+        reactor.spawnProcess(router, sys.executable, argv, env=None, childFDs={0: "w", 1: "r", 2: 2})
+        router.listening.addCallback(lambda port: (router, port))
+        return router.listening
+    d.addCallback(start_router)
+
+    def run(router_and_port):
+        router, port = router_and_port
+        base_rss = router.rss()
+        started = reactor.seconds()
+        d = run_clients(reactor, options, port, options["backends"], router)
+
+        def done(clients_and_peak):
+            clients, peak_rss = clients_and_peak
+            report(options, clients, reactor.seconds() - started, base_rss, peak_rss)
+            router.transport.signalProcess("TERM")
+            return router.ended
+        d.addCallback(done)
+        return d
+    d.addCallback(run)
+    return d
+
+
+
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+    if options["serve-router"]:
+        [routes] = options.extra
+        return serve_router(reactor, options, loads(routes))
+    return benchmark(reactor, options)
+
+
+
+if __name__ == '__main__':
+    react(main, sys.argv[1:])
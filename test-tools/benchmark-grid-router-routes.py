@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+#
+# Measure how quickly the grid router can accept connections and select a
+# route for them, and how long it takes to install a new route table, for
+# route tables of different sizes.
+#
+# No network or Kubernetes is involved.  Connections are delivered straight
+# to the Foolscap proxy protocol and outgoing connections are captured by a
+# memory reactor.
+#
+# Usage:
+#
+#     benchmark-grid-router-routes.py [route count ...]
+#
+# The default route counts are 10000 and 100000.
+#
+
+from __future__ import print_function
+
+from sys import argv
+from time import time
+from hashlib import sha256
+
+from twisted.test.proto_helpers import StringTransport, MemoryReactorClock
+
+from grid_router._router import _GridRouterService
+
+# How many connections to accept for each measurement.
+CONNECTIONS = 20000
+
+
+def tub_id(n):
+    return sha256(b"%d" % (n,)).hexdigest()[:32].decode("ascii")
+
+
+def routes(count):
+    return {
+        tub_id(n): (None, (u"10.0.{}.{}".format(n // 256 % 256, n % 256), 10000))
+        for n in range(count)
+    }
+
+
+def request(tub_id):
+    return (
+        b"GET /id/%s HTTP/1.1\r\n"
+        b"Host: example.invalid\r\n"
+        b"Upgrade: TLS/1.0\r\n"
+        b"Connection: Upgrade\r\n"
+        b"\r\n"
+    ) % (tub_id.encode("ascii"),)
+
+
+def accept(factory, requests):
+    """
+    Deliver one connection for each of ``requests`` to the proxy.
+
+    :return: The number of connections which were refused.
+    """
+    refused = 0
+    for data in requests:
+        protocol = factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(data)
+        if transport.disconnecting:
+            refused += 1
+    return refused
+
+
+def measure(label, f, count):
+    start = time()
+    result = f()
+    elapsed = time() - start
+    print("    {:<32} {:>10.0f}/s  ({:.3f}s)".format(label, count / elapsed, elapsed))
+    return result
+
+
+def benchmark(route_count):
+    print("{} routes".format(route_count))
+    reactor = MemoryReactorClock()
+    router = _GridRouterService(reactor)
+    table = routes(route_count)
+    measure(
+        "install route table",
+        lambda: router.set_route_mapping(table),
+        route_count,
+    )
+    factory = router.factory()
+
+    known = list(request(tub_id(n % route_count)) for n in range(CONNECTIONS))
+    measure("accept known TubID", lambda: accept(factory, known), CONNECTIONS)
+    del reactor.tcpClients[:]
+
+    unknown = list(request(tub_id(route_count + n % 100)) for n in range(CONNECTIONS))
+    refused = measure("accept unknown TubID", lambda: accept(factory, unknown), CONNECTIONS)
+    assert refused == CONNECTIONS, refused
+
+
+def main(route_counts):
+    for count in route_counts or [10000, 100000]:
+        benchmark(int(count))
+
+
+if __name__ == '__main__':
+    main(argv[1:])
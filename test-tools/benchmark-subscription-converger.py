@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+#
+# Measure how the subscription converger's phases scale with the number of
+# subscriptions.
+#
+# Subscriptions live in a subscription manager database in a temporary
+# directory and are read through the in-memory subscription manager client.
+# Kubernetes is txkube's in-memory implementation and AWS is txaws' fake.
+# Nothing leaves the process.
+#
+# For each subscription count, two convergence passes run: the first
+# creates every subscription's resources and the second finds nothing to
+# change.  The report gives the time taken by each phase of each pass
+# (loading the inputs, computing the jobs and running them) and the growth
+# of the process's peak resident set size during it.  Peak RSS only grows so
+# later measurements are hidden by earlier, bigger ones.
+#
+# Usage:
+#
+#     benchmark-subscription-converger.py [subscription count ...]
+#
+# The default subscription counts are 1000, 10000 and 50000.
+#
+
+from __future__ import print_function
+
+from sys import argv
+from time import time
+from tempfile import mkdtemp
+from resource import getrusage, RUSAGE_SELF
+
+import attr
+
+from twisted.internet.task import react
+from twisted.internet.defer import inlineCallbacks, maybeDeferred, returnValue
+from twisted.python.filepath import FilePath
+
+from txaws.testing.service import FakeAWSServiceRegion
+from txkube import memory_kubernetes
+
+from lae_automation.model import SubscriptionDetails
+from lae_automation.subscription_manager import (
+    SubscriptionDatabase, memory_client,
+)
+from lae_automation.subscription_converger import (
+    _get_converge_inputs, _converge_logic, _execute_converge_outputs,
+)
+from lae_automation.kubeclient import KubeClient
+from lae_automation.signup import get_bucket_name
+from lae_automation.test.strategies import deployment_configuration
+
+DOMAIN = u"s4.example.com"
+CUSTOMER_ID = u"cus_benchmark"
+
+
+def subscription_id(n):
+    return u"bench{:06d}".format(n)
+
+
+def populate(database, count):
+    """
+    Create ``count`` subscriptions in ``database``.
+
+    Creating a subscription generates its secrets, which is slow, so only
+    the first is really created.  The others are copies of it with their own
+    identifiers.
+    """
+    template = database.create_subscription(
+        subscription_id(0),
+        SubscriptionDetails(
+            bucketname=get_bucket_name(subscription_id(0), CUSTOMER_ID),
+            oldsecrets=None,
+            customer_email=u"benchmark@example.invalid",
+            customer_pgpinfo=None,
+            product_id=u"S4_consumer_iteration_2_beta1_2014-05-27",
+            customer_id=CUSTOMER_ID,
+            subscription_id=subscription_id(0),
+            introducer_port_number=10000,
+            storage_port_number=10001,
+        ),
+    )
+    for n in range(1, count):
+        database.load_subscription(
+            attr.assoc(
+                template,
+                subscription_id=subscription_id(n),
+                bucketname=get_bucket_name(subscription_id(n), CUSTOMER_ID),
+            ),
+        )
+
+
+def peak_rss():
+    # Kilobytes, on Linux.
+    return getrusage(RUSAGE_SELF).ru_maxrss
+
+
+@inlineCallbacks
+def measure(label, f, *args):
+    rss = peak_rss()
+    start = time()
+    result = yield maybeDeferred(f, *args)
+    elapsed = time() - start
+    print("    {:<24} {:>10.3f}s  {:>+10d} KiB peak RSS".format(
+        label, elapsed, peak_rss() - rss,
+    ))
+    returnValue(result)
+
+
+@inlineCallbacks
+def converge_once(reactor, label, config, subscriptions, k8s, aws):
+    print("  {}".format(label))
+    state = yield measure(
+        "load inputs", _get_converge_inputs, config, subscriptions, k8s, aws,
+    )
+    jobs = yield measure(
+        "compute jobs", _converge_logic, state, config, subscriptions, k8s, aws,
+    )
+    print("    {:<24} {:>10d}".format("jobs", len(jobs)))
+    yield measure(
+        "run jobs", _execute_converge_outputs, jobs, None, reactor,
+    )
+
+
+@inlineCallbacks
+def benchmark(reactor, count):
+    print("{} subscriptions".format(count))
+    config = attr.evolve(deployment_configuration().example(), domain=DOMAIN)
+
+    path = FilePath(mkdtemp().decode("utf-8"))
+    populate(SubscriptionDatabase.from_directory(path, DOMAIN), count)
+    subscriptions = memory_client(path, DOMAIN)
+
+    k8s = KubeClient(k8s=memory_kubernetes().client())
+    aws = FakeAWSServiceRegion(
+        access_key="access_key_id",
+        secret_key="secret_access_key",
+    )
+    yield aws.get_route53_client().create_hosted_zone(
+        caller_reference=u"benchmark",
+        name=DOMAIN,
+    )
+
+    for label in ["initial pass", "steady pass"]:
+        yield converge_once(reactor, label, config, subscriptions, k8s, aws)
+    path.remove()
+
+
+@inlineCallbacks
+def main(reactor, *counts):
+    for count in counts or [1000, 10000, 50000]:
+        yield benchmark(reactor, int(count))
+
+
+if __name__ == '__main__':
+    react(main, argv[1:])